@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+准入控制
+全局和按映射模型的并发上限；超出上限的请求进入有界等待队列，按优先级（由请求头选择）出队，
+排队超过期限或队列已满时立即拒绝，由调用方返回Anthropic格式的overloaded_error，
+让已接纳请求的延迟在过载时保持可预期。
+"""
+
+import asyncio
+from collections import deque
+from typing import Any, AsyncGenerator, Deque, Dict, List, Optional
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    """解析按模型的并发上限配置：model1=20;model2=10;*=50"""
+    limits: Dict[str, int] = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if "=" not in item:
+            continue
+        model, limit = item.split("=", 1)
+        limits[model.strip()] = int(limit)
+    return limits
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝：队列已满或排队超时"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """已接纳请求的并发名额，release可重复调用"""
+
+    __slots__ = ("controller", "model", "released")
+
+    def __init__(self, controller: "AdmissionController", model: str):
+        self.controller = controller
+        self.model = model
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller._release(self.model)
+
+
+async def release_after(ticket: Ticket, frames: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """流式响应结束（或客户端断开）时归还并发名额"""
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        ticket.release()
+
+
+class _Waiter:
+    __slots__ = ("model", "future")
+
+    def __init__(self, model: str, future: "asyncio.Future[Ticket]"):
+        self.model = model
+        self.future = future
+
+
+class AdmissionController:
+    """并发上限 + 优先级等待队列；limit<=0表示不限制"""
+
+    def __init__(
+        self,
+        global_limit: int = 0,
+        model_limits: Optional[Dict[str, int]] = None,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+        priorities: Optional[List[str]] = None,
+        default_priority: str = "normal",
+        retry_after: float = 1.0,
+    ):
+        self.global_limit = global_limit
+        # 键为映射后的模型名，*为未列出模型的默认上限
+        self.model_limits = dict(model_limits or {})
+        self.default_model_limit = self.model_limits.get("*", 0)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.priorities = priorities or ["high", "normal", "low"]
+        self.default_priority = default_priority if default_priority in self.priorities else self.priorities[-1]
+        self.retry_after = retry_after
+
+        self._active = 0
+        self._active_by_model: Dict[str, int] = {}
+        self._queues: Dict[str, Deque[_Waiter]] = {priority: deque() for priority in self.priorities}
+        self._queued = 0
+
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.global_limit > 0 or any(limit > 0 for limit in self.model_limits.values())
+
+    def priority_of(self, value: Optional[str]) -> str:
+        """请求头中的优先级，未知值使用默认优先级"""
+        value = (value or "").strip().lower()
+        return value if value in self._queues else self.default_priority
+
+    def _model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_model_limit)
+
+    def _has_capacity(self, model: str) -> bool:
+        if self.global_limit > 0 and self._active >= self.global_limit:
+            return False
+        limit = self._model_limit(model)
+        return limit <= 0 or self._active_by_model.get(model, 0) < limit
+
+    def _grant(self, model: str) -> Ticket:
+        self._active += 1
+        self._active_by_model[model] = self._active_by_model.get(model, 0) + 1
+        self.admitted += 1
+        return Ticket(self, model)
+
+    async def acquire(self, model: str, priority: str) -> Ticket:
+        """获取并发名额：有空闲名额且队列为空时立即接纳，否则排队等待或被拒绝"""
+        if self._has_capacity(model) and not self._queued:
+            return self._grant(model)
+        if self._queued >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected("queue full", self.retry_after)
+
+        waiter = _Waiter(model, asyncio.get_event_loop().create_future())
+        self._queues[priority].append(waiter)
+        self._queued += 1
+        self.queued_total += 1
+        # 队列中可能有因其他模型满载而等待的请求，本请求的模型仍有空闲名额时直接出队
+        self._dispatch()
+        delivered = False
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            delivered = True
+            return ticket
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            raise AdmissionRejected("queue timeout", self.retry_after)
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self._queues[priority].remove(waiter)
+                self._queued -= 1
+            elif not delivered:
+                # 名额已分配但等待方超时或被取消（如客户端断开）：归还名额
+                waiter.future.result().release()
+
+    def _dispatch(self) -> None:
+        """按优先级顺序把空闲名额分配给排队请求（跳过所属模型仍满载的请求）"""
+        for priority in self.priorities:
+            queue = self._queues[priority]
+            if not queue:
+                continue
+            for waiter in list(queue):
+                if self.global_limit > 0 and self._active >= self.global_limit:
+                    return
+                if self._has_capacity(waiter.model):
+                    queue.remove(waiter)
+                    self._queued -= 1
+                    waiter.future.set_result(self._grant(waiter.model))
+
+    def _release(self, model: str) -> None:
+        self._active -= 1
+        count = self._active_by_model.get(model, 0) - 1
+        if count > 0:
+            self._active_by_model[model] = count
+        else:
+            self._active_by_model.pop(model, None)
+        if self._queued:
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        """准入控制统计，用于/health展示"""
+        return {
+            "enabled": self.enabled,
+            "global_limit": self.global_limit,
+            "model_limits": self.model_limits,
+            "active": self._active,
+            "active_by_model": dict(self._active_by_model),
+            "queued": {priority: len(queue) for priority, queue in self._queues.items()},
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+代理开销压测（单机、完全离线）
+启动模拟上游和代理两个子进程，每个场景先直连模拟上游、再经过代理发送相同负载，报告：
+  - 代理增加的延迟（经过代理与直连的总耗时分位数之差）和首token开销
+  - 经过代理的帧率、请求速率
+  - 代理进程每个请求的CPU时间（/proc/<pid>/stat）和常驻内存（VmRSS/VmHWM）；
+    每个场景开始前重置峰值（/proc/<pid>/clear_refs），峰值增量除以并发数即每个请求的峰值内存
+--save-baseline 把结果保存为基线，--compare 与基线比较，任一指标劣化超过 --threshold 百分比时退出码为1。
+用法:
+  python benchmarks/bench.py --save-baseline
+  python benchmarks/bench.py --compare --threshold 10
+  python benchmarks/bench.py --scenario stream_burst --env STREAM_COALESCE_BYTES=256
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from loadgen import anthropic_body, openai_body, run_load, summarize  # noqa: E402
+
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+# 场景：模拟上游的配置 + 请求参数
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    # 上游无延迟地连续输出细碎chunk：代理的转换/编码吞吐和CPU
+    "stream_burst": {
+        "mock": {"chunks": 400, "chunk_bytes": 8, "reasoning_chunks": 50, "ttft_ms": 0, "interval_ms": 0},
+        "stream": True, "prompt_bytes": 2000,
+    },
+    # 接近真实节奏的流：首token 100ms，之后每10ms一个chunk
+    "stream_paced": {
+        "mock": {"chunks": 60, "chunk_bytes": 16, "reasoning_chunks": 10, "ttft_ms": 100, "interval_ms": 10},
+        "stream": True, "prompt_bytes": 2000,
+    },
+    # 长对话请求体：请求解析、转换和编码的开销
+    "large_prompt": {
+        "mock": {"chunks": 20, "chunk_bytes": 16, "reasoning_chunks": 0, "ttft_ms": 0, "interval_ms": 0},
+        "stream": True, "prompt_bytes": 256 * 1024,
+    },
+    "non_stream": {
+        "mock": {"chunks": 200, "chunk_bytes": 16, "reasoning_chunks": 20, "ttft_ms": 0, "interval_ms": 0},
+        "stream": False, "prompt_bytes": 2000,
+    },
+    # 多轮对话每轮重发同一张2MB的图片：多模态转换、请求体拼接和每个请求的峰值内存
+    "multimodal": {
+        "mock": {"chunks": 20, "chunk_bytes": 16, "reasoning_chunks": 0, "ttft_ms": 0, "interval_ms": 0},
+        "stream": True, "prompt_bytes": 2000, "image_bytes": 2 * 1024 * 1024, "turns": 3,
+    },
+}
+
+# 比较基线时的指标方向和绝对噪声下限（变化量小于下限不算劣化）
+HIGHER_IS_WORSE: Dict[str, float] = {
+    "proxied_latency_p50_ms": 1.0,
+    "proxied_latency_p99_ms": 2.0,
+    "proxy_added_p50_ms": 1.0,
+    "proxy_added_p99_ms": 2.0,
+    "ttft_overhead_p50_ms": 1.0,
+    "cpu_ms_per_request": 0.1,
+    "rss_peak_mb": 2.0,
+    "rss_peak_per_request_mb": 0.5,
+}
+LOWER_IS_WORSE: Dict[str, float] = {
+    "proxied_requests_per_sec": 0.0,
+    "proxied_frames_per_sec": 0.0,
+}
+
+
+# ---- 子进程 ----
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url}: process exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url}: not ready after {timeout}s")
+
+
+def start_mock(port: int) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "mock_upstream.py"), "--port", str(port)])
+    _wait_ready(f"http://127.0.0.1:{port}/v1/models", process)
+    return process
+
+
+def start_proxy(port: int, mock_port: int, extra_env: Dict[str, str]) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "OPENAI_API_KEY": "bench",
+        "UPSTREAMS": "",
+        "LOG_LEVEL": "WARNING",
+        "LOG_SAMPLE_RATE": "0",
+        "PORT": str(port),
+    })
+    env.update(extra_env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=REPO_DIR,
+        env=env,
+    )
+    _wait_ready(f"http://127.0.0.1:{port}/health", process)
+    return process
+
+
+def stop(process: Optional[subprocess.Popen]) -> None:
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ---- 进程资源 ----
+
+def cpu_seconds(pid: int) -> float:
+    """进程累计的用户态+内核态CPU时间"""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        # comm字段可能包含空格，从最后一个")"之后开始解析
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def memory_mb(pid: int) -> Tuple[float, float]:
+    """(当前常驻内存, 峰值常驻内存)，单位MB"""
+    values = {}
+    with open(f"/proc/{pid}/status", "r") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                name, value = line.split(":", 1)
+                values[name] = int(value.split()[0]) / 1024
+    return round(values.get("VmRSS", 0.0), 1), round(values.get("VmHWM", 0.0), 1)
+
+
+def reset_peak_memory(pid: int) -> None:
+    """把VmHWM重置为当前常驻内存（Linux 4.0+），不支持时峰值为进程启动以来的值"""
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# ---- 场景 ----
+
+async def run_scenario(name: str, args: argparse.Namespace, pid: int) -> Dict[str, Any]:
+    scenario = SCENARIOS[name]
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}/v1/messages"
+    async with httpx.AsyncClient() as client:
+        await client.post(f"{mock_url}/mock/config", json=scenario["mock"])
+
+    load = {
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "requests": args.requests,
+        "duration": args.duration,
+    }
+    media = {"image_bytes": scenario.get("image_bytes", 0), "turns": scenario.get("turns", 1)}
+    direct_body = openai_body(scenario["prompt_bytes"], scenario["stream"], **media)
+    proxy_body = anthropic_body(scenario["prompt_bytes"], scenario["stream"], **media)
+
+    # 预热：建立连接、填充各级缓存
+    warmup = dict(load, rate=0.0, duration=0.0, requests=max(args.concurrency, 20))
+    await run_load(f"{mock_url}/v1/chat/completions", direct_body, "openai", **warmup)
+    await run_load(proxy_url, proxy_body, "anthropic", **warmup)
+
+    direct = summarize(await run_load(f"{mock_url}/v1/chat/completions", direct_body, "openai", **load))
+    reset_peak_memory(pid)
+    rss_before, _ = memory_mb(pid)
+    cpu_before = cpu_seconds(pid)
+    proxied_result = await run_load(proxy_url, proxy_body, "anthropic", **load)
+    cpu_used = cpu_seconds(pid) - cpu_before
+    proxied = summarize(proxied_result)
+    rss, rss_peak = memory_mb(pid)
+
+    completed = max(1, proxied["requests"] - proxied["errors"])
+    report: Dict[str, Any] = {f"direct_{key}": value for key, value in direct.items()}
+    report.update({f"proxied_{key}": value for key, value in proxied.items()})
+    report.update({
+        "proxy_added_p50_ms": round(proxied["latency_p50_ms"] - direct["latency_p50_ms"], 3),
+        "proxy_added_p99_ms": round(proxied["latency_p99_ms"] - direct["latency_p99_ms"], 3),
+        "ttft_overhead_p50_ms": round(proxied["ttft_p50_ms"] - direct["ttft_p50_ms"], 3),
+        "ttft_overhead_p99_ms": round(proxied["ttft_p99_ms"] - direct["ttft_p99_ms"], 3),
+        "cpu_ms_per_request": round(cpu_used * 1000 / completed, 3),
+        "rss_mb": rss,
+        "rss_peak_mb": rss_peak,
+        "rss_peak_per_request_mb": round(max(0.0, rss_peak - rss_before) / max(1, args.concurrency), 3),
+    })
+    return report
+
+
+# ---- 基线 ----
+
+def baseline_path(name: str) -> str:
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def compare(name: str, current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """返回劣化超过阈值的指标说明"""
+    regressions = []
+    for metric, floor in list(HIGHER_IS_WORSE.items()) + list(LOWER_IS_WORSE.items()):
+        if metric not in current or metric not in baseline:
+            continue
+        old, new = baseline[metric], current[metric]
+        delta = new - old if metric in HIGHER_IS_WORSE else old - new
+        if delta <= floor:
+            continue
+        pct = delta / abs(old) * 100 if old else float("inf")
+        if pct > threshold:
+            regressions.append(f"{name}.{metric}: {old} -> {new} ({pct:+.1f}% worse)")
+    return regressions
+
+
+def print_report(name: str, report: Dict[str, Any]) -> None:
+    print(f"\n== {name} ==")
+    for key in (
+        "proxied_requests_per_sec", "proxied_frames_per_sec",
+        "direct_latency_p50_ms", "proxied_latency_p50_ms", "proxy_added_p50_ms", "proxy_added_p99_ms",
+        "direct_ttft_p50_ms", "proxied_ttft_p50_ms", "ttft_overhead_p50_ms", "ttft_overhead_p99_ms",
+        "cpu_ms_per_request", "rss_mb", "rss_peak_mb", "rss_peak_per_request_mb", "proxied_errors",
+    ):
+        print(f"  {key:<28} {report[key]}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=0.0, help="requests/s (open loop); 0 = fixed concurrency")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds; overrides --requests")
+    parser.add_argument("--proxy-port", type=int, default=18000)
+    parser.add_argument("--mock-port", type=int, default=19100)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra proxy environment")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed regression in percent")
+    parser.add_argument("--output", help="write the full report as JSON")
+    args = parser.parse_args()
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    mock = proxy = None
+    reports: Dict[str, Dict[str, Any]] = {}
+    try:
+        mock = start_mock(args.mock_port)
+        proxy = start_proxy(args.proxy_port, args.mock_port, extra_env)
+        for name in args.scenario:
+            reports[name] = asyncio.run(run_scenario(name, args, proxy.pid))
+            print_report(name, reports[name])
+    finally:
+        stop(proxy)
+        stop(mock)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+    regressions: List[str] = []
+    for name, report in reports.items():
+        path = baseline_path(name)
+        if args.compare:
+            if not os.path.exists(path):
+                print(f"\n{name}: no baseline at {path}")
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    regressions.extend(compare(name, report, json.load(f), args.threshold))
+        if args.save_baseline:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            print(f"\n{name}: baseline saved to {path}")
+
+    if regressions:
+        print(f"\nRegressions over {args.threshold}%:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    if args.compare:
+        print(f"\nNo regressions over {args.threshold}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+请求编解码微基准
+对比每个请求的 解析 → 转换 → 编码 开销：
+  before: 标准库json.loads（request.json()）→ convert_request → httpx的json=序列化
+  after:  decode_request（orjson/msgspec + 结构校验）→ convert_request → encode_request
+用法: python benchmarks/codec_bench.py [--messages 200] [--text-bytes 2000] [--rounds 50]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import main  # noqa: E402
+import sse_encoder  # noqa: E402
+from request_codec import decode_request, encode_request  # noqa: E402
+
+WORDS = ["the", "proxy", "converts", "messages", "函数", "调用", "stream", "token", "upstream", "请求"]
+
+
+def make_body(messages: int, text_bytes: int, seed: int = 1) -> bytes:
+    """构造一个类似agent长对话的请求体：字符串content与text blocks交替，夹杂非ASCII文本"""
+    rng = random.Random(seed)
+
+    def text() -> str:
+        words = []
+        size = 0
+        while size < text_bytes:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word.encode("utf-8")) + 1
+        return " ".join(words)
+
+    history = []
+    for i in range(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        if i % 3 == 0:
+            content = text()
+        else:
+            content = [{"type": "text", "text": text()}, {"type": "text", "text": text()[:200]}]
+        history.append({"role": role, "content": content})
+    body = {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 4096,
+        "stream": True,
+        "temperature": 0.2,
+        "system": "You are a helpful assistant.",
+        "messages": history,
+    }
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def before(raw: bytes) -> bytes:
+    anthropic_request = json.loads(raw)
+    openai_request = main.AnthropicToOpenAIConverter.convert_request(anthropic_request)
+    return json.dumps(openai_request, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+
+def after(raw: bytes) -> bytes:
+    anthropic_request = decode_request(raw)
+    openai_request = main.AnthropicToOpenAIConverter.convert_request(anthropic_request)
+    return encode_request(openai_request)
+
+
+def measure(fn, raw: bytes, rounds: int) -> float:
+    """多轮取最小值，返回每个请求的秒数"""
+    fn(raw)
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(10):
+            fn(raw)
+        best = min(best, (time.perf_counter() - started) / 10)
+    return best
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 200, 1000])
+    parser.add_argument("--text-bytes", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"JSON backend: {sse_encoder.JSON_BACKEND}")
+    print(f"{'messages':>8} {'body':>10} {'before':>10} {'after':>10} {'speedup':>8}")
+    for count in args.messages:
+        raw = make_body(count, args.text_bytes)
+        assert json.loads(before(raw)) == json.loads(after(raw))
+        t_before = measure(before, raw, args.rounds)
+        t_after = measure(after, raw, args.rounds)
+        print(
+            f"{count:>8} {len(raw) / 1024:>8.0f}KB {t_before * 1e3:>8.3f}ms {t_after * 1e3:>8.3f}ms "
+            f"{t_before / t_after:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+HTTP压缩基准：每种可用编码和级别的压缩率与CPU开销
+  request:  agent长对话请求体（代理→上游的请求体压缩、客户端→代理的请求体解码）
+  response: 非流式响应体（一次性压缩）
+  stream:   SSE流，逐帧压缩并flush（STREAM_COMPRESSION）与整个流一次性压缩（压缩率上限）的对比
+CPU时间按每MB原始数据计，解码时间为接收方的开销
+用法: python benchmarks/compression_bench.py [--messages 200] [--frames 500] [--rounds 5]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import compression  # noqa: E402
+import main  # noqa: E402
+from codec_bench import make_body  # noqa: E402
+from request_codec import decode_request, encode_request  # noqa: E402
+
+LEVELS = {"gzip": [1, 6, 9], "zstd": [1, 3, 9], "br": [1, 4, 9]}
+
+
+def make_request(messages: int, text_bytes: int) -> bytes:
+    """转换后发往上游的请求体"""
+    return encode_request(main.AnthropicToOpenAIConverter.convert_request(decode_request(make_body(messages, text_bytes))))
+
+
+def make_response(text_bytes: int) -> bytes:
+    """非流式Anthropic响应体"""
+    text = (make_body(1, text_bytes).decode("utf-8") * 2)[:text_bytes]
+    return json.dumps({
+        "id": "msg_bench",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-3-5-sonnet-20241022",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "usage": {"input_tokens": 1000, "output_tokens": text_bytes // 4},
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def make_frames(count: int, chunk_bytes: int) -> list:
+    """content_block_delta帧，每帧chunk_bytes字节的文本"""
+    text = make_body(1, count * chunk_bytes).decode("utf-8")
+    return [
+        b"event: content_block_delta\ndata: " + json.dumps({
+            "type": "content_block_delta",
+            "index": 0,
+            "delta": {"type": "text_delta", "text": text[i * chunk_bytes:(i + 1) * chunk_bytes]},
+        }, ensure_ascii=False).encode("utf-8") + b"\n\n"
+        for i in range(count)
+    ]
+
+
+def best_of(fn, rounds: int) -> float:
+    fn()
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return compression.brotli.decompress(data)
+    return compression.decode_body(data, encoding)
+
+
+def stream_frames(frames: list, encoding: str, level: int) -> list:
+    compressor = compression.StreamCompressor(encoding, level)
+    return [compressor.compress(frame) for frame in frames] + [compressor.finish()]
+
+
+def stream_decode(parts: list, encoding: str) -> None:
+    if encoding == "gzip":
+        decoder = zlib.decompressobj(31)
+        for part in parts:
+            decoder.decompress(part)
+    else:
+        decompress(b"".join(parts), encoding)
+
+
+def row(name: str, raw: int, encoded: int, encode_time: float, decode_time: float) -> None:
+    mb = raw / (1024 * 1024)
+    print(
+        f"{name:<14} {encoded / 1024:>9.1f}KB {raw / encoded:>7.2f}x "
+        f"{encode_time * 1e3 / mb:>10.2f}ms {decode_time * 1e3 / mb:>10.2f}ms"
+    )
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--text-bytes", type=int, default=2000)
+    parser.add_argument("--response-bytes", type=int, default=8000)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--chunk-bytes", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = {
+        "request": make_request(args.messages, args.text_bytes),
+        "response": make_response(args.response_bytes),
+    }
+    frames = make_frames(args.frames, args.chunk_bytes)
+    samples["stream"] = b"".join(frames)
+
+    print(f"available encodings: {', '.join(compression.available())}")
+    for kind, raw in samples.items():
+        print(f"\n{kind}: {len(raw) / 1024:.1f}KB raw" + (f", {len(frames)} frames" if kind == "stream" else ""))
+        print(f"{'encoding':<14} {'encoded':>11} {'ratio':>8} {'enc/MB':>12} {'dec/MB':>12}")
+        for encoding in compression.available():
+            for level in LEVELS[encoding]:
+                name = f"{encoding}:{level}"
+                encoded = compression.compress(raw, encoding, level)
+                assert decompress(encoded, encoding) == raw
+                encode_time = best_of(lambda: compression.compress(raw, encoding, level), args.rounds)
+                decode_time = best_of(lambda: decompress(encoded, encoding), args.rounds)
+                if kind != "stream":
+                    row(name, len(raw), len(encoded), encode_time, decode_time)
+                    continue
+                row(name + " whole", len(raw), len(encoded), encode_time, decode_time)
+                parts = stream_frames(frames, encoding, level)
+                encode_time = best_of(lambda: stream_frames(frames, encoding, level), args.rounds)
+                decode_time = best_of(lambda: stream_decode(parts, encoding), args.rounds)
+                row(name + " frame", len(raw), sum(len(part) for part in parts), encode_time, decode_time)
+
+
+if __name__ == "__main__":
+    main_cli()
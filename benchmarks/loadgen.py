@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+压测负载生成器
+以固定并发（闭环）或固定速率（开环）发送请求，记录每个请求的总耗时、首token时间和SSE帧数。
+kind=anthropic 时请求代理的 /v1/messages，首token为第一个content_block_delta帧；
+kind=openai 时直接请求上游的 /chat/completions（用于计算代理本身增加的延迟），首token为第一个data帧。
+用法: python benchmarks/loadgen.py --url http://127.0.0.1:8000/v1/messages --concurrency 32 --requests 500
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ANTHROPIC_FIRST_TOKEN = '"content_block_delta"'
+
+
+class Sample:
+    """单个请求的测量结果（秒）"""
+
+    __slots__ = ("status", "latency", "ttft", "frames", "error")
+
+    def __init__(self) -> None:
+        self.status = 0
+        self.latency = 0.0
+        self.ttft: Optional[float] = None
+        self.frames = 0
+        self.error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status == 200
+
+
+class LoadResult:
+    def __init__(self, samples: List[Sample], wall: float):
+        self.samples = samples
+        self.wall = wall
+
+
+def _prompt(prompt_bytes: int) -> str:
+    return ("benchmark prompt " * (prompt_bytes // 17 + 1))[:prompt_bytes]
+
+
+def _image(image_bytes: int) -> str:
+    """固定内容的伪图片base64数据（每次生成相同内容，重复的轮次可命中代理的内容缓存）"""
+    return base64.b64encode(random.Random(image_bytes).getrandbits(8 * image_bytes).to_bytes(image_bytes, "little")).decode()
+
+
+def _turns(user: Any, turns: int) -> List[Dict[str, Any]]:
+    """多轮对话：每轮用户消息相同（重发的历史），中间是助手回复"""
+    messages: List[Dict[str, Any]] = []
+    for turn in range(turns):
+        if turn:
+            messages.append({"role": "assistant", "content": "ok"})
+        messages.append({"role": "user", "content": user})
+    return messages
+
+
+def anthropic_body(
+    prompt_bytes: int, stream: bool, max_tokens: int = 1024, image_bytes: int = 0, turns: int = 1
+) -> bytes:
+    """image_bytes>0时每轮用户消息带一张图片（image块，base64来源）"""
+    user: Any = _prompt(prompt_bytes)
+    if image_bytes:
+        user = [
+            {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": _image(image_bytes)}},
+            {"type": "text", "text": user},
+        ]
+    return json.dumps({
+        "model": "claude-bench",
+        "max_tokens": max_tokens,
+        "stream": stream,
+        "messages": _turns(user, turns),
+    }).encode("utf-8")
+
+
+def openai_body(
+    prompt_bytes: int, stream: bool, max_tokens: int = 1024, image_bytes: int = 0, turns: int = 1
+) -> bytes:
+    user: Any = _prompt(prompt_bytes)
+    if image_bytes:
+        user = [
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{_image(image_bytes)}"}},
+            {"type": "text", "text": user},
+        ]
+    return json.dumps({
+        "model": "mock",
+        "max_tokens": max_tokens,
+        "stream": stream,
+        "messages": _turns(user, turns),
+    }).encode("utf-8")
+
+
+async def _one(client: httpx.AsyncClient, url: str, body: bytes, kind: str, headers: Dict[str, str]) -> Sample:
+    sample = Sample()
+    started = time.perf_counter()
+    try:
+        async with client.stream("POST", url, content=body, headers=headers) as response:
+            sample.status = response.status_code
+            if response.headers.get("content-type", "").startswith("text/event-stream"):
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    sample.frames += 1
+                    if sample.ttft is None and (kind == "openai" or ANTHROPIC_FIRST_TOKEN in line):
+                        sample.ttft = time.perf_counter() - started
+            else:
+                await response.aread()
+                sample.ttft = time.perf_counter() - started
+                sample.frames = 1
+    except httpx.HTTPError as e:
+        sample.error = type(e).__name__
+    sample.latency = time.perf_counter() - started
+    return sample
+
+
+async def run_load(
+    url: str,
+    body: bytes,
+    kind: str = "anthropic",
+    concurrency: int = 16,
+    rate: float = 0.0,
+    requests: int = 200,
+    duration: float = 0.0,
+    headers: Optional[Dict[str, str]] = None,
+    timeout: float = 120.0,
+) -> LoadResult:
+    """
+    rate>0 时按固定速率开环发送（不等待前一个请求完成），否则用concurrency个worker闭环发送；
+    duration>0 时按时长停止，否则发送requests个请求
+    """
+    headers = dict({"content-type": "application/json"}, **(headers or {}))
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(concurrency, 64))
+    samples: List[Sample] = []
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        started = time.perf_counter()
+        deadline = started + duration if duration > 0 else None
+
+        def more(sent: int) -> bool:
+            if deadline is not None:
+                return time.perf_counter() < deadline
+            return sent < requests
+
+        if rate > 0:
+            tasks = []
+            sent = 0
+            while more(sent):
+                tasks.append(asyncio.ensure_future(_one(client, url, body, kind, headers)))
+                sent += 1
+                delay = started + sent / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            samples = list(await asyncio.gather(*tasks))
+        else:
+            counter = [0]
+
+            async def worker() -> None:
+                while more(counter[0]):
+                    counter[0] += 1
+                    samples.append(await _one(client, url, body, kind, headers))
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+    return LoadResult(samples, wall)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def summarize(result: LoadResult) -> Dict[str, Any]:
+    """汇总为毫秒/每秒的指标"""
+    ok = [sample for sample in result.samples if sample.ok]
+    latencies = [sample.latency * 1000 for sample in ok]
+    ttfts = [sample.ttft * 1000 for sample in ok if sample.ttft is not None]
+    frames = sum(sample.frames for sample in ok)
+    wall = result.wall or 1e-9
+    return {
+        "requests": len(result.samples),
+        "errors": len(result.samples) - len(ok),
+        "requests_per_sec": round(len(ok) / wall, 2),
+        "frames_per_sec": round(frames / wall, 1),
+        "latency_p50_ms": round(percentile(latencies, 50), 3),
+        "latency_p95_ms": round(percentile(latencies, 95), 3),
+        "latency_p99_ms": round(percentile(latencies, 99), 3),
+        "ttft_p50_ms": round(percentile(ttfts, 50), 3),
+        "ttft_p95_ms": round(percentile(ttfts, 95), 3),
+        "ttft_p99_ms": round(percentile(ttfts, 99), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load generator for /v1/messages")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/v1/messages")
+    parser.add_argument("--kind", choices=("anthropic", "openai"), default="anthropic")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=0.0, help="requests/s (open loop); 0 = fixed concurrency")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds; overrides --requests")
+    parser.add_argument("--prompt-bytes", type=int, default=1000)
+    parser.add_argument("--no-stream", action="store_true")
+    args = parser.parse_args()
+
+    make_body = anthropic_body if args.kind == "anthropic" else openai_body
+    body = make_body(args.prompt_bytes, not args.no_stream)
+    result = asyncio.run(run_load(
+        args.url, body, args.kind, args.concurrency, args.rate, args.requests, args.duration
+    ))
+    print(json.dumps(summarize(result), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+模拟的OpenAI兼容上游（压测用，完全离线）
+POST /v1/chat/completions 按配置返回流式SSE（含reasoning_content）或非流式响应；
+GET /v1/models 供代理的健康探测使用；
+GET/POST /mock/config 读取/修改配置（压测编排脚本在场景之间切换），GET /mock/stats 返回计数。
+SSE帧在配置变更时预先编码，模拟上游本身的CPU开销尽量小。
+用法: python benchmarks/mock_upstream.py --port 9100 --chunks 200 --chunk-bytes 8 --interval-ms 0
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+DEFAULT_CONFIG: Dict[str, Any] = {
+    # 内容chunk数和每个chunk的字节数
+    "chunks": 100,
+    "chunk_bytes": 8,
+    # 内容之前的reasoning_content chunk数
+    "reasoning_chunks": 0,
+    # 首个chunk之前的延迟和chunk之间的间隔
+    "ttft_ms": 0.0,
+    "interval_ms": 0.0,
+    # 按比例返回503（测试故障切换）
+    "error_rate": 0.0,
+    "prompt_tokens": 100,
+    # usage中报告的前缀缓存命中token数（prompt_tokens_details.cached_tokens）
+    "cached_tokens": 0,
+}
+
+_TEXT = "The quick brown fox jumps over the lazy dog. "
+
+
+def _piece(size: int) -> str:
+    return (_TEXT * (size // len(_TEXT) + 1))[:size]
+
+
+def _frame(delta: Dict[str, Any], finish_reason: Any = None, usage: Any = None) -> bytes:
+    chunk: Dict[str, Any] = {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "mock",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else [],
+    }
+    if usage is not None:
+        chunk["usage"] = usage
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def _usage(config: Dict[str, Any]) -> Dict[str, Any]:
+    completion = config["chunks"] + config["reasoning_chunks"]
+    usage: Dict[str, Any] = {
+        "prompt_tokens": config["prompt_tokens"],
+        "completion_tokens": completion,
+        "total_tokens": config["prompt_tokens"] + completion,
+    }
+    if config["cached_tokens"]:
+        usage["prompt_tokens_details"] = {"cached_tokens": config["cached_tokens"]}
+    return usage
+
+
+def build_frames(config: Dict[str, Any]) -> List[bytes]:
+    """按配置预先编码流式响应的SSE帧（不含usage帧和[DONE]）"""
+    reasoning = _frame({"reasoning_content": _piece(config["chunk_bytes"])})
+    content = _frame({"content": _piece(config["chunk_bytes"])})
+    frames = [_frame({"role": "assistant", "content": ""})]
+    frames.extend([reasoning] * config["reasoning_chunks"])
+    frames.extend([content] * config["chunks"])
+    frames.append(_frame({}, finish_reason="stop"))
+    return frames
+
+
+class MockUpstream:
+    """最小的ASGI应用，不依赖Web框架"""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.stats = {"requests": 0, "streams": 0, "streams_completed": 0, "streams_aborted": 0, "errors": 0}
+        self.configure(config)
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.frames = build_frames(self.config)
+        self.usage_frame = _frame({}, usage=_usage(self.config))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return
+        body = await self._read_body(receive)
+        if (b"content-encoding", b"gzip") in scope["headers"]:
+            # 代理开启了上游请求体压缩（UPSTREAM_REQUEST_ENCODING=gzip）
+            body = zlib.decompress(body, 47)
+        path = scope["path"]
+        method = scope["method"]
+        if path.endswith("/chat/completions") and method == "POST":
+            await self.chat_completions(json.loads(body or b"{}"), receive, send)
+        elif path.endswith("/models"):
+            await self._json(send, 200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        elif path == "/mock/config":
+            if method == "POST":
+                self.configure(json.loads(body or b"{}"))
+            await self._json(send, 200, self.config)
+        elif path == "/mock/stats":
+            await self._json(send, 200, self.stats)
+        else:
+            await self._json(send, 404, {"error": {"message": "not found"}})
+
+    @staticmethod
+    async def _read_body(receive: Receive) -> bytes:
+        parts = []
+        while True:
+            message = await receive()
+            parts.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(parts)
+
+    @staticmethod
+    async def _json(send: Send, status: int, data: Any) -> None:
+        body = json.dumps(data).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def chat_completions(self, request: Dict[str, Any], receive: Receive, send: Send) -> None:
+        config = self.config
+        self.stats["requests"] += 1
+        if config["error_rate"] and random.random() < config["error_rate"]:
+            self.stats["errors"] += 1
+            await self._json(send, 503, {"error": {"message": "mock overloaded", "type": "server_error"}})
+            return
+        if config["ttft_ms"]:
+            await asyncio.sleep(config["ttft_ms"] / 1000.0)
+
+        if not request.get("stream"):
+            message: Dict[str, Any] = {
+                "role": "assistant",
+                "content": _piece(config["chunk_bytes"] * config["chunks"]),
+            }
+            if config["reasoning_chunks"]:
+                message["reasoning_content"] = _piece(config["chunk_bytes"] * config["reasoning_chunks"])
+            await self._json(send, 200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": _usage(config),
+            })
+            return
+
+        self.stats["streams"] += 1
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        })
+        # 代理断开连接时停止生成（统计为streams_aborted），模拟上游在客户端取消后释放算力
+        disconnected = asyncio.ensure_future(receive())
+        interval = config["interval_ms"] / 1000.0
+        frames: List[bytes] = self.frames
+        try:
+            for frame in frames:
+                if disconnected.done():
+                    self.stats["streams_aborted"] += 1
+                    return
+                await send({"type": "http.response.body", "body": frame, "more_body": True})
+                if interval:
+                    await asyncio.sleep(interval)
+        finally:
+            disconnected.cancel()
+        tail: Tuple[bytes, ...] = (b"data: [DONE]\n\n",)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            tail = (self.usage_frame,) + tail
+        await send({"type": "http.response.body", "body": b"".join(tail)})
+        self.stats["streams_completed"] += 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible upstream for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    config = {key: getattr(args, key) for key in DEFAULT_CONFIG}
+    uvicorn.run(MockUpstream(config), host=args.host, port=args.port, log_level="warning", lifespan="off")
+
+
+if __name__ == "__main__":
+    main()
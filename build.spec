@@ -6,7 +6,7 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('.env.example', '.'), ],
+    datas=[('.env.example', '.'), ('routing.example.yaml', '.'), ],
     hiddenimports=[
         'uvicorn.logging',
         'uvicorn.loops',
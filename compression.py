@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+HTTP压缩
+- 非流式响应：按Accept-Encoding在zstd/br/gzip中协商（zstd需要安装zstandard，br需要brotli，
+  未安装的编码不参与协商），小于最小长度的响应体不压缩
+- 流式响应（可选）：每个SSE帧压缩后立即flush（gzip的Z_SYNC_FLUSH、zstd的FLUSH_BLOCK、brotli的flush），
+  压缩器的上下文跨帧保留，不会为了压缩率攒帧而推迟任何一帧的发送
+- 请求体：按Content-Encoding（gzip/deflate/zstd）增量解码，解压后的大小超过上限时立即中止（防止压缩炸弹）
+- 上游请求体：按配置的编码压缩后发送（需要上游支持压缩的请求体）
+"""
+
+import zlib
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from multimodal import RequestTooLarge
+from request_codec import InvalidRequest
+
+# 服务端偏好顺序（压缩率/速度综合最好的在前）
+PREFERENCE = ("zstd", "br", "gzip")
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3, "br": 4}
+
+# gzip头（wbits=16+15）；解码时32+15自动识别gzip/zlib头
+_GZIP_WBITS = 31
+_AUTO_WBITS = 47
+# zstd解码每次输入的字节数：zstd的解压对象不能限制单次输出，而每个输入字节最多解出约32KB
+# （RLE块4字节解出128KB），按片输入时单片的输出不超过约8MB，超过上限后立即中止
+_ZSTD_PIECE = 256
+_DECODE_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def available() -> List[str]:
+    """当前环境可用的响应压缩编码（按偏好顺序）"""
+    return [
+        encoding for encoding in PREFERENCE
+        if encoding == "gzip" or (encoding == "zstd" and zstandard is not None)
+        or (encoding == "br" and brotli is not None)
+    ]
+
+
+def request_encodings() -> List[str]:
+    """可以解码的请求体编码"""
+    return ["gzip", "deflate"] + (["zstd"] if zstandard is not None else [])
+
+
+class UnsupportedEncoding(InvalidRequest):
+    """无法解码的Content-Encoding（415）"""
+
+
+def parse_encodings(spec: str) -> List[str]:
+    """逗号分隔的编码列表，去掉当前环境不可用的"""
+    usable = available()
+    return [item.strip().lower() for item in spec.split(",") if item.strip().lower() in usable]
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """各编码的压缩级别：gzip:6,zstd:3,br:4（未列出的使用默认值）"""
+    levels = dict(DEFAULT_LEVELS)
+    for item in spec.split(","):
+        if ":" not in item:
+            continue
+        encoding, level = item.split(":", 1)
+        encoding = encoding.strip().lower()
+        if encoding not in levels:
+            raise ValueError(f"unknown encoding: {encoding}")
+        levels[encoding] = int(level)
+    return levels
+
+
+def negotiate(accept_encoding: str, offered: Sequence[str]) -> Optional[str]:
+    """按Accept-Encoding（含q值和*）从offered中选择编码；offered的顺序即服务端偏好"""
+    if not accept_encoding or not offered:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip()] = quality
+    best: Optional[str] = None
+    best_quality = 0.0
+    for encoding in offered:
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """一次性压缩"""
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    raise UnsupportedEncoding(encoding)
+
+
+class StreamCompressor:
+    """流式压缩：compress的输出可以直接发送，客户端解码后得到完整的输入（不缓冲到下一帧）"""
+
+    __slots__ = ("encoding", "_compressor")
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            raise UnsupportedEncoding(encoding)
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = self._compressor
+        if self.encoding == "gzip":
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "zstd":
+            return compressor.compress(data) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return compressor.process(data) + compressor.flush()
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+async def compress_stream(
+    stream: AsyncIterable[bytes], encoding: str, level: int, stats: Optional["CompressionStats"] = None
+) -> AsyncIterator[bytes]:
+    """逐帧压缩并flush的响应体迭代器；关闭时同时关闭内层迭代器（客户端断开时尽快释放上游连接）"""
+    compressor = StreamCompressor(encoding, level)
+    raw = encoded = 0
+    try:
+        async for frame in stream:
+            if frame:
+                data = compressor.compress(frame)
+                raw += len(frame)
+                encoded += len(data)
+                yield data
+        data = compressor.finish()
+        encoded += len(data)
+        yield data
+    finally:
+        if stats is not None:
+            stats.record("stream", encoding, raw, encoded)
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class CompressionStats:
+    """按方向和编码累计的压缩前后字节数"""
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[str, List[int]]] = {}
+
+    def record(self, direction: str, encoding: str, raw: int, encoded: int) -> None:
+        counter = self.counters.setdefault(direction, {}).setdefault(encoding, [0, 0, 0])
+        counter[0] += 1
+        counter[1] += raw
+        counter[2] += encoded
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            direction: {
+                encoding: {
+                    "count": count,
+                    "raw_bytes": raw,
+                    "encoded_bytes": encoded,
+                    "ratio": round(raw / encoded, 2) if encoded else None,
+                }
+                for encoding, (count, raw, encoded) in encodings.items()
+            }
+            for direction, encodings in self.counters.items()
+        }
+
+
+class BodyDecoder:
+    """请求体的增量解码器：解码后的总长度超过max_size（0表示不限制）时抛出RequestTooLarge"""
+
+    __slots__ = ("encoding", "max_size", "size", "_decoder")
+
+    def __init__(self, encoding: str, max_size: int = 0):
+        encoding = encoding.strip().lower()
+        if encoding in ("gzip", "x-gzip"):
+            self._decoder = zlib.decompressobj(_AUTO_WBITS)
+        elif encoding == "deflate":
+            self._decoder = zlib.decompressobj()
+        elif encoding == "zstd" and zstandard is not None:
+            self._decoder = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise UnsupportedEncoding(
+                f"Unsupported Content-Encoding: {encoding}; supported: {', '.join(request_encodings())}"
+            )
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0
+
+    def _grow(self, data: bytes) -> bytes:
+        self.size += len(data)
+        if self.max_size > 0 and self.size > self.max_size:
+            raise RequestTooLarge(
+                f"decompressed request body exceeds the {self.max_size // (1024 * 1024)} MB limit"
+            )
+        return data
+
+    def pieces(self, chunk: bytes, max_piece: int = 0) -> Iterator[bytes]:
+        """
+        逐片解码：gzip/deflate每片的输出不超过max_piece（0表示不限制），
+        zstd按_ZSTD_PIECE字节分片输入（单片输出有上限但不按max_piece切分）
+        """
+        try:
+            if self.encoding == "zstd":
+                for start in range(0, len(chunk), _ZSTD_PIECE):
+                    data = self._grow(self._decoder.decompress(chunk[start:start + _ZSTD_PIECE]))
+                    if data:
+                        yield data
+                return
+            while chunk:
+                limit = max_piece
+                if self.max_size > 0:
+                    # 最多多解出1个字节，用于判断是否超过上限
+                    remaining = self.max_size - self.size + 1
+                    limit = min(limit, remaining) if limit > 0 else remaining
+                data = self._grow(self._decoder.decompress(chunk, limit))
+                chunk = self._decoder.unconsumed_tail
+                if data:
+                    yield data
+        except _DECODE_ERRORS as e:
+            raise InvalidRequest(f"Invalid {self.encoding} request body: {e}")
+
+    def decode(self, chunk: bytes) -> bytes:
+        return b"".join(self.pieces(chunk))
+
+    def finish(self) -> bytes:
+        if not self._decoder.eof:
+            raise InvalidRequest(f"Invalid {self.encoding} request body: truncated stream")
+        if self.encoding == "zstd":
+            return b""
+        return self._grow(self._decoder.flush())
+
+
+def decode_body(body: bytes, encoding: str, max_size: int = 0) -> bytes:
+    """解码整个请求体；identity或空编码原样返回"""
+    if not encoding or encoding.strip().lower() == "identity":
+        return body
+    decoder = BodyDecoder(encoding, max_size)
+    return decoder.decode(body) + decoder.finish()
+
+
+async def decode_stream(
+    stream: AsyncIterable[bytes], encoding: str, max_size: int = 0, max_piece: int = 0
+) -> AsyncIterator[bytes]:
+    """边接收边解码的请求体迭代器；max_piece限制每次产出的解码数据长度（见BodyDecoder.pieces）"""
+    if not encoding or encoding.strip().lower() == "identity":
+        async for chunk in stream:
+            yield chunk
+        return
+    decoder = BodyDecoder(encoding, max_size)
+    async for chunk in stream:
+        for data in decoder.pieces(chunk, max_piece):
+            yield data
+    tail = decoder.finish()
+    if tail:
+        yield tail
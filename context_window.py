@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+本地上下文窗口检查
+按映射后的OpenAI模型配置上下文长度和最大输出token数，在转换请求后、发往上游之前用本地token计数检查：
+- 输入加上最少的输出余量超过上下文长度时立即返回Anthropic格式的400，不再让上游分词后拒绝
+- 可选的裁剪策略（trim）：保留system和最近的消息，按整轮（从一条user消息到下一条user消息之前）丢弃最早的对话，
+  直到放得下；保留的最近消息本身放不下时仍然拒绝
+- max_tokens收紧到上下文的剩余空间和模型的最大输出（未配置的限额不检查）
+token数为估算值（TokenCounter：有分词器时按分词器，否则按字节），按消息内容缓存，重复的历史消息不重复计数
+"""
+
+from typing import Any, Dict, List, Optional
+
+from request_codec import InvalidRequest
+from token_counter import REPLY_PRIMING, TokenCounter
+
+_FIELDS = ("context", "max_output")
+POLICIES = ("reject", "trim")
+
+
+class ContextLimits:
+    """单个模型的上下文长度和最大输出token数，0表示不限制"""
+
+    __slots__ = _FIELDS
+
+    def __init__(self, context: int = 0, max_output: int = 0):
+        self.context = context
+        self.max_output = max_output
+
+    def override(self, spec: str) -> "ContextLimits":
+        """在当前配置基础上覆盖：context:32768,max_output:8192"""
+        values = {field: getattr(self, field) for field in _FIELDS}
+        for item in spec.split(","):
+            item = item.strip()
+            if ":" not in item:
+                continue
+            field, value = item.split(":", 1)
+            field = field.strip()
+            if field not in values:
+                raise ValueError(f"unknown context limit field: {field}")
+            values[field] = int(value)
+        return ContextLimits(**values)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {field: getattr(self, field) for field in _FIELDS}
+
+
+def parse_context_limits(spec: str) -> Dict[str, ContextLimits]:
+    """解析按模型的限额：qwen-max-latest=context:32768,max_output:8192;*=context:131072"""
+    limits: Dict[str, ContextLimits] = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if "=" not in item:
+            continue
+        model, fields = item.split("=", 1)
+        limits[model.strip()] = ContextLimits().override(fields)
+    return limits
+
+
+class ContextOverflow(InvalidRequest):
+    """输入超过模型的上下文长度（400 invalid_request_error）"""
+
+
+class ContextWindow:
+    """按模型检查并调整转换后的OpenAI请求（就地修改messages和max_tokens）"""
+
+    def __init__(
+        self,
+        limits: Dict[str, ContextLimits],
+        counter: TokenCounter,
+        policy: str = "reject",
+        min_output: int = 256,
+        keep_recent: int = 4,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown context overflow policy: {policy}; choose one of: {', '.join(POLICIES)}")
+        self.limits = limits
+        self.counter = counter
+        self.policy = policy
+        self.min_output = min_output
+        self.keep_recent = keep_recent
+        self.checked = 0
+        self.rejected = 0
+        self.trimmed = 0
+        self.trimmed_messages = 0
+        self.clamped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.limits)
+
+    def limits_for(self, model: str) -> Optional[ContextLimits]:
+        return self.limits.get(model) or self.limits.get("*")
+
+    def _trim_point(self, messages: List[Dict[str, Any]], start: int, protected: int) -> Optional[int]:
+        """丢弃从start开始的一整轮对话后，剩余对话的起点；会碰到受保护的最近消息时返回None"""
+        end = start + 1
+        while end < len(messages) and messages[end].get("role") != "user":
+            end += 1
+        return end if end <= protected else None
+
+    def fit(self, openai_request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        检查并调整请求，返回本次的处理结果（input_tokens、dropped、max_tokens）；
+        放不下时抛出ContextOverflow
+        """
+        model = openai_request["model"]
+        limits = self.limits_for(model)
+        if limits is None:
+            return {}
+        self.checked += 1
+        max_tokens = openai_request.get("max_tokens")
+        if limits.max_output > 0 and isinstance(max_tokens, int) and max_tokens > limits.max_output:
+            max_tokens = limits.max_output
+        if limits.context <= 0:
+            return self._clamp(openai_request, max_tokens, None, 0)
+
+        messages = openai_request["messages"]
+        counts = [self.counter.count_message(model, message) for message in messages]
+        input_tokens = sum(counts) + REPLY_PRIMING
+        # 至少要留给输出的token数（max_tokens更小时以max_tokens为准）
+        reserve = min(self.min_output, max_tokens) if isinstance(max_tokens, int) else self.min_output
+        dropped = 0
+        if input_tokens + reserve > limits.context and self.policy == "trim":
+            # 开头的system消息和最近keep_recent条消息不丢弃
+            start = 0
+            while start < len(messages) and messages[start].get("role") == "system":
+                start += 1
+            protected = max(start, len(messages) - self.keep_recent)
+            end = start
+            while input_tokens + reserve > limits.context:
+                point = self._trim_point(messages, end, protected)
+                if point is None:
+                    break
+                input_tokens -= sum(counts[end:point])
+                end = point
+            if end > start and input_tokens + reserve <= limits.context:
+                dropped = end - start
+                openai_request["messages"] = messages[:start] + messages[end:]
+                self.trimmed += 1
+                self.trimmed_messages += dropped
+        if input_tokens + reserve > limits.context:
+            self.rejected += 1
+            raise ContextOverflow(
+                f"prompt is too long: about {input_tokens} tokens + {reserve} output tokens > "
+                f"{limits.context} maximum for {model}"
+            )
+        return self._clamp(openai_request, max_tokens, input_tokens, dropped, limits.context - input_tokens)
+
+    def _clamp(
+        self,
+        openai_request: Dict[str, Any],
+        max_tokens: Any,
+        input_tokens: Optional[int],
+        dropped: int,
+        room: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        if isinstance(max_tokens, int):
+            if room is not None:
+                max_tokens = min(max_tokens, room)
+            if max_tokens != openai_request["max_tokens"]:
+                openai_request["max_tokens"] = max_tokens
+                self.clamped += 1
+        return {"input_tokens": input_tokens, "dropped": dropped, "max_tokens": max_tokens}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "limits": {model: limits.as_dict() for model, limits in self.limits.items()},
+            "checked": self.checked,
+            "rejected": self.rejected,
+            "trimmed": self.trimmed,
+            "trimmed_messages": self.trimmed_messages,
+            "clamped": self.clamped,
+        }
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+流式增量合并
+把同一内容块上连续的text_delta/thinking_delta片段合并成一个SSE帧，
+达到字节阈值或时间窗口后输出，减少下游的小包写入次数
+"""
+
+import asyncio
+import time
+from typing import AsyncIterable, AsyncIterator, Callable, List, Optional, TypeVar
+
+import sse_encoder
+
+T = TypeVar("T")
+
+_ENCODERS = {
+    "text": sse_encoder.text_delta,
+    "thinking": sse_encoder.thinking_delta,
+}
+
+
+class DeltaCoalescer:
+    """增量合并器；max_bytes<=0时不合并，每个增量立即编码输出"""
+
+    def __init__(self, max_bytes: int = 0, window: float = 0.02):
+        self.max_bytes = max_bytes
+        self.window = window
+        self._kind: Optional[str] = None
+        self._index = 0
+        self._parts: List[str] = []
+        self._size = 0
+        self._deadline = 0.0
+        self._first_sent = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def add(self, kind: str, index: int, text: str) -> bytes:
+        """加入一个增量片段，返回需要立即写出的帧（可能为空）"""
+        if not self.enabled:
+            return _ENCODERS[kind](index, text)
+
+        # 块类型或索引变化时先输出之前缓冲的内容，保证事件顺序
+        output = b""
+        if self._parts and (kind != self._kind or index != self._index):
+            output = self.flush()
+
+        # 第一个增量立即输出，不增加首token延迟
+        if not self._first_sent:
+            self._first_sent = True
+            return output + _ENCODERS[kind](index, text)
+
+        if not self._parts:
+            self._kind = kind
+            self._index = index
+            self._deadline = time.monotonic() + self.window
+        self._parts.append(text)
+        self._size += len(text.encode("utf-8"))
+
+        if self._size >= self.max_bytes or time.monotonic() >= self._deadline:
+            output += self.flush()
+        return output
+
+    def flush(self) -> bytes:
+        """输出缓冲中的增量；在块开始/结束、message_delta等事件之前调用"""
+        if not self._parts:
+            return b""
+        frame = _ENCODERS[self._kind](self._index, "".join(self._parts))
+        self._parts = []
+        self._size = 0
+        return frame
+
+    def timeout(self) -> Optional[float]:
+        """距离时间窗口到期的剩余秒数，缓冲为空时返回None"""
+        if not self._parts:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+
+async def iter_with_deadline(
+    source: AsyncIterable[T],
+    timeout_fn: Callable[[], Optional[float]],
+) -> AsyncIterator[Optional[T]]:
+    """
+    迭代异步数据源，timeout_fn返回的时间内没有新数据时产出None，
+    调用方借此在上游停顿时及时输出缓冲内容。等待中的读取不会被取消。
+    """
+    iterator = source.__aiter__()
+    pending: Optional["asyncio.Future[T]"] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = timeout_fn()
+            if timeout is not None and not pending.done():
+                await asyncio.wait({pending}, timeout=timeout)
+                if not pending.done():
+                    yield None
+                    continue
+            try:
+                item = await pending
+            except StopAsyncIteration:
+                return
+            pending = None
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
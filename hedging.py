@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+对冲请求
+上游在按最近首token时间（TTFT）分位数得到的延迟内还没有返回首个有内容的chunk（只有role的首个chunk不算）时，
+向另一个上游（或同一上游的另一个连接）发送相同请求，先返回者胜出，另一个立即取消。
+对冲比例由每个模型的令牌桶预算限制，避免上游开销翻倍。
+只用于流式请求：TTFT样本和对冲延迟都按首个chunk计算，非流式请求要等整个生成结束，不适用。
+对冲的发送和胜负除了计入/health的统计，还通过on_event回调交给调用方（如导出为Prometheus指标）。
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class HedgePolicy:
+    """单个模型的对冲策略：TTFT分位数延迟 + 对冲比例预算 + 胜负统计"""
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        min_delay: float = 0.05,
+        initial_delay: float = 1.0,
+        max_rate: float = 0.05,
+        burst: float = 10.0,
+        window: int = 256,
+        min_samples: int = 20,
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._new_samples = 0
+        self._delay = initial_delay
+        self._tokens = burst
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.budget_denied = 0
+
+    def observe(self, latency: float) -> None:
+        """记录一次首token时间；每积累一批新样本重新计算一次分位数，避免每个请求都排序"""
+        self._samples.append(latency)
+        self._new_samples += 1
+        if len(self._samples) >= self.min_samples and self._new_samples >= self.min_samples:
+            self._new_samples = 0
+            ordered = sorted(self._samples)
+            rank = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+            self._delay = max(self.min_delay, ordered[rank])
+
+    def delay(self) -> float:
+        """发送对冲请求前等待的秒数"""
+        return self._delay
+
+    def admit(self) -> None:
+        """每个请求向预算桶存入max_rate个令牌（上限burst）"""
+        self.requests += 1
+        self._tokens = min(self.burst, self._tokens + self.max_rate)
+
+    def try_spend(self) -> bool:
+        """发送对冲请求需要消耗一个令牌，长期对冲比例不超过max_rate"""
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        self.budget_denied += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "delay_ms": round(self._delay * 1000, 1),
+            "samples": len(self._samples),
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_rate": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+            "hedge_win_rate": round(self.hedge_wins / self.hedges, 4) if self.hedges else 0.0,
+            "budget_denied": self.budget_denied,
+        }
+
+
+# on_event的事件：发送了对冲请求、对冲请求胜出、主请求胜出
+HEDGE_LAUNCHED = "launched"
+HEDGE_WON = "hedge_won"
+PRIMARY_WON = "primary_won"
+
+
+class Hedger:
+    """按Anthropic模型名启用对冲，每个模型独立的策略和统计"""
+
+    def __init__(
+        self,
+        models: List[str],
+        on_event: Optional[Callable[[str, str], None]] = None,
+        **policy_options: Any,
+    ):
+        self.models = models
+        self.on_event = on_event
+        self.policy_options = policy_options
+        self._policies: Dict[str, HedgePolicy] = {}
+
+    def _emit(self, model: str, event: str) -> None:
+        if self.on_event is not None:
+            self.on_event(model, event)
+
+    def enabled(self, model: str) -> bool:
+        return "*" in self.models or model in self.models
+
+    def policy(self, model: str) -> HedgePolicy:
+        policy = self._policies.get(model)
+        if policy is None:
+            policy = self._policies[model] = HedgePolicy(**self.policy_options)
+        return policy
+
+    async def run(
+        self,
+        model: str,
+        primary: Callable[[], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]],
+        discard: Callable[[T], Awaitable[None]],
+    ) -> T:
+        """
+        执行primary，超过延迟仍未完成且预算允许时并发执行hedge，返回先成功完成的结果；
+        落败的任务被取消，已经产生的结果交给discard释放（如关闭上游响应）
+        """
+        policy = self.policy(model)
+        policy.admit()
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(primary())]
+        winner: Optional["asyncio.Future[T]"] = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=policy.delay())
+            if done or not policy.try_spend():
+                result = await tasks[0]
+                winner = tasks[0]
+                policy.observe(time.monotonic() - started)
+                return result
+
+            policy.hedges += 1
+            self._emit(model, HEDGE_LAUNCHED)
+            tasks.append(asyncio.ensure_future(hedge()))
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        winner = task
+                        break
+            if winner is None:
+                # 两个请求都失败：抛出主请求的异常
+                return tasks[0].result()
+
+            if winner is tasks[0]:
+                policy.primary_wins += 1
+                self._emit(model, PRIMARY_WON)
+            else:
+                policy.hedge_wins += 1
+                self._emit(model, HEDGE_WON)
+            policy.observe(time.monotonic() - started)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    self._abandon(task, discard)
+
+    @staticmethod
+    def _abandon(task: "asyncio.Future[T]", discard: Callable[[T], Awaitable[None]]) -> None:
+        """取消落败的任务；取消前已经完成的结果交给discard释放"""
+        def _cleanup(finished: "asyncio.Future[T]") -> None:
+            if finished.cancelled():
+                return
+            if finished.exception() is None:
+                asyncio.ensure_future(discard(finished.result()))
+
+        task.cancel()
+        task.add_done_callback(_cleanup)
+
+    def stats(self) -> Dict[str, Any]:
+        """对冲统计，用于/health展示"""
+        return {
+            "models": self.models,
+            "policies": {model: policy.stats() for model, policy in self._policies.items()},
+        }
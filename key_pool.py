@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+上游API Key池
+每个上游可以配置多个API Key（逗号分隔），每个Key有请求数和token数两个令牌桶：
+- 限额来自配置（每分钟请求数/token数），或从上游响应头 x-ratelimit-limit/remaining/reset-requests|tokens 学习，
+  每次响应后按上游报告的剩余额度校准；429时按 retry-after(-ms) 或重置时间暂停该Key
+- 请求发往余量（剩余额度占比）最大的Key；所有Key暂时用尽时短暂排队等待最早恢复的Key，
+  超过最长等待时间才返回RateLimited
+- 多worker部署时每个worker按share（1/worker数）使用每个Key的限额和上游报告的剩余额度
+- Key只以编号和哈希前缀出现在统计和指标中
+"""
+
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class RateLimited(Exception):
+    """所有Key都被限流（或上游返回429），retry_after为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析OpenAI风格的重置时间：1s、6m0s、20ms、1h30m，或纯数字秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+def retry_after(headers: Any) -> Optional[float]:
+    """retry-after-ms或retry-after（秒数）响应头"""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _int_header(headers: Any, name: str, share: float = 1.0) -> Optional[int]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value) * share)
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """每分钟限额的令牌桶；limit<=0表示限额未知（不限制）"""
+
+    __slots__ = ("limit", "tokens", "rate", "updated")
+
+    def __init__(self, limit: float = 0.0):
+        self.limit = limit
+        self.tokens = limit
+        self.rate = limit / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.limit > 0 and self.tokens < self.limit:
+            self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def fraction(self) -> float:
+        return 1.0 if self.limit <= 0 else max(0.0, self.tokens) / self.limit
+
+    def wait_time(self, amount: float) -> float:
+        """取出amount个令牌还需要等待的秒数（amount不超过桶容量）"""
+        if self.limit <= 0:
+            return 0.0
+        amount = min(amount, self.limit)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, amount: float) -> None:
+        if self.limit > 0:
+            self.tokens -= amount
+
+    def sync(
+        self, limit: Optional[int], remaining: Optional[int], reset: Optional[float], pending: float = 0.0
+    ) -> None:
+        """
+        按上游报告的限额/剩余额度/重置时间校准；pending为同一Key上其他进行中请求已扣除的额度
+        （token额度在请求完成时才计入上游报告的剩余额度）。剩余额度是此刻的值，从此刻开始重新累计恢复
+        """
+        if limit:
+            self.limit = float(limit)
+            self.rate = self.limit / 60.0
+        if self.limit <= 0 or remaining is None:
+            return
+        self.tokens = float(remaining) - pending
+        self.updated = time.monotonic()
+        if reset and reset > 0 and remaining < self.limit:
+            # 在重置时间内恢复到满额
+            self.rate = max(self.limit / 60.0, (self.limit - remaining) / reset)
+
+
+class ApiKey:
+    """一个API Key：请求数/token数令牌桶、暂停截止时间和计数"""
+
+    __slots__ = (
+        "key", "label", "requests", "tokens", "blocked_until", "in_flight", "pending_tokens", "sent", "throttled"
+    )
+
+    def __init__(self, key: str, index: int, rpm: float = 0.0, tpm: float = 0.0):
+        self.key = key
+        self.label = f"key{index}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]}"
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        # 进行中请求的预估token数之和
+        self.pending_tokens = 0.0
+        self.sent = 0
+        self.throttled = 0
+
+    def headroom(self, now: float) -> float:
+        """剩余额度占比（0~1），暂停中为0"""
+        if now < self.blocked_until:
+            return 0.0
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return min(self.requests.fraction(), self.tokens.fraction())
+
+    def saturation(self, now: float) -> float:
+        return round(1.0 - self.headroom(now), 4)
+
+    def wait_time(self, now: float, estimate: float) -> float:
+        """可以发送一个预计消耗estimate个token的请求之前还需要等待的秒数"""
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.blocked_until - now, self.requests.wait_time(1), self.tokens.wait_time(estimate), 0.0)
+
+
+class KeyPool:
+    """一个上游的Key池"""
+
+    def __init__(
+        self, keys: List[str], rpm: float = 0.0, tpm: float = 0.0, cooldown: float = 1.0, share: float = 1.0
+    ):
+        self.keys = [ApiKey(key, index, rpm * share, tpm * share) for index, key in enumerate(keys or [""])]
+        self.cooldown = cooldown
+        self.share = share
+        self._next = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.exhausted = 0
+
+    @staticmethod
+    def split(spec: str) -> List[str]:
+        """逗号分隔的Key列表"""
+        return [key.strip() for key in spec.split(",") if key.strip()]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _pick(self, now: float, estimate: float) -> Optional[ApiKey]:
+        """可以立即发送的Key中余量最大的一个；余量相同时轮流使用"""
+        best: Optional[ApiKey] = None
+        best_score = -1.0
+        count = len(self.keys)
+        for offset in range(count):
+            key = self.keys[(self._next + offset) % count]
+            if key.wait_time(now, estimate) > 0:
+                continue
+            score = key.headroom(now) - key.in_flight * 1e-6
+            if score > best_score:
+                best, best_score = key, score
+        if best is not None:
+            self._next = (self.keys.index(best) + 1) % count
+        return best
+
+    def ready(self, estimate: float = 0.0) -> bool:
+        """是否有可以立即发送的Key"""
+        now = time.monotonic()
+        return any(key.wait_time(now, estimate) <= 0 for key in self.keys)
+
+    async def acquire(self, estimate: float = 0.0, max_wait: float = 0.0) -> ApiKey:
+        """
+        取一个Key并扣除一次请求和estimate个token的额度；都用尽时最多等待max_wait秒，
+        仍然没有可用的Key时抛出RateLimited
+        """
+        started = time.monotonic()
+        deadline = started + max_wait
+        waited = False
+        while True:
+            now = time.monotonic()
+            key = self._pick(now, estimate)
+            if key is not None:
+                key.requests.take(1)
+                key.tokens.take(estimate)
+                key.in_flight += 1
+                key.pending_tokens += estimate
+                key.sent += 1
+                if waited:
+                    self.waits += 1
+                    self.wait_seconds += now - started
+                return key
+            wait = min(key.wait_time(now, estimate) for key in self.keys)
+            if now + wait > deadline:
+                self.exhausted += 1
+                raise RateLimited(
+                    f"All {len(self.keys)} upstream API key(s) are rate limited; retry in {wait:.1f}s", wait
+                )
+            waited = True
+            await asyncio.sleep(max(wait, 0.001))
+
+    def update(self, key: ApiKey, headers: Any, status: int, estimate: float = 0.0) -> None:
+        """请求结束（estimate为acquire时扣除的token数）：按响应头校准额度；429时暂停该Key"""
+        self.release(key, estimate)
+        key.requests.sync(
+            _int_header(headers, "x-ratelimit-limit-requests", self.share),
+            _int_header(headers, "x-ratelimit-remaining-requests", self.share),
+            parse_duration(headers.get("x-ratelimit-reset-requests")),
+        )
+        key.tokens.sync(
+            _int_header(headers, "x-ratelimit-limit-tokens", self.share),
+            _int_header(headers, "x-ratelimit-remaining-tokens", self.share),
+            parse_duration(headers.get("x-ratelimit-reset-tokens")),
+            key.pending_tokens,
+        )
+        if status == 429:
+            key.throttled += 1
+            pause = retry_after(headers)
+            if pause is None:
+                resets = [
+                    parse_duration(headers.get("x-ratelimit-reset-requests")),
+                    parse_duration(headers.get("x-ratelimit-reset-tokens")),
+                ]
+                pause = max([reset for reset in resets if reset] or [self.cooldown])
+            key.blocked_until = max(key.blocked_until, time.monotonic() + pause)
+
+    def release(self, key: ApiKey, estimate: float = 0.0) -> None:
+        """请求没有得到响应（连接失败/取消）：只归还进行中的计数"""
+        key.in_flight -= 1
+        key.pending_tokens = max(0.0, key.pending_tokens - estimate)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "waits": self.waits,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "exhausted": self.exhausted,
+            "keys": {
+                key.label: {
+                    "saturation": key.saturation(now),
+                    "requests_remaining": round(key.requests.tokens, 1) if key.requests.limit > 0 else None,
+                    "requests_limit": key.requests.limit or None,
+                    "tokens_remaining": round(key.tokens.tokens) if key.tokens.limit > 0 else None,
+                    "tokens_limit": key.tokens.limit or None,
+                    "blocked_for": round(max(0.0, key.blocked_until - now), 3),
+                    "in_flight": key.in_flight,
+                    "sent": key.sent,
+                    "throttled": key.throttled,
+                }
+                for key in self.keys
+            },
+        }
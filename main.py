@@ -8,12 +8,52 @@ Anthropic to OpenAI API Proxy Service
 import os
 import json
 import asyncio
-from typing import AsyncGenerator, Dict, Any, Optional, List
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Dict, Any, Optional, List, Tuple, Union
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 import httpx
 from dotenv import load_dotenv
 
+import compression
+import sse_encoder
+from admission import AdmissionController, AdmissionRejected, Ticket, parse_limits, release_after
+from context_window import ContextOverflow, ContextWindow, parse_context_limits
+from delta_coalescer import DeltaCoalescer, iter_with_deadline
+from hedging import Hedger
+from key_pool import ApiKey, KeyPool, RateLimited, retry_after as key_retry_after
+from message_batches import (
+    BatchNotFound, BatchRequestError, BatchRunner, BatchStore, InvalidBatch, UpstreamSlots
+)
+from metrics import (
+    ERROR_DECODE, ERROR_INTERNAL, ERROR_TIMEOUT, ERROR_UPSTREAM_STATUS, MetricsRegistry, ProxyMetrics
+)
+from model_routing import ModelRouter, mapping_table
+from multimodal import MediaCache, MediaRequest, MediaResolver, RequestTooLarge, SplicedBody
+from phase_timer import PhaseTimer, SlowRequestLog, timed_iter, with_timing_trailer
+from prefix_cache import affinity_key, anthropic_usage, canonical_messages
+from request_codec import InvalidRequest, decode_request, encode_request, validate_request
+from request_logger import RequestLogger
+from response_cache import (
+    KIND_RESPONSE, KIND_STREAM, ResponseCache, cache_directives, cache_key, is_deterministic
+)
+from sampling_profiler import ProfileInProgress, SamplingProfiler
+from single_flight import SingleFlight
+from stream_control import (
+    CANCEL_CLIENT_DISCONNECT, CANCEL_SHUTDOWN, TIMEOUT_CONNECT, TIMEOUT_IDLE, TIMEOUT_TOTAL,
+    DisconnectAwareStreamingResponse, StreamDrain, StreamTimeouts, StreamWatchdog, UpstreamTimeout, parse_timeouts,
+    timeout_message
+)
+from token_counter import TokenCounter, parse_tokenizers
+from upstream_pool import UpstreamClientPool
+from upstream_router import (
+    RETRYABLE_STATUS, Upstream, UpstreamRouter, parse_routes, parse_upstreams
+)
+from usage_ledger import ANONYMOUS, GROUP_FIELDS, UsageLedger, account_id
+
 # 加载.env文件
 load_dotenv()
 
@@ -37,80 +77,478 @@ def parse_model_mapping() -> Dict[str, str]:
 
 MODEL_MAPPING = parse_model_mapping()
 
-app = FastAPI(title="Anthropic to OpenAI Proxy")
+# 路由配置文件（可选，.yaml/.yml/.toml/.json）：配置后取代MODEL_MAPPING，支持glob模式、按权重分流和参数覆盖，
+# 文件变化后自动重新加载（ROUTING_RELOAD_INTERVAL秒检查一次，0表示不监视）；
+# 分流键取自请求的metadata.user_id，同一用户始终落在同一个目标模型上
+ROUTING_FILE = os.getenv("ROUTING_FILE", "")
+ROUTING_RELOAD_INTERVAL = float(os.getenv("ROUTING_RELOAD_INTERVAL", "2"))
+
+# 服务配置（python main.py）：SERVER_WORKERS>1时启动多个worker进程（SO_REUSEPORT），
+# 进程内的限流状态（准入并发上限、Key池限额）按worker数平分；安装uvloop/httptools后自动使用（SERVER_LOOP/SERVER_HTTP为auto）。
+# 收到SIGTERM后停止接受新连接，进行中的流最多继续SERVER_DRAIN_TIMEOUT秒，到期仍未结束的流收到overloaded_error事件
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_WORKERS = max(1, int(os.getenv("SERVER_WORKERS", "1")))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+SERVER_KEEPALIVE_TIMEOUT = float(os.getenv("SERVER_KEEPALIVE_TIMEOUT", "5"))
+SERVER_DRAIN_TIMEOUT = float(os.getenv("SERVER_DRAIN_TIMEOUT", "30"))
+SERVER_LOOP = os.getenv("SERVER_LOOP", "auto")
+SERVER_HTTP = os.getenv("SERVER_HTTP", "auto")
+
+
+def per_worker(limit: int) -> int:
+    """全局上限在每个worker中的份额（0表示不限制）"""
+    return limit if limit <= 0 else max(1, math.ceil(limit / SERVER_WORKERS))
+
+
+# 上游连接池配置
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "300"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "0"))
+
+upstream_pool = UpstreamClientPool(
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    http2=UPSTREAM_HTTP2,
+    timeout=UPSTREAM_TIMEOUT,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+)
+
+# 分级超时（秒，0表示不限制）：首字节为请求开始到第一个data行，空闲为chunk之间的最长间隔，
+# 默认值与UPSTREAM_TIMEOUT一致；UPSTREAM_MODEL_TIMEOUTS按映射后的模型覆盖，*为未列出模型的默认配置
+UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.getenv("UPSTREAM_FIRST_BYTE_TIMEOUT", str(UPSTREAM_TIMEOUT)))
+UPSTREAM_IDLE_TIMEOUT = float(os.getenv("UPSTREAM_IDLE_TIMEOUT", str(UPSTREAM_TIMEOUT)))
+UPSTREAM_TOTAL_TIMEOUT = float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", "0"))
+
+DEFAULT_TIMEOUTS = StreamTimeouts(
+    connect=UPSTREAM_CONNECT_TIMEOUT,
+    first_byte=UPSTREAM_FIRST_BYTE_TIMEOUT,
+    idle=UPSTREAM_IDLE_TIMEOUT,
+    total=UPSTREAM_TOTAL_TIMEOUT,
+)
+MODEL_TIMEOUTS = parse_timeouts(os.getenv("UPSTREAM_MODEL_TIMEOUTS", ""), DEFAULT_TIMEOUTS)
+
+# 服务关闭时排空进行中的流（server.serve在停止接受新连接时调用begin）
+stream_drain = StreamDrain()
+
+
+def timeouts_for(model: str) -> StreamTimeouts:
+    """映射后模型的超时配置"""
+    return MODEL_TIMEOUTS.get(model) or MODEL_TIMEOUTS.get("*") or DEFAULT_TIMEOUTS
+
+# 多上游路由配置：UPSTREAMS未配置时只有一个由OPENAI_API_URL/OPENAI_API_KEY组成的默认上游
+UPSTREAMS = parse_upstreams(os.getenv("UPSTREAMS", ""))
+UPSTREAM_ROUTES = parse_routes(os.getenv("UPSTREAM_ROUTES", ""))
+UPSTREAM_BALANCE = os.getenv("UPSTREAM_BALANCE", "least_outstanding")
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "2"))
+UPSTREAM_CB_FAILURES = int(os.getenv("UPSTREAM_CB_FAILURES", "5"))
+UPSTREAM_CB_COOLDOWN = float(os.getenv("UPSTREAM_CB_COOLDOWN", "30"))
+UPSTREAM_PROBE_INTERVAL = float(os.getenv("UPSTREAM_PROBE_INTERVAL", "10"))
+# 带cache_control断点的请求按会话粘性路由到同一个上游（复用上游前缀缓存），
+# 该上游负载超过组内平均负载的这一倍数时退回普通负载均衡；0表示关闭粘性路由
+PREFIX_AFFINITY_LOAD_FACTOR = float(os.getenv("PREFIX_AFFINITY_LOAD_FACTOR", "1.5"))
+# API Key池：api_key（UPSTREAMS中的或OPENAI_API_KEY）可以是逗号分隔的多个Key。
+# 每个Key的每分钟请求数/token数限额（0表示未知，从上游x-ratelimit-*响应头学习），
+# 所有Key都用尽时最多排队等待的秒数，以及429没有retry-after时暂停该Key的秒数
+KEY_POOL_RPM = float(os.getenv("KEY_POOL_RPM", "0"))
+KEY_POOL_TPM = float(os.getenv("KEY_POOL_TPM", "0"))
+KEY_POOL_MAX_WAIT = float(os.getenv("KEY_POOL_MAX_WAIT", "5"))
+KEY_POOL_COOLDOWN = float(os.getenv("KEY_POOL_COOLDOWN", "1"))
+
+upstream_router = UpstreamRouter(
+    {
+        name: Upstream(
+            name,
+            config["url"],
+            failure_threshold=UPSTREAM_CB_FAILURES,
+            cooldown=UPSTREAM_CB_COOLDOWN,
+            keys=KeyPool(
+                KeyPool.split(config["api_key"]), KEY_POOL_RPM, KEY_POOL_TPM, KEY_POOL_COOLDOWN,
+                share=1.0 / SERVER_WORKERS
+            ),
+        )
+        for name, config in (
+            UPSTREAMS or {"default": {"url": OPENAI_API_URL, "api_key": OPENAI_API_KEY}}
+        ).items()
+    },
+    UPSTREAM_ROUTES,
+    strategy=UPSTREAM_BALANCE,
+    max_attempts=UPSTREAM_MAX_ATTEMPTS,
+    probe_interval=UPSTREAM_PROBE_INTERVAL,
+    affinity_load_factor=PREFIX_AFFINITY_LOAD_FACTOR,
+)
+
+
+# 流式增量合并配置（STREAM_COALESCE_BYTES为0表示关闭）
+STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", "0"))
+STREAM_COALESCE_WINDOW_MS = float(os.getenv("STREAM_COALESCE_WINDOW_MS", "20"))
+
+# 响应缓存配置（默认关闭，只缓存temperature为0的请求）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "64"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+    ttl=RESPONSE_CACHE_TTL,
+    disk_dir=RESPONSE_CACHE_DIR or None,
+) if RESPONSE_CACHE_ENABLED else None
+
+# 单飞合并配置：逗号分隔的Anthropic模型名，*表示所有模型；
+# 默认只合并temperature为0的请求，SINGLE_FLIGHT_SAMPLING_MODELS中的模型也合并采样请求
+def parse_model_list(name: str) -> List[str]:
+    """解析逗号分隔的模型列表环境变量"""
+    return [item.strip() for item in os.getenv(name, "").split(",") if item.strip()]
+
+
+SINGLE_FLIGHT_MODELS = parse_model_list("SINGLE_FLIGHT_MODELS")
+SINGLE_FLIGHT_SAMPLING_MODELS = parse_model_list("SINGLE_FLIGHT_SAMPLING_MODELS")
+
+single_flight = SingleFlight()
+
+
+def single_flight_enabled(model: str, deterministic: bool) -> bool:
+    """判断该模型的请求是否启用单飞合并"""
+    if deterministic:
+        return "*" in SINGLE_FLIGHT_MODELS or model in SINGLE_FLIGHT_MODELS
+    return "*" in SINGLE_FLIGHT_SAMPLING_MODELS or model in SINGLE_FLIGHT_SAMPLING_MODELS
+
+
+# 准入控制配置：全局和按映射模型的并发上限（0表示不限制），超出上限的请求按优先级排队
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "0"))
+ADMISSION_MODEL_LIMITS = parse_limits(os.getenv("ADMISSION_MODEL_LIMITS", ""))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+ADMISSION_PRIORITY_HEADER = os.getenv("ADMISSION_PRIORITY_HEADER", "x-priority")
+ADMISSION_PRIORITIES = parse_model_list("ADMISSION_PRIORITIES") or ["high", "normal", "low"]
+ADMISSION_DEFAULT_PRIORITY = os.getenv("ADMISSION_DEFAULT_PRIORITY", "normal")
+ADMISSION_REJECT_STATUS = int(os.getenv("ADMISSION_REJECT_STATUS", "529"))
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+admission = AdmissionController(
+    global_limit=per_worker(ADMISSION_MAX_CONCURRENCY),
+    model_limits={model: per_worker(limit) for model, limit in ADMISSION_MODEL_LIMITS.items()},
+    max_queue=ADMISSION_MAX_QUEUE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    priorities=ADMISSION_PRIORITIES,
+    default_priority=ADMISSION_DEFAULT_PRIORITY,
+    retry_after=ADMISSION_RETRY_AFTER,
+)
+
+
+def anthropic_error_response(
+    status_code: int,
+    error_type: str,
+    message: str,
+    headers: Optional[Dict[str, str]] = None
+) -> JSONResponse:
+    """Anthropic格式的错误响应"""
+    return JSONResponse(
+        {"type": "error", "error": {"type": error_type, "message": message}},
+        status_code=status_code,
+        headers=headers
+    )
+
+
+def overloaded_response(rejected: AdmissionRejected) -> JSONResponse:
+    """准入被拒绝时的Anthropic格式错误：529 overloaded_error 或 429 rate_limit_error"""
+    error_type = "rate_limit_error" if ADMISSION_REJECT_STATUS == 429 else "overloaded_error"
+    return anthropic_error_response(
+        ADMISSION_REJECT_STATUS,
+        error_type,
+        f"Proxy overloaded ({rejected.reason}), please retry later",
+        headers={"retry-after": str(max(1, math.ceil(rejected.retry_after)))}
+    )
+
+
+# 对冲请求配置：逗号分隔的Anthropic模型名，*表示所有模型（默认关闭，只对冲流式请求）
+HEDGE_MODELS = parse_model_list("HEDGE_MODELS")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "50"))
+HEDGE_INITIAL_DELAY_MS = float(os.getenv("HEDGE_INITIAL_DELAY_MS", "1000"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.05"))
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", "10"))
+
+hedger = Hedger(
+    HEDGE_MODELS,
+    # 对冲的发送和胜负计入/metrics（proxy_metrics在下方创建，回调时已存在）
+    on_event=lambda model, event: proxy_metrics.hedges.inc((model, event)),
+    percentile=HEDGE_PERCENTILE,
+    min_delay=HEDGE_MIN_DELAY_MS / 1000.0,
+    initial_delay=HEDGE_INITIAL_DELAY_MS / 1000.0,
+    max_rate=HEDGE_MAX_RATE,
+    burst=HEDGE_BURST,
+)
+
+
+# 指标配置：多worker部署时设置METRICS_DIR，各worker的快照写到该目录并在/metrics合并
+# （SERVER_WORKERS>1且未设置时使用启动时创建的临时目录）
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "5"))
+
+proxy_metrics = ProxyMetrics(MetricsRegistry(METRICS_DIR or None, METRICS_EXPORT_INTERVAL))
+
+
+# 多模态配置：不小于MEDIA_SPLICE_MIN_BYTES的base64数据不重新编码，直接从原始请求体拼接到上游请求体；
+# 重复的图片按内容哈希共享（MEDIA_CACHE_MAX_MB，0表示关闭）；
+# 单个请求的内存占用（原始请求体、解析结果和额外复制的数据）超过MAX_REQUEST_MEMORY_MB时返回413
+MEDIA_BLOCK_TYPES = ("image", "document")
+MEDIA_SPLICE_MIN_BYTES = int(os.getenv("MEDIA_SPLICE_MIN_BYTES", str(64 * 1024)))
+MEDIA_CACHE_MAX_MB = float(os.getenv("MEDIA_CACHE_MAX_MB", "128"))
+MAX_REQUEST_MEMORY_MB = float(os.getenv("MAX_REQUEST_MEMORY_MB", "256"))
+MAX_REQUEST_MEMORY_BYTES = int(MAX_REQUEST_MEMORY_MB * 1024 * 1024)
+
+media_cache = MediaCache(int(MEDIA_CACHE_MAX_MB * 1024 * 1024))
+
+
+# HTTP压缩配置：非流式响应按Accept-Encoding在RESPONSE_COMPRESSION中协商（顺序即偏好，zstd/br需要安装
+# zstandard/brotli），不小于RESPONSE_COMPRESSION_MIN_BYTES才压缩；STREAM_COMPRESSION开启后流式响应也压缩
+# （每帧flush，不推迟发送）；请求体按Content-Encoding（gzip/deflate/zstd）解码；
+# UPSTREAM_REQUEST_ENCODING非空时，不小于UPSTREAM_REQUEST_COMPRESS_MIN_BYTES的上游请求体压缩后发送
+RESPONSE_COMPRESSION = compression.parse_encodings(os.getenv("RESPONSE_COMPRESSION", "zstd,br,gzip"))
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+STREAM_COMPRESSION = os.getenv("STREAM_COMPRESSION", "false").lower() in ("1", "true", "yes")
+COMPRESSION_LEVELS = compression.parse_levels(os.getenv("COMPRESSION_LEVELS", ""))
+UPSTREAM_REQUEST_ENCODING = os.getenv("UPSTREAM_REQUEST_ENCODING", "").strip().lower()
+UPSTREAM_REQUEST_COMPRESS_MIN_BYTES = int(os.getenv("UPSTREAM_REQUEST_COMPRESS_MIN_BYTES", str(16 * 1024)))
+
+if UPSTREAM_REQUEST_ENCODING and UPSTREAM_REQUEST_ENCODING not in compression.available():
+    raise ValueError(
+        f"UPSTREAM_REQUEST_ENCODING={UPSTREAM_REQUEST_ENCODING} is not available; "
+        f"choose one of: {', '.join(compression.available())}"
+    )
+
+compression_stats = compression.CompressionStats()
+
+
+# 本地token计数配置：按映射模型指定分词器，*为默认；未配置或加载失败时按字节估算
+TOKENIZERS = parse_tokenizers(os.getenv("TOKENIZERS", ""))
+TOKEN_COUNT_CACHE_ENTRIES = int(os.getenv("TOKEN_COUNT_CACHE_ENTRIES", "50000"))
+
+token_counter = TokenCounter(TOKENIZERS, max_entries=TOKEN_COUNT_CACHE_ENTRIES)
+
+
+# 上下文窗口配置：按映射后的模型配置上下文长度和最大输出（*为默认，未配置表示不检查），转换后用本地token计数检查；
+# 放不下时reject立即返回400，trim丢弃最早的整轮对话（保留system和最近CONTEXT_KEEP_RECENT_MESSAGES条消息）；
+# 输出至少要留CONTEXT_MIN_OUTPUT_TOKENS，max_tokens收紧到剩余空间和最大输出
+MODEL_CONTEXT_LIMITS = parse_context_limits(os.getenv("MODEL_CONTEXT_LIMITS", ""))
+CONTEXT_OVERFLOW_POLICY = os.getenv("CONTEXT_OVERFLOW_POLICY", "reject").lower()
+CONTEXT_MIN_OUTPUT_TOKENS = int(os.getenv("CONTEXT_MIN_OUTPUT_TOKENS", "256"))
+CONTEXT_KEEP_RECENT_MESSAGES = int(os.getenv("CONTEXT_KEEP_RECENT_MESSAGES", "4"))
+
+context_window = ContextWindow(
+    MODEL_CONTEXT_LIMITS,
+    token_counter,
+    policy=CONTEXT_OVERFLOW_POLICY,
+    min_output=CONTEXT_MIN_OUTPUT_TOKENS,
+    keep_recent=CONTEXT_KEEP_RECENT_MESSAGES,
+)
+
+
+# 阶段计时配置（默认关闭：会改变输出并向客户端暴露内部耗时）：非流式响应返回Server-Timing响应头，
+# 流式响应末尾追加诊断注释帧；总耗时超过阈值的请求记入环形缓冲区（/debug/slow_requests）
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() in ("1", "true", "yes")
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "5000"))
+SLOW_REQUEST_LOG_SIZE = int(os.getenv("SLOW_REQUEST_LOG_SIZE", "100"))
+
+slow_requests = SlowRequestLog(SLOW_REQUEST_THRESHOLD_MS / 1000.0, SLOW_REQUEST_LOG_SIZE)
+
+
+# 调试端点配置（/debug/slow_requests、/debug/profile），默认关闭
+DEBUG_ENDPOINTS_ENABLED = os.getenv("DEBUG_ENDPOINTS_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000.0, PROFILE_MAX_SECONDS)
+
+
+# 消息批处理配置：批次保存在BATCH_DIR（重启后继续执行），BATCH_WORKERS个worker共享，
+# 按上游限制批处理的并发（上游名=并发数，*为默认），不影响在线请求
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "16"))
+BATCH_UPSTREAM_CONCURRENCY = parse_limits(os.getenv("BATCH_UPSTREAM_CONCURRENCY", "*=8"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "100000"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+BATCH_RETRY_BACKOFF = float(os.getenv("BATCH_RETRY_BACKOFF", "1"))
+BATCH_EXPIRY_HOURS = float(os.getenv("BATCH_EXPIRY_HOURS", "24"))
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "1"))
+
+batch_store = BatchStore(BATCH_DIR, max_requests=BATCH_MAX_REQUESTS, expiry=BATCH_EXPIRY_HOURS * 3600)
+
+
+# 用量账本：按API Key（哈希）、请求模型和映射模型累加token数和耗时，定期批量写入SQLite（WAL），
+# 查询见/usage；默认关闭，设置USAGE_DB（数据库文件路径）后开启。流式请求向上游请求stream_options.include_usage以获得真实用量
+USAGE_DB = os.getenv("USAGE_DB", "")
+USAGE_BUCKET_SECONDS = int(os.getenv("USAGE_BUCKET_SECONDS", "60"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_RETENTION_DAYS = float(os.getenv("USAGE_RETENTION_DAYS", "90"))
+STREAM_INCLUDE_USAGE = os.getenv("STREAM_INCLUDE_USAGE", "true").lower() in ("1", "true", "yes")
+
+usage_ledger = UsageLedger(
+    USAGE_DB,
+    bucket_seconds=USAGE_BUCKET_SECONDS,
+    flush_interval=USAGE_FLUSH_INTERVAL,
+    retention_days=USAGE_RETENTION_DAYS,
+)
+
+
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_MAX_BODY_CHARS = int(os.getenv("LOG_MAX_BODY_CHARS", "2000"))
+LOG_DEBUG_BODIES = os.getenv("LOG_DEBUG_BODIES", "false").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+request_logger = RequestLogger(
+    level=LOG_LEVEL,
+    sample_rate=LOG_SAMPLE_RATE,
+    max_body_chars=LOG_MAX_BODY_CHARS,
+    debug_bodies=LOG_DEBUG_BODIES,
+    queue_size=LOG_QUEUE_SIZE,
+)
+
+# 模型路由：配置了ROUTING_FILE时从文件加载（启动时文件不合法直接报错），否则使用MODEL_MAPPING
+model_router = ModelRouter(
+    mapping_table(MODEL_MAPPING, DEFAULT_OPENAI_MODEL),
+    ROUTING_FILE,
+    DEFAULT_OPENAI_MODEL,
+    interval=ROUTING_RELOAD_INTERVAL,
+    logger=request_logger,
+)
+
+
+def upstream_headers(api_key: str = OPENAI_API_KEY) -> Dict[str, str]:
+    """上游请求头"""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json; charset=utf-8"
+    }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动后台日志线程，创建共享上游连接池并预热，启动熔断上游的健康探测、路由配置监视和批处理，
+    退出时依次关闭
+    """
+    request_logger.start()
+    upstream_pool.start(request_logger)
+    if UPSTREAM_PREWARM_CONNECTIONS > 0:
+        # 所有上游并发预热，启动时间取决于最慢的一个
+        upstreams = list(upstream_router.upstreams.values())
+        results = await asyncio.gather(*[
+            upstream_pool.prewarm(
+                upstream.name,
+                f"{upstream.base_url}/models",
+                UPSTREAM_PREWARM_CONNECTIONS,
+                headers=upstream_headers(upstream.api_key)
+            )
+            for upstream in upstreams
+        ])
+        for upstream, warmed in zip(upstreams, results):
+            request_logger.info(
+                "[连接池] %s 预热连接: %d/%d", upstream.name, warmed, UPSTREAM_PREWARM_CONNECTIONS
+            )
+    upstream_router.start_probes(upstream_pool.client)
+    model_router.start()
+    proxy_metrics.registry.start()
+    batch_runner.start()
+    usage_ledger.start()
+    try:
+        yield
+    finally:
+        await usage_ledger.stop()
+        await batch_runner.stop()
+        await proxy_metrics.registry.stop()
+        await model_router.stop()
+        await upstream_router.stop_probes()
+        await upstream_pool.aclose()
+        request_logger.stop()
+
+
+app = FastAPI(title="Anthropic to OpenAI Proxy", lifespan=lifespan)
 
 
 class AnthropicToOpenAIConverter:
     """Anthropic到OpenAI请求转换器"""
 
     @staticmethod
-    def convert_messages(anthropic_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def convert_message(msg: Dict[str, Any], media: MediaResolver) -> Optional[Dict[str, Any]]:
+        """将单条Anthropic消息转换为OpenAI格式，不支持的角色返回None"""
+        role = msg["role"]
+        if role == "user" or role == "assistant":
+            # user/assistant的content可能是blocks：只保留text块和image/document块，
+            # assistant的thinking块在OpenAI中作为元数据处理，不转发
+            content = msg.get("content", [])
+            if isinstance(content, list):
+                if any(block.get("type") in MEDIA_BLOCK_TYPES for block in content):
+                    # 含图片/文档时按顺序输出OpenAI的content parts
+                    parts = []
+                    for block in content:
+                        block_type = block.get("type")
+                        if block_type == "text":
+                            parts.append({"type": "text", "text": block.get("text", "")})
+                        elif block_type in MEDIA_BLOCK_TYPES:
+                            part = media.convert_block(block)
+                            if part is not None:
+                                parts.append(part)
+                    return {"role": role, "content": parts}
+                return {
+                    "role": role,
+                    "content": "\n".join([
+                        block.get("text", "") for block in content if block.get("type") == "text"
+                    ])
+                }
+            return {
+                "role": role,
+                "content": str(content)
+            }
+        if role == "system":
+            return {
+                "role": "system",
+                "content": msg.get("content", "")
+            }
+        return None
+
+    @staticmethod
+    def convert_messages(anthropic_messages: List[Dict[str, Any]], media: MediaResolver) -> List[Dict[str, Any]]:
         """将Anthropic消息格式转换为OpenAI格式"""
+        convert_message = AnthropicToOpenAIConverter.convert_message
         openai_messages = []
-
         for msg in anthropic_messages:
-            if msg["role"] == "user":
-                # 处理Anthropic的用户消息（可能包含content blocks）
-                content = msg.get("content", [])
-                if isinstance(content, list):
-                    # Anthropic的content是blocks
-                    text_parts = []
-                    for block in content:
-                        if block.get("type") == "text":
-                            text_parts.append(block.get("text", ""))
-                    openai_messages.append({
-                        "role": "user",
-                        "content": "\n".join(text_parts) if text_parts else ""
-                    })
-                else:
-                    openai_messages.append({
-                        "role": "user",
-                        "content": str(content)
-                    })
-            elif msg["role"] == "assistant":
-                # 处理Anthropic的assistant消息
-                content = msg.get("content", [])
-                if isinstance(content, list):
-                    text_parts = []
-                    for block in content:
-                        if block.get("type") == "text":
-                            text_parts.append(block.get("text", ""))
-                        elif block.get("type") == "thinking":
-                            # 思考内容在OpenAI中作为元数据处理
-                            pass
-                    openai_messages.append({
-                        "role": "assistant",
-                        "content": "\n".join(text_parts) if text_parts else ""
-                    })
-                else:
-                    openai_messages.append({
-                        "role": "assistant",
-                        "content": str(content)
-                    })
-            elif msg["role"] == "system":
-                openai_messages.append({
-                    "role": "system",
-                    "content": msg.get("content", "")
-                })
-
+            converted = convert_message(msg, media)
+            if converted is not None:
+                openai_messages.append(converted)
         return openai_messages
 
     @staticmethod
-    def convert_request(anthropic_request: Dict[str, Any]) -> Dict[str, Any]:
-        """将完整的Anthropic请求转换为OpenAI请求"""
+    def convert_request(anthropic_request: Dict[str, Any], raw: Optional[bytes] = None) -> Dict[str, Any]:
+        """
+        将完整的Anthropic请求转换为OpenAI请求；raw为原始请求体，较大的图片/文档数据直接从中切片拼接。
+        system提示词合并为第一条消息，多轮对话的前缀保持逐字节相同（见prefix_cache）。
+        内存占用超过MAX_REQUEST_MEMORY_MB时抛出RequestTooLarge
+        """
         # 获取用户请求的模型
         requested_model = anthropic_request.get("model", "")
         
-        # 根据模型映射转换，如果没有映射则使用默认模型
-        if requested_model in MODEL_MAPPING:
-            model = MODEL_MAPPING[requested_model]
-        else:
-            model = DEFAULT_OPENAI_MODEL
+        # 按路由规则选择目标模型（未匹配任何规则时使用默认模型），同一用户的分流结果保持稳定
+        user_id = (anthropic_request.get("metadata") or {}).get("user_id")
+        target = model_router.resolve(requested_model, user_id if isinstance(user_id, str) else None)
+        model = target.model
 
         # 转换消息
+        media = MediaResolver(raw, media_cache, MEDIA_SPLICE_MIN_BYTES, MAX_REQUEST_MEMORY_BYTES)
         messages = AnthropicToOpenAIConverter.convert_messages(
-            anthropic_request.get("messages", [])
+            anthropic_request.get("messages", []), media
         )
+        messages = canonical_messages(anthropic_request.get("system"), messages)
 
         # 创建OpenAI请求
         openai_request = {
@@ -118,6 +556,9 @@ class AnthropicToOpenAIConverter:
             "messages": messages,
             "stream": anthropic_request.get("stream", False)
         }
+        if openai_request["stream"] and STREAM_INCLUDE_USAGE:
+            # 流末尾的usage chunk（路由规则可以用params覆盖或删除）
+            openai_request["stream_options"] = {"include_usage": True}
 
         # 复制可选参数
         if "temperature" in anthropic_request:
@@ -128,7 +569,12 @@ class AnthropicToOpenAIConverter:
             openai_request["top_p"] = anthropic_request["top_p"]
         if "stop" in anthropic_request:
             openai_request["stop"] = anthropic_request["stop"]
+        # 路由规则的参数覆盖
+        if target.params:
+            target.apply(openai_request)
 
+        if media.media:
+            return MediaRequest(openai_request, media.media)
         return openai_request
 
 
@@ -188,10 +634,7 @@ class OpenAIToAnthropicConverter:
             "model": original_model,
             "stop_reason": None,
             "stop_sequence": None,
-            "usage": {
-                "input_tokens": openai_response.get("usage", {}).get("prompt_tokens", 0),
-                "output_tokens": openai_response.get("usage", {}).get("completion_tokens", 0)
-            }
+            "usage": anthropic_usage(openai_response.get("usage"))
         }
 
         # 转换内容
@@ -221,207 +664,734 @@ class OpenAIToAnthropicConverter:
         return anthropic_response
 
 
-async def stream_openai_response(
-    openai_request: Dict[str, Any],
-    original_model: str
-) -> AsyncGenerator[str, None]:
-    """流式传输OpenAI响应并转换为Anthropic格式"""
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no"
+}
+
+
+class UpstreamCall:
+    """
+    一次已发出的上游请求；流式请求额外保存读到首个有内容的data行为止的所有data行
+    （对冲时以首个有内容的data行判断胜负，只有role的首个chunk不算）
+    """
+
+    __slots__ = ("upstream", "started", "response", "connect_time", "lines", "head", "ttft")
+
+    def __init__(self, upstream: Upstream, started: float, response: httpx.Response):
+        self.upstream = upstream
+        self.started = started
+        self.response = response
+        self.connect_time = time.monotonic() - started
+        self.lines: Optional[AsyncIterator[str]] = None
+        self.head: List[str] = []
+        self.ttft: Optional[float] = None
+
+    @property
+    def first_line(self) -> Optional[str]:
+        return self.head[0] if self.head else None
+
+    async def discard(self) -> None:
+        """释放落败的对冲请求：关闭响应，不计入熔断器"""
+        await self.response.aclose()
+        self.upstream.release(success=None)
+
+
+def estimate_tokens(openai_request: Dict[str, Any], body: Union[bytes, SplicedBody]) -> int:
+    """Key池按token限额节流时的预估消耗：请求体字节数/4 + max_tokens（上游报告的剩余额度随后校准）"""
+    max_tokens = openai_request.get("max_tokens")
+    return len(body) // 4 + (max_tokens if isinstance(max_tokens, int) else 0)
+
+
+async def acquire_key(upstream: Upstream, estimate: int, max_wait: float) -> ApiKey:
+    """从上游的Key池取一个Key，记录排队时间和拒绝次数"""
+    started = time.monotonic()
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            async with client.stream(
+        key = await upstream.keys.acquire(estimate, max_wait)
+    except RateLimited:
+        proxy_metrics.key_pool_exhausted.inc((upstream.name,))
+        raise
+    waited = time.monotonic() - started
+    if waited > 0.001:
+        proxy_metrics.key_pool_wait.observe((upstream.name,), waited)
+    return key
+
+
+def update_key(upstream: Upstream, key: ApiKey, response: Optional[httpx.Response], estimate: int) -> None:
+    """按响应头校准Key的额度并更新Key的指标；response为None表示没有得到响应"""
+    if response is None:
+        upstream.keys.release(key, estimate)
+    else:
+        upstream.keys.update(key, response.headers, response.status_code, estimate)
+        proxy_metrics.key_requests.inc((upstream.name, key.label, str(response.status_code)))
+    proxy_metrics.key_saturation.set((upstream.name, key.label), key.saturation(time.monotonic()))
+
+
+async def send_upstream(
+    openai_request: Dict[str, Any],
+    stream: bool,
+    plan: Optional[List[Upstream]] = None,
+    body: Optional[Union[bytes, SplicedBody]] = None
+) -> UpstreamCall:
+    """
+    按路由计划发送请求，调用方负责release上游；body为预编码的请求体，切换上游时复用。
+    每个上游从Key池中取余量最大的Key：非最后一个上游的Key都用尽时直接跳过，
+    最后一个上游最多排队KEY_POOL_MAX_WAIT秒，仍无可用Key时抛出RateLimited；
+    某个Key返回429时换一个Key重试同一个上游（不计入熔断器），每个Key最多一次。
+    连接失败、超时或429/5xx时计入熔断器并切换到下一个上游，最后一个上游的错误原样返回或抛出
+    """
+    client = upstream_pool.client
+    if plan is None:
+        plan = upstream_router.plan(openai_request["model"])
+    if body is None:
+        body = encode_request(openai_request)
+    estimate = estimate_tokens(openai_request, body)
+    # 大请求体压缩一次后发给所有候选上游（拼接了原始媒体数据的请求体不压缩，base64本身几乎压缩不了）
+    content_encoding = None
+    if UPSTREAM_REQUEST_ENCODING and isinstance(body, bytes) and len(body) >= UPSTREAM_REQUEST_COMPRESS_MIN_BYTES:
+        raw_size = len(body)
+        body = compression.compress(body, UPSTREAM_REQUEST_ENCODING, COMPRESSION_LEVELS[UPSTREAM_REQUEST_ENCODING])
+        content_encoding = UPSTREAM_REQUEST_ENCODING
+        compression_stats.record("upstream_request", content_encoding, raw_size, len(body))
+    # 连接超时按模型配置；读取超时只作为网络层的兜底，首字节/空闲/总时长由StreamWatchdog控制
+    timeout = httpx.Timeout(UPSTREAM_TIMEOUT, connect=timeouts_for(openai_request["model"]).connect)
+    for attempt, upstream in enumerate(plan):
+        last = attempt == len(plan) - 1
+        key_attempts = len(upstream.keys)
+        while True:
+            key_attempts -= 1
+            try:
+                key = await acquire_key(upstream, estimate, KEY_POOL_MAX_WAIT if last else 0.0)
+            except RateLimited:
+                if last:
+                    raise
+                request_logger.warning("[Key池] 上游 %s 的Key都已限流，切换到下一个上游", upstream.name)
+                break
+            started = upstream.acquire()
+            headers = upstream_headers(key.key)
+            if content_encoding:
+                headers["Content-Encoding"] = content_encoding
+            if isinstance(body, SplicedBody):
+                # 分片的请求体按已知长度发送，而不是chunked编码
+                headers["Content-Length"] = str(len(body))
+            request = client.build_request(
                 "POST",
-                f"{OPENAI_API_URL}/chat/completions",
-                json=openai_request,
-                headers={
-                    "Authorization": f"Bearer {OPENAI_API_KEY}",
-                    "Content-Type": "application/json; charset=utf-8"
-                }
-            ) as openai_stream:
-                # 发送消息开始事件
-                message_start = {
-                    "type": "message_start",
-                    "message": {
-                        "id": "msg_stream_xxx",
-                        "type": "message",
-                        "role": "assistant",
-                        "content": [],
-                        "model": original_model,
-                        "stop_reason": None,
-                        "stop_sequence": None,
-                        "usage": {
-                            "input_tokens": 0,
-                            "output_tokens": 0
-                        }
-                    }
-                }
-                yield f"data: {json.dumps(message_start)}\n\n"
-
-                thinking_index = 0
-                content_index = 1
-                thinking_started = False
-                content_started = False
-
-                async for line_bytes in openai_stream.aiter_lines():
-                    # 确保正确解码UTF-8
-                    try:
-                        if isinstance(line_bytes, bytes):
-                            line = line_bytes.decode('utf-8', errors='replace')
-                        else:
-                            line = line_bytes
-                    except Exception as e:
-                        print(f"Decode error: {e}")
-                        continue
-                        
-                    if not line or not line.startswith("data: "):
-                        continue
+                upstream.chat_completions_url,
+                content=body,
+                headers=headers,
+                timeout=timeout
+            )
+            try:
+                response = await client.send(request, stream=stream)
+            except httpx.TransportError:
+                update_key(upstream, key, None, estimate)
+                upstream.release(success=False)
+                if last:
+                    raise
+                request_logger.warning("[路由] 上游 %s 请求失败，切换到下一个上游", upstream.name)
+                break
+            except BaseException:
+                update_key(upstream, key, None, estimate)
+                upstream.release(success=None)
+                raise
+            update_key(upstream, key, response, estimate)
+            if response.status_code == 429 and key_attempts > 0 and (last or upstream.keys.ready(estimate)):
+                # 只是这个Key的额度用尽：换一个Key重试（最后一个上游可以排队等待其他Key恢复）
+                await response.aclose()
+                upstream.release(success=None)
+                request_logger.warning("[Key池] 上游 %s 的 %s 被限流，换一个Key重试", upstream.name, key.label)
+                continue
+            if response.status_code in RETRYABLE_STATUS and not last:
+                await response.aclose()
+                upstream.release(success=False)
+                request_logger.warning(
+                    "[路由] 上游 %s 返回 %d，切换到下一个上游", upstream.name, response.status_code
+                )
+                break
+            return UpstreamCall(upstream, started, response)
+    raise RuntimeError("No upstream configured")
 
-                    data_str = line[6:]  # 移除 "data: " 前缀
-
-                    if data_str == "[DONE]":
-                        # 发送消息结束事件
-                        message_delta = {
-                            "type": "message_delta",
-                            "delta": {"stop_reason": "end_turn"},
-                            "message": {
-                                "stop_reason": "end_turn",
-                                "stop_sequence": None
-                            }
-                        }
-                        yield f"data: {json.dumps(message_delta)}\n\n"
-
-                        # 发送完成事件
-                        yield "data: [DONE]\n\n"
+
+async def open_upstream_stream(
+    openai_request: Dict[str, Any],
+    plan: Optional[List[Upstream]] = None,
+    body: Optional[Union[bytes, SplicedBody]] = None
+) -> UpstreamCall:
+    """发送流式请求并读到第一个有内容的data行，返回时上游已经开始产生内容"""
+    call = await send_upstream(openai_request, stream=True, plan=plan, body=body)
+    try:
+        if call.response.status_code == 200:
+            call.lines = call.response.aiter_lines()
+            async for line in call.lines:
+                if line.startswith("data: "):
+                    call.head.append(line)
+                    if has_content(line):
+                        call.ttft = time.monotonic() - call.started
                         break
+    except BaseException as e:
+        await call.response.aclose()
+        call.upstream.release(success=False if isinstance(e, Exception) else None)
+        raise
+    return call
+
+
+async def hedged_upstream_call(
+    openai_request: Dict[str, Any],
+    original_model: str,
+    affinity: Optional[str] = None
+) -> UpstreamCall:
+    """
+    打开上游流。启用对冲的模型：主请求超过延迟未产生首个有内容的chunk时向另一个上游发送对冲请求
+    （复用同一份请求体）。affinity为粘性路由的键（见prefix_cache.affinity_key）
+    """
+    body = encode_request(openai_request)
+    model = openai_request["model"]
+    plan = upstream_router.plan(model, affinity=affinity)
+    if not hedger.enabled(original_model):
+        return await open_upstream_stream(openai_request, plan, body)
+    return await hedger.run(
+        original_model,
+        lambda: open_upstream_stream(openai_request, plan, body),
+        # 对冲请求发出时再选上游（避开主请求的上游）
+        lambda: open_upstream_stream(
+            openai_request, upstream_router.plan(model, exclude=plan[0], affinity=affinity), body
+        ),
+        UpstreamCall.discard,
+    )
+
+
+def has_content(line: str) -> bool:
+    """data行是否有内容：文本/思考/工具调用增量、结束原因、错误或[DONE]；无法解析的行交给转发循环处理"""
+    data = line[6:]
+    if data == "[DONE]":
+        return True
+    try:
+        chunk = sse_encoder.loads(data)
+        if not isinstance(chunk, dict) or chunk.get("error"):
+            return True
+        for choice in chunk.get("choices") or ():
+            delta = choice.get("delta") or {}
+            if (
+                delta.get("content") or delta.get("reasoning_content") or delta.get("tool_calls")
+                or choice.get("finish_reason")
+            ):
+                return True
+    except sse_encoder.DECODE_ERRORS + (AttributeError,):
+        return True
+    return False
+
+
+async def _prepend_lines(head: List[str], lines: AsyncIterator[str]) -> AsyncGenerator[str, None]:
+    for line in head:
+        yield line
+    async for line in lines:
+        yield line
+
+
+def stream_input_tokens(call: UpstreamCall, openai_request: Dict[str, Any]) -> int:
+    """
+    message_start中的输入token数：上游在首个chunk中就带有usage时（如vLLM的continuous_usage_stats）
+    使用真实值，否则按本地token计数估算；真实用量随结束时的message_delta发送
+    """
+    if call.first_line is not None:
+        try:
+            first_usage = sse_encoder.loads(call.first_line[6:]).get("usage")
+        except sse_encoder.DECODE_ERRORS + (AttributeError,):
+            first_usage = None
+        if first_usage and first_usage.get("prompt_tokens"):
+            return anthropic_usage(first_usage)["input_tokens"]
+    return token_counter.count_messages(openai_request["model"], openai_request["messages"])
+
+
+async def stream_openai_response(
+    openai_request: Dict[str, Any],
+    original_model: str,
+    timer: Optional[PhaseTimer] = None,
+    affinity: Optional[str] = None,
+    account: str = ANONYMOUS
+) -> AsyncGenerator[bytes, None]:
+    """
+    流式传输OpenAI响应并转换为Anthropic格式（SSE帧由sse_encoder按模板编码）。
+    timer记录上游连接、首字节、等待上游chunk的时间，其余的中继时间计为SSE输出。
+    首字节/空闲/总时长超时由StreamWatchdog取消等待中的读取，转换为错误事件；
+    客户端断开时生成器被取消或关闭，finally立即关闭上游连接，上游随之停止生成；
+    服务关闭的排空期限到期时同样被取消，转换为overloaded_error事件。
+    结束时按account（客户端API Key的哈希）把用量记入用量账本
+    """
+    call: Optional[UpstreamCall] = None
+    success: Optional[bool] = None
+    finished = False
+    cancelled: Optional[str] = None
+    output_chunks = 0
+    started = time.monotonic()
+    # 上游在流末尾返回的usage（含缓存命中token数）；上游不返回时按估算值
+    usage: Optional[Dict[str, Any]] = None
+    input_tokens = 0
+    labels = (original_model, openai_request["model"], "none")
+    timeouts = timeouts_for(openai_request["model"])
+    watchdog = StreamWatchdog(timeouts) if timeouts.watched else None
+    drain_task = stream_drain.add()
+    try:
+        if watchdog is not None:
+            watchdog.wait_started()
+        try:
+            call = await hedged_upstream_call(openai_request, original_model, affinity)
+        finally:
+            if watchdog is not None:
+                watchdog.wait_finished()
+                watchdog.first_byte()
+        openai_stream = call.response
+        labels = (original_model, openai_request["model"], call.upstream.name)
+        proxy_metrics.upstream_requests.inc(labels + (str(openai_stream.status_code),))
+        proxy_metrics.connect.observe(labels, call.connect_time)
+        proxy_metrics.inflight_streams.inc(labels)
+        if timer is not None:
+            timer.add("upstream_connect", call.connect_time)
+            if call.ttft is not None:
+                timer.add("upstream_first_byte", call.ttft - call.connect_time)
+        relay_started = time.perf_counter()
+        try:
+            if openai_stream.status_code != 200:
+                body = await openai_stream.aread()
+                success = openai_stream.status_code not in RETRYABLE_STATUS
+                proxy_metrics.errors.inc(labels + (ERROR_UPSTREAM_STATUS,))
+                yield sse_encoder.error_event(
+                    "rate_limit_error" if openai_stream.status_code == 429 else "api_error",
+                    body.decode("utf-8", errors="replace")
+                )
+                return
+
+            # 发送消息开始事件
+            input_tokens = stream_input_tokens(call, openai_request)
+            yield sse_encoder.message_start("msg_stream_xxx", original_model, input_tokens)
+
+            if call.ttft is not None:
+                proxy_metrics.ttft.observe(labels, call.ttft)
+            # 输出速率按上游chunk数近似token数
+            last_chunk_at: Optional[float] = None
+
+            thinking_index = 0
+            content_index = 1
+            thinking_started = False
+            content_started = False
+
+            # 可选的增量合并：开启时间窗口后，上游停顿超过窗口也会及时输出缓冲内容
+            coalescer = DeltaCoalescer(STREAM_COALESCE_BYTES, STREAM_COALESCE_WINDOW_MS / 1000.0)
+            upstream_lines = call.lines
+            if timer is not None:
+                upstream_lines = timed_iter(upstream_lines, timer, "upstream_wait")
+            if watchdog is not None:
+                upstream_lines = watchdog.watch(upstream_lines)
+            upstream_lines = _prepend_lines(call.head, upstream_lines)
+            if coalescer.enabled and coalescer.window > 0:
+                lines = iter_with_deadline(upstream_lines, coalescer.timeout)
+            else:
+                lines = upstream_lines
+
+            async for line_bytes in lines:
+                if line_bytes is None:
+                    # 时间窗口到期
+                    pending = coalescer.flush()
+                    if pending:
+                        yield pending
+                    continue
+
+                # 确保正确解码UTF-8
+                try:
+                    if isinstance(line_bytes, bytes):
+                        line = line_bytes.decode('utf-8', errors='replace')
+                    else:
+                        line = line_bytes
+                except Exception as e:
+                    request_logger.warning("Decode error: %s", e)
+                    continue
+                    
+                if not line or not line.startswith("data: "):
+                    continue
+
+                data_str = line[6:]  # 移除 "data: " 前缀
+
+                if data_str == "[DONE]":
+                    finished = True
+                    # 发送消息结束事件
+                    yield coalescer.flush() + sse_encoder.message_delta(
+                        "end_turn", include_stop_sequence=True,
+                        usage=anthropic_usage(usage) if usage is not None
+                        else {"input_tokens": input_tokens, "output_tokens": output_chunks}
+                    )
+
+                    # 发送完成事件
+                    yield sse_encoder.DONE
+                    break
 
-                    try:
-                        chunk = json.loads(data_str)
-
-                        if "choices" in chunk:
-                            for choice in chunk["choices"]:
-                                delta = choice.get("delta", {})
-
-                                # 处理思考内容（thinking）- 必须在content之前
-                                if "reasoning_content" in delta and delta["reasoning_content"]:
-                                    if not thinking_started:
-                                        # 发送思考块开始
-                                        thinking_start = {
-                                            "type": "content_block_start",
-                                            "index": thinking_index,
-                                            "content_block": {
-                                                "type": "thinking",
-                                                "thinking": ""
-                                            }
-                                        }
-                                        yield f"data: {json.dumps(thinking_start)}\n\n"
-                                        thinking_started = True
-                                    
-                                    # 发送思考内容增量
-                                    thinking_delta = {
-                                        "type": "content_block_delta",
-                                        "index": thinking_index,
-                                        "delta": {
-                                            "type": "thinking_delta",
-                                            "thinking": delta["reasoning_content"]
-                                        }
-                                    }
-                                    yield f"data: {json.dumps(thinking_delta)}\n\n"
-
-                                # 处理content
-                                if "content" in delta and delta["content"]:
-                                    # 如果thinking已完成但未关闭，先关闭thinking块
-                                    if thinking_started and not content_started:
-                                        thinking_end = {
-                                            "type": "content_block_stop",
-                                            "index": thinking_index
-                                        }
-                                        yield f"data: {json.dumps(thinking_end)}\n\n"
-                                    
-                                    if not content_started:
-                                        # 发送内容块开始
-                                        content_start = {
-                                            "type": "content_block_start",
-                                            "index": content_index,
-                                            "content_block": {
-                                                "type": "text",
-                                                "text": ""
-                                            }
-                                        }
-                                        yield f"data: {json.dumps(content_start)}\n\n"
-                                        content_started = True
-                                    
-                                    # 发送内容增量
-                                    content_delta = {
-                                        "type": "content_block_delta",
-                                        "index": content_index,
-                                        "delta": {
-                                            "type": "text_delta",
-                                            "text": delta["content"]
-                                        }
-                                    }
-                                    yield f"data: {json.dumps(content_delta)}\n\n"
-
-                                # 处理完成原因
-                                if choice.get("finish_reason"):
-                                    # 发送思考块结束（如果还未关闭）
-                                    if thinking_started and not content_started:
-                                        thinking_end = {
-                                            "type": "content_block_stop",
-                                            "index": thinking_index
-                                        }
-                                        yield f"data: {json.dumps(thinking_end)}\n\n"
-                                    
-                                    # 发送内容块结束
-                                    if content_started:
-                                        content_end = {
-                                            "type": "content_block_stop",
-                                            "index": content_index
-                                        }
-                                        yield f"data: {json.dumps(content_end)}\n\n"
-
-                                    # 发送消息增量
-                                    message_delta = {
-                                        "type": "message_delta",
-                                        "delta": {
-                                            "stop_reason": choice["finish_reason"]
-                                        },
-                                        "message": {
-                                            "stop_reason": choice["finish_reason"]
-                                        }
-                                    }
-                                    yield f"data: {json.dumps(message_delta)}\n\n"
-
-                    except json.JSONDecodeError:
+                try:
+                    chunk = sse_encoder.loads(data_str)
+                except sse_encoder.DECODE_ERRORS:
+                    proxy_metrics.errors.inc(labels + (ERROR_DECODE,))
+                    continue
+
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                    if not chunk.get("choices"):
+                        # include_usage的末尾chunk只有usage，不计入输出速率
                         continue
 
+                now = time.monotonic()
+                if last_chunk_at is not None:
+                    proxy_metrics.inter_token.observe(labels, now - last_chunk_at)
+                last_chunk_at = now
+                output_chunks += 1
+
+                if "choices" in chunk:
+                    for choice in chunk["choices"]:
+                        delta = choice.get("delta", {})
+
+                        # 处理思考内容（thinking）- 必须在content之前
+                        reasoning_content = delta.get("reasoning_content")
+                        if reasoning_content:
+                            if not thinking_started:
+                                # 发送思考块开始
+                                yield coalescer.flush() + sse_encoder.content_block_start(thinking_index, "thinking")
+                                thinking_started = True
+
+                            # 发送思考内容增量（可能被合并）
+                            frame = coalescer.add("thinking", thinking_index, reasoning_content)
+                            if frame:
+                                yield frame
+
+                        # 处理content
+                        content = delta.get("content")
+                        if content:
+                            # 如果thinking已完成但未关闭，先关闭thinking块
+                            if thinking_started and not content_started:
+                                yield coalescer.flush() + sse_encoder.content_block_stop(thinking_index)
+
+                            if not content_started:
+                                # 发送内容块开始
+                                yield coalescer.flush() + sse_encoder.content_block_start(content_index, "text")
+                                content_started = True
+
+                            # 发送内容增量（可能被合并）
+                            frame = coalescer.add("text", content_index, content)
+                            if frame:
+                                yield frame
+
+                        # 处理完成原因
+                        finish_reason = choice.get("finish_reason")
+                        if finish_reason:
+                            # 发送思考块结束（如果还未关闭）
+                            if thinking_started and not content_started:
+                                yield coalescer.flush() + sse_encoder.content_block_stop(thinking_index)
+
+                            # 发送内容块结束
+                            if content_started:
+                                yield coalescer.flush() + sse_encoder.content_block_stop(content_index)
+
+                            # 发送消息增量
+                            yield coalescer.flush() + sse_encoder.message_delta(finish_reason)
+
+            success = True
+            if output_chunks > 1 and call.ttft is not None:
+                generation_time = last_chunk_at - call.started - call.ttft
+                if generation_time > 0:
+                    proxy_metrics.output_rate.observe(labels, (output_chunks - 1) / generation_time)
+        finally:
+            await openai_stream.aclose()
+            proxy_metrics.inflight_streams.dec(labels)
+            proxy_metrics.duration.observe(labels, time.monotonic() - call.started)
+            if timer is not None:
+                relay = time.perf_counter() - relay_started
+                timer.add("sse_emit", relay - timer.phases.get("upstream_wait", 0.0))
+
+    except asyncio.CancelledError:
+        if watchdog is not None and watchdog.expired is not None:
+            # 超时：取消由watchdog发起，转换为错误事件后正常结束
+            cancelled = watchdog.expired
+            success = False
+            proxy_metrics.errors.inc(labels + (ERROR_TIMEOUT,))
+            yield sse_encoder.error_event("api_error", timeout_message(cancelled, timeouts))
+        elif stream_drain.expired and not finished:
+            # 服务关闭的排空期限到期：告知客户端重试，不计入熔断器
+            cancelled = CANCEL_SHUTDOWN
+            yield sse_encoder.error_event("overloaded_error", "Server is shutting down, please retry")
+        else:
+            # 客户端断开
+            if not finished:
+                cancelled = CANCEL_CLIENT_DISCONNECT
+            raise
+    except GeneratorExit:
+        if not finished:
+            cancelled = CANCEL_CLIENT_DISCONNECT
+        raise
     except Exception as e:
-        error_response = {
-            "type": "error",
-            "error": {
-                "type": "internal_server_error",
-                "message": str(e)
-            }
-        }
-        yield f"data: {json.dumps(error_response)}\n\n"
+        success = False
+        if isinstance(e, httpx.TimeoutException):
+            proxy_metrics.errors.inc(labels + (ERROR_TIMEOUT,))
+            reason = TIMEOUT_CONNECT if isinstance(e, httpx.ConnectTimeout) else TIMEOUT_IDLE
+            yield sse_encoder.error_event("api_error", timeout_message(reason, timeouts))
+        elif isinstance(e, RateLimited):
+            proxy_metrics.errors.inc(labels + (ERROR_UPSTREAM_STATUS,))
+            yield sse_encoder.error_event("rate_limit_error", str(e))
+        else:
+            proxy_metrics.errors.inc(labels + (ERROR_INTERNAL,))
+            yield sse_encoder.error_event("internal_server_error", str(e))
+    finally:
+        stream_drain.discard(drain_task)
+        if watchdog is not None:
+            watchdog.close()
+        if cancelled is not None:
+            proxy_metrics.cancelled.inc(labels + (cancelled,))
+            max_tokens = openai_request.get("max_tokens")
+            if isinstance(max_tokens, int) and max_tokens > output_chunks:
+                proxy_metrics.cancelled_tokens.inc(labels, max_tokens - output_chunks)
+        # 客户端断开（GeneratorExit/取消）时success为None，不计入熔断器
+        if call is not None:
+            call.upstream.release(success, call.ttft)
+        final_usage = (
+            anthropic_usage(usage) if usage is not None
+            else {"input_tokens": input_tokens, "output_tokens": output_chunks, "cache_read_input_tokens": 0}
+        )
+        usage_ledger.record(
+            account, original_model, openai_request["model"],
+            final_usage["input_tokens"], final_usage["output_tokens"], final_usage["cache_read_input_tokens"],
+            latency=time.monotonic() - started, ttft=call.ttft if call is not None else None, error=success is False
+        )
+
+
+async def fetch_openai_response(
+    openai_request: Dict[str, Any],
+    original_model: str,
+    timer: Optional[PhaseTimer] = None,
+    plan: Optional[List[Upstream]] = None,
+    affinity: Optional[str] = None,
+    account: str = ANONYMOUS
+) -> Dict[str, Any]:
+    """非流式请求上游并转换为Anthropic格式，按account把用量（失败时记为错误）记入用量账本"""
+    started = time.monotonic()
+    try:
+        anthropic_response = await _fetch_openai_response(openai_request, original_model, timer, plan, affinity)
+    except Exception:
+        usage_ledger.record(
+            account, original_model, openai_request["model"], latency=time.monotonic() - started, error=True
+        )
+        raise
+    usage = anthropic_response["usage"]
+    usage_ledger.record(
+        account, original_model, openai_request["model"],
+        usage["input_tokens"], usage["output_tokens"], usage["cache_read_input_tokens"],
+        latency=time.monotonic() - started
+    )
+    return anthropic_response
+
+
+async def _fetch_openai_response(
+    openai_request: Dict[str, Any],
+    original_model: str,
+    timer: Optional[PhaseTimer],
+    plan: Optional[List[Upstream]],
+    affinity: Optional[str]
+) -> Dict[str, Any]:
+    """
+    timer记录上游请求和响应转换的时间。
+    配置了总时长超时时，超时后取消上游请求并抛出UpstreamTimeout。
+    指定plan时（批处理已选定上游）按该计划发送。
+    非流式请求不做对冲：响应要等整个生成结束才返回，按首token时间的延迟对冲会让长回复几乎都生成两遍
+    """
+    timeouts = timeouts_for(openai_request["model"])
+    if plan is None:
+        plan = upstream_router.plan(openai_request["model"], affinity=affinity)
+    upstream_call = send_upstream(openai_request, stream=False, plan=plan)
+    try:
+        if timeouts.total > 0:
+            call = await asyncio.wait_for(upstream_call, timeouts.total)
+        else:
+            call = await upstream_call
+    except asyncio.TimeoutError:
+        labels = (original_model, openai_request["model"], "none")
+        proxy_metrics.errors.inc(labels + (ERROR_TIMEOUT,))
+        proxy_metrics.cancelled.inc(labels + (TIMEOUT_TOTAL,))
+        raise UpstreamTimeout(TIMEOUT_TOTAL, timeout_message(TIMEOUT_TOTAL, timeouts))
+    except Exception as e:
+        if isinstance(e, httpx.TimeoutException):
+            error_class = ERROR_TIMEOUT
+        elif isinstance(e, RateLimited):
+            error_class = ERROR_UPSTREAM_STATUS
+        else:
+            error_class = ERROR_INTERNAL
+        proxy_metrics.errors.inc((original_model, openai_request["model"], "none", error_class))
+        if isinstance(e, httpx.ConnectTimeout):
+            raise UpstreamTimeout(TIMEOUT_CONNECT, timeout_message(TIMEOUT_CONNECT, timeouts))
+        raise
+    openai_response = call.response
+    call.upstream.release(openai_response.status_code not in RETRYABLE_STATUS)
+    if timer is not None:
+        timer.mark("upstream")
+
+    labels = (original_model, openai_request["model"], call.upstream.name)
+    duration = time.monotonic() - call.started
+    proxy_metrics.upstream_requests.inc(labels + (str(openai_response.status_code),))
+    proxy_metrics.duration.observe(labels, duration)
+
+    if openai_response.status_code != 200:
+        proxy_metrics.errors.inc(labels + (ERROR_UPSTREAM_STATUS,))
+        if openai_response.status_code == 429:
+            pause = key_retry_after(openai_response.headers)
+            raise RateLimited(openai_response.text, KEY_POOL_COOLDOWN if pause is None else pause)
+        raise HTTPException(
+            status_code=openai_response.status_code,
+            detail=openai_response.text
+        )
+
+    # 确保正确解码响应
+    try:
+        # 显式设置UTF-8编码
+        openai_response.encoding = 'utf-8'
+        openai_data = openai_response.json()
+    except Exception as e:
+        # 如果JSON解析失败，尝试手动处理
+        try:
+            text = openai_response.content.decode('utf-8', errors='replace')
+            openai_data = json.loads(text)
+        except Exception as e2:
+            proxy_metrics.errors.inc(labels + (ERROR_DECODE,))
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to decode OpenAI response: {str(e2)}"
+            )
+
+    completion_tokens = (openai_data.get("usage") or {}).get("completion_tokens") or 0
+    if completion_tokens and duration > 0:
+        proxy_metrics.output_rate.observe(labels, completion_tokens / duration)
+
+    anthropic_response = OpenAIToAnthropicConverter.convert_response(openai_data, original_model)
+    if timer is not None:
+        timer.mark("convert_response")
+    return anthropic_response
+
+
+def check_content_length(request: Request) -> None:
+    """请求体和解析结果各占一份内存：声明的长度已超过上限时直接拒绝"""
+    content_length = request.headers.get("content-length", "")
+    if MAX_REQUEST_MEMORY_BYTES > 0 and content_length.isdigit():
+        if 2 * int(content_length) > MAX_REQUEST_MEMORY_BYTES:
+            raise RequestTooLarge(
+                f"request body of {int(content_length) // (1024 * 1024)} MB needs about twice that in memory, "
+                f"exceeding the {MAX_REQUEST_MEMORY_MB:g} MB per-request limit"
+            )
+
+
+def fit_context(openai_request: Dict[str, Any], original_model: str) -> None:
+    """按上下文窗口检查转换后的请求：裁剪历史、收紧max_tokens，放不下时抛出ContextOverflow"""
+    if not context_window.enabled:
+        return
+    labels = (original_model, openai_request["model"])
+    requested_max_tokens = openai_request.get("max_tokens")
+    try:
+        result = context_window.fit(openai_request)
+    except ContextOverflow:
+        proxy_metrics.context_window.inc(labels + ("rejected",))
+        raise
+    if result.get("dropped"):
+        proxy_metrics.context_window.inc(labels + ("trimmed",))
+        request_logger.info(
+            "[上下文] %s 超出上下文长度，丢弃最早的 %d 条消息（剩余约 %d tokens）",
+            openai_request["model"], result["dropped"], result["input_tokens"]
+        )
+    if openai_request.get("max_tokens") != requested_max_tokens:
+        proxy_metrics.context_window.inc(labels + ("clamped",))
+
+
+async def read_request_body(request: Request) -> bytes:
+    """读取请求体，按Content-Encoding解码；解码后的大小与解析结果合计不能超过单请求内存上限"""
+    body = await request.body()
+    encoding = request.headers.get("content-encoding", "")
+    if not encoding:
+        return body
+    decoded = compression.decode_body(body, encoding, MAX_REQUEST_MEMORY_BYTES // 2)
+    compression_stats.record("request", encoding.strip().lower(), len(decoded), len(body))
+    return decoded
+
+
+def compress_response(request: Request, response: JSONResponse) -> JSONResponse:
+    """按Accept-Encoding压缩非流式响应体（太小的响应体不压缩）"""
+    response.headers["Vary"] = "Accept-Encoding"
+    if len(response.body) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+    encoding = compression.negotiate(request.headers.get("accept-encoding", ""), RESPONSE_COMPRESSION)
+    if encoding is None:
+        return response
+    body = compression.compress(response.body, encoding, COMPRESSION_LEVELS[encoding])
+    compression_stats.record("response", encoding, len(response.body), len(body))
+    response.body = body
+    response.headers["Content-Encoding"] = encoding
+    response.headers["Content-Length"] = str(len(body))
+    return response
+
+
+def compressed_stream(
+    request: Request, stream: AsyncGenerator[bytes, None], headers: Dict[str, str]
+) -> AsyncGenerator[bytes, None]:
+    """STREAM_COMPRESSION开启时按Accept-Encoding压缩SSE流（每帧flush），并设置对应的响应头"""
+    if not STREAM_COMPRESSION:
+        return stream
+    headers["Vary"] = "Accept-Encoding"
+    encoding = compression.negotiate(request.headers.get("accept-encoding", ""), RESPONSE_COMPRESSION)
+    if encoding is None:
+        return stream
+    headers["Content-Encoding"] = encoding
+    return compression.compress_stream(stream, encoding, COMPRESSION_LEVELS[encoding], compression_stats)
+
+
+def timing_headers(
+    timer: Optional[PhaseTimer],
+    headers: Dict[str, str],
+    original_model: str,
+    openai_request: Dict[str, Any]
+) -> Dict[str, str]:
+    """非流式响应：加上Server-Timing响应头，并把慢请求记入环形缓冲区"""
+    if timer is not None:
+        headers["Server-Timing"] = timer.server_timing()
+        slow_requests.record(timer, model=original_model, mapped_model=openai_request["model"], stream=False)
+    return headers
+
+
+def timed_stream(
+    stream: AsyncGenerator[bytes, None],
+    timer: Optional[PhaseTimer],
+    original_model: str,
+    openai_request: Dict[str, Any]
+) -> AsyncGenerator[bytes, None]:
+    """流式响应：末尾追加Server-Timing注释帧，结束时把慢请求记入环形缓冲区"""
+    if timer is None:
+        return stream
+    return with_timing_trailer(
+        stream, timer, slow_requests, model=original_model, mapped_model=openai_request["model"], stream=True
+    )
 
 
 @app.post("/v1/messages")
 async def anthropic_messages_endpoint(request: Request):
     """处理Anthropic /v1/messages 端点的请求"""
+    timer = PhaseTimer() if SERVER_TIMING_ENABLED else None
     try:
-        # 解析请求体
-        anthropic_request = await request.json()
+        # 解析并校验请求体（声明的长度已超过内存上限时不读取请求体）
+        check_content_length(request)
+        body = await read_request_body(request)
+        if timer is not None:
+            timer.mark("read")
+        anthropic_request = decode_request(body)
+        if timer is not None:
+            timer.mark("parse")
         
-        # 打印接收到的请求信息
-        print("\n" + "="*80)
-        print("[接收到的Anthropic API请求]")
-        print(f"请求URL: {request.url}")
-        print(f"请求方法: {request.method}")
-        print("请求内容:")
-        print(json.dumps(anthropic_request, ensure_ascii=False, indent=2))
-        print("="*80 + "\n")
+        # 记录接收到的请求（按采样率，写日志在后台线程完成）
+        log_sampled = request_logger.sampled()
+        request_logger.log_request(
+            "接收到的Anthropic API请求", str(request.url), request.method, anthropic_request, log_sampled
+        )
 
         # 检查API key
-        if not OPENAI_API_KEY:
+        if not UPSTREAMS and not OPENAI_API_KEY:
             raise HTTPException(
                 status_code=500,
                 detail="OpenAI API key not configured"
@@ -431,97 +1401,519 @@ async def anthropic_messages_endpoint(request: Request):
         original_model = anthropic_request.get("model", "unknown")
         
         # 转换为OpenAI格式
-        openai_request = AnthropicToOpenAIConverter.convert_request(anthropic_request)
+        openai_request = AnthropicToOpenAIConverter.convert_request(anthropic_request, body)
+        fit_context(openai_request, original_model)
+        affinity = affinity_key(anthropic_request, openai_request)
+        account = account_id(request.headers)
+        if timer is not None:
+            timer.mark("convert")
+        proxy_metrics.requests.inc((
+            original_model, openai_request["model"], "true" if openai_request["stream"] else "false"
+        ))
         
-        # 打印转换后的OpenAI请求信息
-        openai_url = f"{OPENAI_API_URL}/chat/completions"
-        print("\n" + "="*80)
-        print("[转换后的OpenAI API请求]")
-        print(f"请求URL: {openai_url}")
-        print(f"请求方法: POST")
-        print("请求内容:")
-        print(json.dumps(openai_request, ensure_ascii=False, indent=2))
-        print("="*80 + "\n")
+        # 记录转换后的OpenAI请求
+        request_logger.log_request(
+            "转换后的OpenAI API请求", f"{OPENAI_API_URL}/chat/completions", "POST", openai_request, log_sampled
+        )
+
+        # 响应缓存：只缓存确定性请求，可通过Cache-Control/X-Proxy-Cache请求头绕过
+        is_stream = anthropic_request.get("stream", False)
+        deterministic = is_deterministic(openai_request)
+        key = None
+        cache_status = None
+        cache_store_key = None
+        if response_cache is not None and deterministic:
+            allow_read, allow_store = cache_directives(request.headers)
+            key = cache_key(openai_request, original_model)
+            cached = await response_cache.get(key) if allow_read else None
+            if timer is not None:
+                timer.mark("cache")
+            if cached is not None:
+                kind, data = cached
+                if kind == KIND_STREAM and is_stream:
+                    headers = dict(SSE_HEADERS, **{"X-Proxy-Cache": "HIT"})
+                    stream = timed_stream(ResponseCache.replay_stream(data), timer, original_model, openai_request)
+                    return StreamingResponse(
+                        compressed_stream(request, stream, headers),
+                        media_type="text/event-stream",
+                        headers=headers
+                    )
+                if kind == KIND_RESPONSE and not is_stream:
+                    return compress_response(request, JSONResponse(
+                        data,
+                        media_type="application/json; charset=utf-8",
+                        headers=timing_headers(timer, {"X-Proxy-Cache": "HIT"}, original_model, openai_request)
+                    ))
+            if not allow_read:
+                response_cache.bypasses += 1
+                cache_status = "BYPASS"
+            else:
+                cache_status = "MISS"
+            if allow_store:
+                cache_store_key = key
+
+        # 单飞合并：并发的相同请求只向上游发送一次
+        flight_key = None
+        if single_flight_enabled(original_model, deterministic):
+            flight_key = key or cache_key(openai_request, original_model)
+
+        # 准入控制：缓存命中和单飞跟随者不会访问上游，不占用并发名额
+        ticket: Optional[Ticket] = None
+        if admission.enabled and not (flight_key and single_flight.joinable(flight_key)):
+            try:
+                ticket = await admission.acquire(
+                    openai_request["model"],
+                    admission.priority_of(request.headers.get(ADMISSION_PRIORITY_HEADER))
+                )
+            except AdmissionRejected as rejected:
+                return overloaded_response(rejected)
+            if timer is not None:
+                timer.mark("queue")
 
         # 检查是否为流式请求
-        if anthropic_request.get("stream", False):
+        if is_stream:
             # 流式响应
-            return StreamingResponse(
-                stream_openai_response(openai_request, original_model),
+            def open_stream() -> AsyncGenerator[bytes, None]:
+                stream = stream_openai_response(openai_request, original_model, timer, affinity, account)
+                if cache_store_key:
+                    stream = response_cache.record_stream(cache_store_key, stream, sse_encoder.DONE)
+                if ticket is not None:
+                    stream = release_after(ticket, stream)
+                return stream
+
+            headers = dict(SSE_HEADERS)
+            if cache_status:
+                headers["X-Proxy-Cache"] = cache_status
+            if flight_key:
+                stream = single_flight.stream(flight_key, open_stream)
+            else:
+                stream = open_stream()
+            # 客户端断开时立即关闭响应体生成器（进而关闭上游连接）；
+            # 响应体生成器未启动就断开时由后台任务归还名额（release可重复调用）
+            stream = compressed_stream(request, timed_stream(stream, timer, original_model, openai_request), headers)
+            return DisconnectAwareStreamingResponse(
+                stream,
                 media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
+                headers=headers,
+                background=BackgroundTask(ticket.release) if ticket is not None else None
             )
         else:
             # 非流式响应
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                openai_response = await client.post(
-                    f"{OPENAI_API_URL}/chat/completions",
-                    json=openai_request,
-                    headers={
-                        "Authorization": f"Bearer {OPENAI_API_KEY}",
-                        "Content-Type": "application/json; charset=utf-8"
-                    }
-                )
-
-                if openai_response.status_code != 200:
-                    raise HTTPException(
-                        status_code=openai_response.status_code,
-                        detail=openai_response.text
+            async def fetch() -> Dict[str, Any]:
+                try:
+                    data = await fetch_openai_response(
+                        openai_request, original_model, timer, affinity=affinity, account=account
                     )
+                finally:
+                    if ticket is not None:
+                        ticket.release()
+                if cache_store_key:
+                    response_cache.set_response(cache_store_key, data)
+                return data
 
-                # 确保正确解码响应
-                try:
-                    # 显式设置UTF-8编码
-                    openai_response.encoding = 'utf-8'
-                    openai_data = openai_response.json()
-                except Exception as e:
-                    # 如果JSON解析失败，尝试手动处理
-                    try:
-                        text = openai_response.content.decode('utf-8', errors='replace')
-                        openai_data = json.loads(text)
-                    except Exception as e2:
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"Failed to decode OpenAI response: {str(e2)}"
-                        )
-                
-                anthropic_data = OpenAIToAnthropicConverter.convert_response(openai_data, original_model)
-
-                return JSONResponse(anthropic_data, media_type="application/json; charset=utf-8")
-
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON in request body")
+            try:
+                if flight_key:
+                    anthropic_data = await single_flight.call(flight_key, fetch)
+                else:
+                    anthropic_data = await fetch()
+            finally:
+                if ticket is not None:
+                    ticket.release()
+            if timer is not None:
+                # 单飞跟随者等待领导者的时间也计入upstream
+                timer.mark("upstream")
+
+            return compress_response(request, JSONResponse(
+                anthropic_data,
+                media_type="application/json; charset=utf-8",
+                headers=timing_headers(
+                    timer, {"X-Proxy-Cache": cache_status} if cache_status else {}, original_model, openai_request
+                )
+            ))
+
+    except compression.UnsupportedEncoding as e:
+        return anthropic_error_response(415, "invalid_request_error", str(e))
+    except InvalidRequest as e:
+        return anthropic_error_response(400, "invalid_request_error", str(e))
+    except RequestTooLarge as e:
+        return anthropic_error_response(413, "request_too_large", str(e))
+    except UpstreamTimeout as e:
+        return anthropic_error_response(504, "api_error", str(e))
+    except RateLimited as e:
+        return anthropic_error_response(
+            429, "rate_limit_error", str(e), headers={"retry-after": str(max(1, math.ceil(e.retry_after)))}
+        )
     except httpx.TimeoutException:
-        raise HTTPException(status_code=408, detail="Request timeout")
+        return anthropic_error_response(504, "api_error", "Upstream request timed out")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/v1/messages/count_tokens")
+async def count_tokens_endpoint(request: Request):
+    """本地计算请求的输入token数：与/v1/messages使用相同的消息转换，不访问上游"""
+    try:
+        check_content_length(request)
+        body = await read_request_body(request)
+        anthropic_request = decode_request(body)
+        openai_request = AnthropicToOpenAIConverter.convert_request(anthropic_request, body)
+    except compression.UnsupportedEncoding as e:
+        return anthropic_error_response(415, "invalid_request_error", str(e))
+    except InvalidRequest as e:
+        return anthropic_error_response(400, "invalid_request_error", str(e))
+    except RequestTooLarge as e:
+        return anthropic_error_response(413, "request_too_large", str(e))
+    messages = openai_request["messages"]
+
+    # system已合并在转换后的消息中；tools也占用输入token
+    extra_messages = []
+    tools = anthropic_request.get("tools")
+    if tools:
+        extra_messages.append({
+            "role": "system",
+            "content": json.dumps(tools, ensure_ascii=False, sort_keys=True)
+        })
+
+    return {"input_tokens": token_counter.count_messages(openai_request["model"], extra_messages + messages)}
+
+
+# 上游错误状态码对应的Anthropic错误类型
+UPSTREAM_ERROR_TYPES = {
+    400: "invalid_request_error",
+    401: "authentication_error",
+    403: "permission_error",
+    404: "not_found_error",
+    413: "request_too_large",
+    429: "rate_limit_error",
+    529: "overloaded_error",
+}
+
+
+# 批处理请求在用量账本中的账户名
+BATCH_ACCOUNT = "batch"
+
+
+def prepare_batch_request(params: Dict[str, Any]) -> Tuple[Any, str]:
+    """校验并转换批次中的一个请求，返回((OpenAI请求, 原始模型), 映射后模型)"""
+    try:
+        anthropic_request = validate_request(params)
+    except InvalidRequest as e:
+        raise BatchRequestError("invalid_request_error", str(e))
+    if anthropic_request.get("stream"):
+        raise BatchRequestError("invalid_request_error", "stream: streaming is not supported in message batches")
+    try:
+        openai_request = AnthropicToOpenAIConverter.convert_request(anthropic_request)
+        fit_context(openai_request, anthropic_request["model"])
+    except ContextOverflow as e:
+        raise BatchRequestError("invalid_request_error", str(e))
+    except RequestTooLarge as e:
+        raise BatchRequestError("request_too_large", str(e))
+    return (openai_request, anthropic_request["model"]), openai_request["model"]
+
+
+async def execute_batch_request(prepared: Any, upstream: Upstream) -> Dict[str, Any]:
+    """
+    在选定的上游上执行批次中的一个请求；启用准入控制时以最低优先级排队，让在线请求优先。
+    上游过载、超时和连接失败标记为可重试
+    """
+    openai_request, original_model = prepared
+    ticket: Optional[Ticket] = None
+    try:
+        if admission.enabled:
+            ticket = await admission.acquire(openai_request["model"], admission.priorities[-1])
+        proxy_metrics.requests.inc((original_model, openai_request["model"], "false"))
+        return await fetch_openai_response(openai_request, original_model, plan=[upstream], account=BATCH_ACCOUNT)
+    except AdmissionRejected as e:
+        raise BatchRequestError("overloaded_error", f"Proxy overloaded: {e.reason}", retryable=True)
+    except RateLimited as e:
+        raise BatchRequestError("rate_limit_error", str(e), retryable=True)
+    except HTTPException as e:
+        raise BatchRequestError(
+            UPSTREAM_ERROR_TYPES.get(e.status_code, "api_error"),
+            str(e.detail),
+            retryable=e.status_code in RETRYABLE_STATUS
+        )
+    except (UpstreamTimeout, httpx.TransportError) as e:
+        raise BatchRequestError("api_error", str(e) or "Upstream request failed", retryable=True)
+    except Exception as e:
+        raise BatchRequestError("api_error", str(e))
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+batch_runner = BatchRunner(
+    batch_store,
+    prepare_batch_request,
+    execute_batch_request,
+    upstream_router.plan,
+    UpstreamSlots(BATCH_UPSTREAM_CONCURRENCY),
+    workers=BATCH_WORKERS,
+    max_retries=BATCH_MAX_RETRIES,
+    retry_backoff=BATCH_RETRY_BACKOFF,
+    poll_interval=BATCH_POLL_INTERVAL,
+)
+
+
+async def iter_batch_items(request: Request) -> AsyncGenerator[Any, None]:
+    """
+    读取批次请求：application/json为 {"requests": [...]}，其他类型按JSONL逐行解析
+    （边接收边解析，请求体不需要整体读入内存）
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    encoding = request.headers.get("content-encoding", "")
+    if content_type == "application/json":
+        check_content_length(request)
+        raw = compression.decode_body(await request.body(), encoding, MAX_REQUEST_MEMORY_BYTES // 2)
+        try:
+            body = sse_encoder.loads(raw)
+        except sse_encoder.DECODE_ERRORS as e:
+            raise InvalidBatch(f"Invalid JSON body: {e}")
+        if not isinstance(body, dict) or not isinstance(body.get("requests"), list):
+            raise InvalidBatch("requests: field required (array of {custom_id, params})")
+        for item in body["requests"]:
+            yield item
+        return
+    pending = b""
+    # JSONL逐行处理：总大小受批次条数上限约束，单行（解码后）不能超过单请求内存上限，
+    # 解码也按这个上限分片产出，压缩炸弹不会在检查行长度之前一次解出
+    line_limit = MAX_REQUEST_MEMORY_BYTES // 2
+    async for chunk in compression.decode_stream(request.stream(), encoding, max_piece=line_limit):
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        if line_limit > 0 and len(pending) > line_limit:
+            raise RequestTooLarge(f"a JSONL line exceeds the {MAX_REQUEST_MEMORY_MB:g} MB per-request limit")
+        for line in lines:
+            if line.strip():
+                yield decode_batch_line(line)
+    if pending.strip():
+        yield decode_batch_line(pending)
+
+
+def decode_batch_line(line: bytes) -> Any:
+    try:
+        return sse_encoder.loads(line)
+    except sse_encoder.DECODE_ERRORS as e:
+        raise InvalidBatch(f"Invalid JSONL line: {e}")
+
+
+def get_batch(batch_id: str) -> Any:
+    try:
+        return batch_runner.get(batch_id)
+    except BatchNotFound:
+        raise HTTPException(status_code=404, detail=f"Batch not found: {batch_id}")
+
+
+@app.post("/v1/messages/batches")
+async def create_batch_endpoint(request: Request):
+    """创建消息批次：请求写入磁盘后立即返回，由后台worker执行"""
+    try:
+        batch = await batch_store.create(iter_batch_items(request))
+    except compression.UnsupportedEncoding as e:
+        return anthropic_error_response(415, "invalid_request_error", str(e))
+    except (InvalidBatch, InvalidRequest) as e:
+        return anthropic_error_response(400, "invalid_request_error", str(e))
+    except RequestTooLarge as e:
+        return anthropic_error_response(413, "request_too_large", str(e))
+    batch_runner.submit(batch)
+    request_logger.info("[批处理] 创建批次 %s，请求数: %d", batch.id, batch.total)
+    return batch.to_dict()
+
+
+@app.get("/v1/messages/batches")
+async def list_batches_endpoint(limit: int = 20, before_id: Optional[str] = None, after_id: Optional[str] = None):
+    """按创建时间倒序列出批次；after_id翻到更早的一页，before_id翻到更新的一页"""
+    limit = max(1, min(limit, 1000))
+    ids = batch_store.ids()
+    if after_id:
+        ids = [batch_id for batch_id in ids if batch_id < after_id]
+    if before_id:
+        ids = [batch_id for batch_id in ids if batch_id > before_id]
+        page = ids[-limit:]
+    else:
+        page = ids[:limit]
+    data = []
+    for batch_id in page:
+        try:
+            data.append(batch_runner.get(batch_id).to_dict())
+        except BatchNotFound:
+            continue
+    return {
+        "data": data,
+        "has_more": len(ids) > limit,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+    }
+
+
+@app.get("/v1/messages/batches/{batch_id}")
+async def get_batch_endpoint(batch_id: str):
+    """查询批次状态"""
+    return get_batch(batch_id).to_dict()
+
+
+@app.post("/v1/messages/batches/{batch_id}/cancel")
+async def cancel_batch_endpoint(batch_id: str):
+    """取消批次：未执行的请求记为canceled，正在执行的请求完成后批次结束"""
+    return batch_runner.cancel(get_batch(batch_id)).to_dict()
+
+
+@app.get("/v1/messages/batches/{batch_id}/results")
+async def batch_results_endpoint(batch_id: str):
+    """以JSONL流式返回批次结果（批次结束后可用）"""
+    batch = get_batch(batch_id)
+    if batch.ended_at is None:
+        return anthropic_error_response(
+            409, "invalid_request_error", f"Batch {batch_id} is still {batch.status}; results are not yet available"
+        )
+    return StreamingResponse(batch_store.iter_results(batch), media_type="application/x-jsonl")
+
+
+@app.delete("/v1/messages/batches/{batch_id}")
+async def delete_batch_endpoint(batch_id: str):
+    """删除已结束的批次及其结果"""
+    batch = get_batch(batch_id)
+    if batch.ended_at is None:
+        return anthropic_error_response(
+            409, "invalid_request_error", f"Batch {batch_id} is still {batch.status}; cancel it before deleting"
+        )
+    batch_store.delete(batch)
+    return {"id": batch_id, "type": "message_batch_deleted"}
+
+
+@app.get("/usage")
+async def usage_endpoint(
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    group_by: str = ",".join(GROUP_FIELDS),
+    interval: int = 0,
+    api_key: Optional[str] = None
+):
+    """
+    用量查询：since/until为Unix时间戳（默认最近24小时），group_by为api_key/model/mapped_model的组合
+    （空字符串表示只汇总总量），interval>0时按该秒数分段；api_key按/usage返回的哈希ID过滤
+    """
+    if not usage_ledger.enabled:
+        return anthropic_error_response(404, "not_found_error", "Usage ledger is disabled (USAGE_DB)")
+    now = time.time()
+    until = now + USAGE_BUCKET_SECONDS if until is None else until
+    since = until - 86400 if since is None else since
+    fields = tuple(field.strip() for field in group_by.split(",") if field.strip())
+    try:
+        data = await usage_ledger.query(since, until, fields, max(0, interval), api_key)
+    except ValueError as e:
+        return anthropic_error_response(400, "invalid_request_error", str(e))
+    return {"since": since, "until": until, "group_by": list(fields), "data": data}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus指标端点（多worker部署时合并所有worker的快照）"""
+    return PlainTextResponse(
+        await proxy_metrics.registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/debug/slow_requests")
+async def slow_requests_endpoint():
+    """最近的慢请求及其各阶段耗时（需开启DEBUG_ENDPOINTS_ENABLED）"""
+    if not DEBUG_ENDPOINTS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return {"threshold_ms": SLOW_REQUEST_THRESHOLD_MS, "requests": slow_requests.recent()}
+
+
+@app.get("/debug/profile")
+async def profile_endpoint(seconds: float = 10.0):
+    """
+    对事件循环采样seconds秒，返回折叠栈格式（可直接交给flamegraph.pl/speedscope）。
+    需开启DEBUG_ENDPOINTS_ENABLED；同一时间只允许一次采样
+    """
+    if not DEBUG_ENDPOINTS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        stacks = await profiler.profile(seconds)
+    except ProfileInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(
+        stacks,
+        headers={"Content-Disposition": f'attachment; filename="profile-{os.getpid()}.collapsed"'}
+    )
+
+
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
     return {
-        "status": "healthy",
+        "status": "draining" if stream_drain.draining else "healthy",
         "service": "anthropic-to-openai-proxy",
         "openai_url": OPENAI_API_URL,
-        "openai_configured": bool(OPENAI_API_KEY)
+        "openai_configured": bool(OPENAI_API_KEY),
+        "upstream_pool": upstream_pool.stats(),
+        "upstream_router": upstream_router.stats(),
+        "logging": request_logger.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "single_flight": single_flight.stats(),
+        "hedging": hedger.stats(),
+        "admission": admission.stats(),
+        "token_counter": token_counter.stats(),
+        "context_window": context_window.stats(),
+        "media_cache": media_cache.stats(),
+        "compression": {
+            "response_encodings": RESPONSE_COMPRESSION,
+            "stream_compression": STREAM_COMPRESSION,
+            "request_encodings": compression.request_encodings(),
+            "upstream_request_encoding": UPSTREAM_REQUEST_ENCODING or None,
+            **compression_stats.stats(),
+        },
+        "model_routing": model_router.stats(),
+        "slow_requests": slow_requests.stats(),
+        "batches": batch_runner.stats(),
+        "usage_ledger": usage_ledger.stats(),
+        "drain": stream_drain.stats()
     }
 
 
 if __name__ == "__main__":
-    import uvicorn
+    import shutil
+    import tempfile
+    import server
     port = int(os.getenv("PORT", "8000"))
     print("Starting Anthropic to OpenAI Proxy Server...")
     print(f"OpenAI API URL: {OPENAI_API_URL}")
     print(f"OpenAI API Key configured: {bool(OPENAI_API_KEY)}")
     print(f"Default OpenAI Model: {DEFAULT_OPENAI_MODEL}")
-    if MODEL_MAPPING:
+    if ROUTING_FILE:
+        print(f"Routing File: {ROUTING_FILE} ({len(model_router.table.routes)} rules)")
+    elif MODEL_MAPPING:
         print(f"Model Mapping: {MODEL_MAPPING}")
     else:
         print("Model Mapping: Not configured (using default model for all requests)")
+    print(f"Upstream Pool: max_connections={UPSTREAM_MAX_CONNECTIONS}, "
+          f"keepalive_expiry={UPSTREAM_KEEPALIVE_EXPIRY}s, http2={UPSTREAM_HTTP2}")
+    print(f"Upstreams: {', '.join(upstream_router.upstreams)}, balance={UPSTREAM_BALANCE}")
+    print(f"Log Level: {LOG_LEVEL}, sample rate: {LOG_SAMPLE_RATE}, debug bodies: {LOG_DEBUG_BODIES}")
     print(f"Service Port: {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    print(f"Server: workers={SERVER_WORKERS}, loop={server.resolved_loop(SERVER_LOOP)}, "
+          f"http={server.resolved_http(SERVER_HTTP)}, backlog={SERVER_BACKLOG}, drain_timeout={SERVER_DRAIN_TIMEOUT}s")
+    metrics_tmp_dir = None
+    if SERVER_WORKERS > 1 and not METRICS_DIR:
+        # 各worker的指标快照需要一个共享目录才能在/metrics合并
+        metrics_tmp_dir = tempfile.mkdtemp(prefix="proxy-metrics-")
+        proxy_metrics.registry.set_directory(metrics_tmp_dir)
+    try:
+        server.serve(
+            app,
+            host=SERVER_HOST,
+            port=port,
+            workers=SERVER_WORKERS,
+            backlog=SERVER_BACKLOG,
+            keepalive_timeout=SERVER_KEEPALIVE_TIMEOUT,
+            drain_timeout=SERVER_DRAIN_TIMEOUT,
+            loop=SERVER_LOOP,
+            http=SERVER_HTTP,
+            on_drain=stream_drain.begin,
+        )
+    finally:
+        if metrics_tmp_dir is not None:
+            shutil.rmtree(metrics_tmp_dir, ignore_errors=True)
@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+"""
+离线消息批处理（Message Batches API）
+- BatchStore：每个批次一个目录：requests.jsonl（提交的请求）、results.jsonl（只追加的结果，每个请求一行）、
+  batch.json（状态）。重启后按results.jsonl中已有的custom_id跳过已完成的请求，从中断处继续
+- BatchRunner：固定数量的worker从有界队列取请求执行，按上游限制批处理的并发（UpstreamSlots），
+  可重试的错误按指数退避重试；请求文件按块读取，内存占用与批次大小无关
+多worker部署时通过BATCH_DIR下的文件锁只让一个进程执行批次；其他进程从磁盘读取状态，
+新批次和取消请求由执行进程定期扫描目录发现。
+"""
+
+import asyncio
+import os
+import re
+import secrets
+import shutil
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, AsyncIterable, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from request_codec import dumps
+from sse_encoder import DECODE_ERRORS, loads
+
+try:
+    import fcntl
+except ImportError:  # Windows：不支持多进程部署，当前进程总是执行批次
+    fcntl = None  # type: ignore
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_CANCELING = "canceling"
+STATUS_ENDED = "ended"
+
+RESULT_SUCCEEDED = "succeeded"
+RESULT_ERRORED = "errored"
+RESULT_CANCELED = "canceled"
+RESULT_EXPIRED = "expired"
+RESULT_TYPES = (RESULT_SUCCEEDED, RESULT_ERRORED, RESULT_CANCELED, RESULT_EXPIRED)
+
+CUSTOM_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+BATCH_ID_PATTERN = re.compile(r"^msgbatch_[0-9a-f]{25}$")
+
+_REQUESTS_FILE = "requests.jsonl"
+_RESULTS_FILE = "results.jsonl"
+_META_FILE = "batch.json"
+_CANCEL_FILE = "cancel"
+_LOCK_FILE = ".lock"
+_READ_CHUNK = 256 * 1024
+
+
+class InvalidBatch(ValueError):
+    """批次请求的结构不合法（整个批次被拒绝）"""
+
+
+class BatchNotFound(LookupError):
+    """批次不存在"""
+
+
+class BatchRequestError(Exception):
+    """单个请求失败；retryable表示可以稍后重试（上游过载、超时、连接失败）"""
+
+    def __init__(self, error_type: str, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.error_type = error_type
+        self.retryable = retryable
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def new_batch_id() -> str:
+    """毫秒时间戳在前，按字典序排序即按创建时间排序"""
+    return f"msgbatch_{int(time.time() * 1000):013x}{secrets.token_hex(6)}"
+
+
+def parse_batch_item(item: Any) -> Tuple[str, Dict[str, Any]]:
+    """校验一个批次条目 {"custom_id": ..., "params": {...}}；params的内容在执行时才校验"""
+    if not isinstance(item, dict):
+        raise InvalidBatch("each request must be an object")
+    custom_id = item.get("custom_id")
+    if not isinstance(custom_id, str) or not CUSTOM_ID_PATTERN.match(custom_id):
+        raise InvalidBatch("custom_id must be 1-64 characters of letters, digits, '_' or '-'")
+    params = item.get("params")
+    if not isinstance(params, dict):
+        raise InvalidBatch(f"{custom_id}: params must be an object")
+    return custom_id, params
+
+
+class Batch:
+    """一个批次的状态；计数和已完成的custom_id由results.jsonl恢复"""
+
+    __slots__ = (
+        "id", "path", "created_at", "expires_at", "cancel_initiated_at", "ended_at",
+        "total", "counts", "done", "inflight", "dirty", "_fd", "_pending", "_pending_bytes", "_idle", "_writing",
+    )
+
+    def __init__(self, batch_id: str, path: str, meta: Dict[str, Any]):
+        self.id = batch_id
+        self.path = path
+        self.created_at: float = meta["created_at"]
+        self.expires_at: float = meta["expires_at"]
+        self.cancel_initiated_at: Optional[float] = meta.get("cancel_initiated_at")
+        self.ended_at: Optional[float] = meta.get("ended_at")
+        self.total: int = meta["total"]
+        self.counts: Dict[str, int] = {kind: 0 for kind in RESULT_TYPES}
+        self.counts.update(meta.get("counts") or {})
+        self.done: Set[str] = set()
+        self.inflight = 0
+        self.dirty = False
+        self._fd: Optional[int] = None
+        # 尚未写入results.jsonl的结果行（由执行进程在线程池中批量写出）
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        # 在事件循环中首次使用时创建（Batch也会在线程池中由load创建）
+        self._idle: Optional[asyncio.Event] = None
+        self._writing: Optional["asyncio.Future[None]"] = None
+
+    @property
+    def status(self) -> str:
+        if self.ended_at is not None:
+            return STATUS_ENDED
+        if self.cancel_initiated_at is not None:
+            return STATUS_CANCELING
+        return STATUS_IN_PROGRESS
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def meta(self) -> Dict[str, Any]:
+        return {
+            "created_at": self.created_at,
+            "expires_at": self.expires_at,
+            "cancel_initiated_at": self.cancel_initiated_at,
+            "ended_at": self.ended_at,
+            "total": self.total,
+            "counts": self.counts,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Anthropic格式的message_batch对象"""
+        counts = dict(self.counts)
+        counts["processing"] = max(0, self.total - sum(self.counts.values()))
+        ended = self.ended_at is not None
+        return {
+            "id": self.id,
+            "type": "message_batch",
+            "processing_status": self.status,
+            "request_counts": {
+                "processing": counts["processing"],
+                "succeeded": counts[RESULT_SUCCEEDED],
+                "errored": counts[RESULT_ERRORED],
+                "canceled": counts[RESULT_CANCELED],
+                "expired": counts[RESULT_EXPIRED],
+            },
+            "ended_at": _iso(self.ended_at),
+            "created_at": _iso(self.created_at),
+            "expires_at": _iso(self.expires_at),
+            "archived_at": None,
+            "cancel_initiated_at": _iso(self.cancel_initiated_at),
+            "results_url": f"/v1/messages/batches/{self.id}/results" if ended else None,
+        }
+
+    # ---- 结果文件 ----
+
+    def open_results(self) -> None:
+        if self._fd is None:
+            self._fd = os.open(self.file(_RESULTS_FILE), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def append_result(self, custom_id: str, result: Dict[str, Any]) -> None:
+        """记录一行结果（先缓冲在内存中，由write_results批量写出）"""
+        line = dumps({"custom_id": custom_id, "result": result}) + b"\n"
+        self._pending.append(line)
+        self._pending_bytes += len(line)
+        self.done.add(custom_id)
+        self.counts[result["type"]] += 1
+        self.dirty = True
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._pending_bytes
+
+    def take_results(self) -> bytes:
+        """取出缓冲的结果行（在事件循环中调用）"""
+        data = b"".join(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        return data
+
+    def write_results(self, data: bytes) -> None:
+        """追加整行结果：O_APPEND下一次write，进程崩溃最多留下不完整的末行（恢复时截掉）"""
+        self.open_results()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]  # type: ignore[arg-type]
+
+    # ---- 进行中的请求 ----
+
+    def _idle_event(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if not self.inflight:
+                self._idle.set()
+        return self._idle
+
+    def start_request(self) -> None:
+        self.inflight += 1
+        self._idle_event().clear()
+
+    def finish_request(self) -> None:
+        self.inflight -= 1
+        if not self.inflight:
+            self._idle_event().set()
+
+    async def wait_idle(self) -> None:
+        """等待所有进行中的请求完成"""
+        await self._idle_event().wait()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class BatchStore:
+    """批次目录的读写；文件操作较重的方法在线程池中调用"""
+
+    def __init__(self, directory: str, max_requests: int = 100000, expiry: float = 86400.0):
+        self.directory = directory
+        self.max_requests = max_requests
+        self.expiry = expiry
+
+    def ensure_directory(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+    def batch_path(self, batch_id: str) -> str:
+        if not BATCH_ID_PATTERN.match(batch_id):
+            raise BatchNotFound(batch_id)
+        return os.path.join(self.directory, batch_id)
+
+    def ids(self) -> List[str]:
+        """所有批次ID，新的在前"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((name for name in names if BATCH_ID_PATTERN.match(name)), reverse=True)
+
+    # ---- 创建 ----
+
+    async def create(self, items: AsyncIterable[Any]) -> Batch:
+        """校验并写出requests.jsonl，全部写完后原子地重命名为批次目录（其他进程不会看到写了一半的批次）"""
+        self.ensure_directory()
+        batch_id = new_batch_id()
+        tmp_path = os.path.join(self.directory, f".tmp-{batch_id}")
+        os.makedirs(tmp_path)
+        loop = asyncio.get_event_loop()
+        seen: Set[str] = set()
+        pending: List[bytes] = []
+        pending_bytes = 0
+        try:
+            with open(os.path.join(tmp_path, _REQUESTS_FILE), "wb") as f:
+                async for item in items:
+                    custom_id, params = parse_batch_item(item)
+                    if custom_id in seen:
+                        raise InvalidBatch(f"duplicate custom_id: {custom_id}")
+                    seen.add(custom_id)
+                    if len(seen) > self.max_requests:
+                        raise InvalidBatch(f"a batch may contain at most {self.max_requests} requests")
+                    line = dumps({"custom_id": custom_id, "params": params}) + b"\n"
+                    pending.append(line)
+                    pending_bytes += len(line)
+                    if pending_bytes >= _READ_CHUNK:
+                        await loop.run_in_executor(None, f.write, b"".join(pending))
+                        pending, pending_bytes = [], 0
+                if not seen:
+                    raise InvalidBatch("requests must contain at least one request")
+                await loop.run_in_executor(None, f.write, b"".join(pending))
+            now = time.time()
+            meta = {"created_at": now, "expires_at": now + self.expiry, "total": len(seen)}
+            path = os.path.join(self.directory, batch_id)
+            self._write_meta(tmp_path, meta)
+            os.rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return Batch(batch_id, path, meta)
+
+    # ---- 读取 ----
+
+    @staticmethod
+    def _write_meta(path: str, meta: Dict[str, Any]) -> None:
+        meta_path = os.path.join(path, _META_FILE)
+        tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(dumps(meta))
+        os.replace(tmp_path, meta_path)
+
+    def save(self, batch: Batch) -> None:
+        batch.dirty = False
+        self._write_meta(batch.path, batch.meta())
+
+    def load(self, batch_id: str, recover: bool = False) -> Batch:
+        """
+        从磁盘读取批次状态（计数由执行进程定期写出）。
+        recover=True（执行进程恢复未结束的批次时）按results.jsonl重新计数并记录已完成的custom_id，
+        截掉崩溃留下的不完整末行
+        """
+        path = self.batch_path(batch_id)
+        try:
+            with open(os.path.join(path, _META_FILE), "rb") as f:
+                meta = loads(f.read())
+        except FileNotFoundError:
+            raise BatchNotFound(batch_id)
+        batch = Batch(batch_id, path, meta)
+        if batch.cancel_initiated_at is None and os.path.exists(batch.file(_CANCEL_FILE)):
+            batch.cancel_initiated_at = os.path.getmtime(batch.file(_CANCEL_FILE))
+        if recover and batch.ended_at is None:
+            batch.counts = {kind: 0 for kind in RESULT_TYPES}
+            for custom_id, kind in self._scan_results(batch):
+                batch.counts[kind] += 1
+                batch.done.add(custom_id)
+        return batch
+
+    @staticmethod
+    def _scan_results(batch: Batch) -> Iterator[Tuple[str, str]]:
+        results_path = batch.file(_RESULTS_FILE)
+        try:
+            f = open(results_path, "rb")
+        except FileNotFoundError:
+            return
+        valid = 0
+        with f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = loads(line)
+                    custom_id, kind = record["custom_id"], record["result"]["type"]
+                except DECODE_ERRORS + (KeyError, TypeError):
+                    break
+                valid += len(line)
+                yield custom_id, kind
+        if valid < os.path.getsize(results_path):
+            os.truncate(results_path, valid)
+
+    def request_cancel(self, batch: Batch) -> None:
+        """取消标记文件：执行进程（可能是另一个worker）扫描到后开始取消"""
+        if batch.cancel_initiated_at is None:
+            batch.cancel_initiated_at = time.time()
+        with open(batch.file(_CANCEL_FILE), "wb"):
+            pass
+        os.utime(batch.file(_CANCEL_FILE), (batch.cancel_initiated_at, batch.cancel_initiated_at))
+
+    def delete(self, batch: Batch) -> None:
+        shutil.rmtree(batch.path, ignore_errors=True)
+
+    @staticmethod
+    def read_requests(f: Any, limit: int) -> List[bytes]:
+        """从请求文件读取最多limit行（线程池中调用）"""
+        lines = []
+        for _ in range(limit):
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
+
+    async def iter_results(self, batch: Batch) -> AsyncGenerator[bytes, None]:
+        """按块流式读取结果文件"""
+        loop = asyncio.get_event_loop()
+        with open(batch.file(_RESULTS_FILE), "rb") as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, _READ_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class UpstreamSlots:
+    """批处理按上游的并发上限（只约束批处理，不影响在线请求）；limit<=0表示不限制"""
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = dict(limits)
+        self.default_limit = self.limits.get("*", 0)
+        self._in_use: Dict[str, int] = {}
+        # 在事件循环中首次使用时创建（Python 3.8的Condition在创建时绑定事件循环）
+        self._condition_obj: Optional[asyncio.Condition] = None
+
+    @property
+    def _condition(self) -> asyncio.Condition:
+        if self._condition_obj is None:
+            self._condition_obj = asyncio.Condition()
+        return self._condition_obj
+
+    def _free(self, name: str) -> bool:
+        limit = self.limits.get(name, self.default_limit)
+        return limit <= 0 or self._in_use.get(name, 0) < limit
+
+    async def acquire(self, plan: Callable[[], List[Any]]) -> Any:
+        """按路由计划的顺序取第一个有空闲名额的上游，都已满时等待名额归还"""
+        async with self._condition:
+            while True:
+                for upstream in plan():
+                    if self._free(upstream.name):
+                        self._in_use[upstream.name] = self._in_use.get(upstream.name, 0) + 1
+                        return upstream
+                await self._condition.wait()
+
+    async def release(self, upstream: Any) -> None:
+        async with self._condition:
+            self._in_use[upstream.name] -= 1
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limits": self.limits, "in_use": {name: n for name, n in self._in_use.items() if n}}
+
+
+_WorkItem = Tuple[Batch, str, Dict[str, Any]]
+
+
+class BatchRunner:
+    """
+    执行进程：workers个worker共享一个有界队列，每个进行中的批次一个读取任务往队列里放请求。
+    prepare(params)校验并转换请求，返回(转换结果, 映射后模型)；execute(转换结果, 上游)返回Anthropic消息。
+    两者都以BatchRequestError报告失败
+    """
+
+    def __init__(
+        self,
+        store: BatchStore,
+        prepare: Callable[[Dict[str, Any]], Tuple[Any, str]],
+        execute: Callable[[Any, Any], Awaitable[Dict[str, Any]]],
+        plan: Callable[[str], List[Any]],
+        slots: UpstreamSlots,
+        workers: int = 16,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        poll_interval: float = 1.0,
+    ):
+        self.store = store
+        self.prepare = prepare
+        self.execute = execute
+        self.plan = plan
+        self.slots = slots
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.poll_interval = poll_interval
+
+        self.active: Dict[str, Batch] = {}
+        self.owner = False
+        self._queue: Optional["asyncio.Queue[_WorkItem]"] = None
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._feeders: Dict[str, "asyncio.Task[None]"] = {}
+        self._ended: Set[str] = set()
+        self._lock_fd: Optional[int] = None
+
+        self.executed = 0
+        self.retried = 0
+
+    @property
+    def _work_queue(self) -> "asyncio.Queue[_WorkItem]":
+        # 在事件循环中首次使用时创建（Python 3.8的Queue在创建时绑定事件循环）
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.workers * 2)
+        return self._queue
+
+    # ---- 生命周期 ----
+
+    def _try_lock(self) -> bool:
+        if fcntl is None:
+            return True
+        fd = os.open(os.path.join(self.store.directory, _LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def start(self) -> None:
+        """
+        拿到目录锁的进程恢复未结束的批次并启动worker；其他进程定期重试拿锁（执行进程退出后接手）。
+        批次目录在创建第一个批次时才创建，目录不存在时不拿锁
+        """
+        self._tasks.append(asyncio.ensure_future(self._poll_loop()))
+
+    async def stop(self) -> None:
+        """停止所有任务；正在执行的请求没有写入结果，重启后重新执行"""
+        tasks = self._tasks + list(self._feeders.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._feeders.clear()
+        for batch in self.active.values():
+            if batch._writing is not None:
+                await asyncio.wait([batch._writing])
+            batch.write_results(batch.take_results())
+            if batch.dirty:
+                self.store.save(batch)
+            batch.close()
+        self.active.clear()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _become_owner(self) -> None:
+        self.owner = True
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def _poll_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.owner and os.path.isdir(self.store.directory) and self._try_lock():
+                self._become_owner()
+            if self.owner:
+                await self._scan(loop)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _scan(self, loop: asyncio.AbstractEventLoop) -> None:
+        """发现新批次和取消标记，写出有变化的批次状态"""
+        for batch_id in await loop.run_in_executor(None, self.store.ids):
+            if batch_id in self._ended:
+                continue
+            batch = self.active.get(batch_id)
+            if batch is None:
+                try:
+                    batch = await loop.run_in_executor(None, self.store.load, batch_id, True)
+                except (BatchNotFound, OSError, ValueError):
+                    continue
+                if batch.ended_at is None:
+                    self.submit(batch)
+                else:
+                    self._ended.add(batch_id)
+            elif batch.cancel_initiated_at is None and os.path.exists(batch.file(_CANCEL_FILE)):
+                self.cancel(batch)
+        for batch in list(self.active.values()):
+            if batch.dirty:
+                # 先写结果再写计数
+                await self._flush(loop, batch)
+                await loop.run_in_executor(None, self.store.save, batch)
+
+    async def _flush(self, loop: asyncio.AbstractEventLoop, batch: Batch) -> None:
+        """在线程池中写出缓冲的结果行；同一批次同时只有一个写入（先等上一个写完）"""
+        while batch._writing is not None and not batch._writing.done():
+            await asyncio.wait([batch._writing])
+        data = batch.take_results()
+        if not data:
+            return
+        # 调用方被取消时写入继续完成（stop会等待它）
+        writing = batch._writing = loop.run_in_executor(None, batch.write_results, data)
+        await asyncio.wait([writing])
+        writing.result()
+
+    # ---- 批次 ----
+
+    def submit(self, batch: Batch) -> None:
+        """开始执行（新建或恢复的）批次；还没有执行进程时（第一个批次刚创建了目录）尝试拿锁"""
+        if not self.owner and self._tasks and self._try_lock():
+            self._become_owner()
+        if not self.owner or batch.id in self.active:
+            return
+        self.active[batch.id] = batch
+        batch.open_results()
+        self._feeders[batch.id] = asyncio.ensure_future(self._feed(batch))
+
+    def get(self, batch_id: str) -> Batch:
+        """执行中的批次直接返回内存状态，其他批次从磁盘读取"""
+        batch = self.active.get(batch_id)
+        if batch is not None:
+            return batch
+        return self.store.load(batch_id)
+
+    def cancel(self, batch: Batch) -> Batch:
+        """发起取消：未开始的请求记为canceled，正在执行的请求完成后批次结束"""
+        if batch.ended_at is not None:
+            return batch
+        self.store.request_cancel(batch)
+        active = self.active.get(batch.id)
+        if active is not None and active.cancel_initiated_at is None:
+            active.cancel_initiated_at = batch.cancel_initiated_at
+            active.dirty = True
+        return active or batch
+
+    async def _feed(self, batch: Batch) -> None:
+        """按块读取请求文件，跳过已完成的请求；取消或过期后剩余请求直接记为canceled/expired"""
+        loop = asyncio.get_event_loop()
+        queue = self._work_queue
+        try:
+            with open(batch.file(_REQUESTS_FILE), "rb") as f:
+                while True:
+                    lines = await loop.run_in_executor(None, self.store.read_requests, f, 1000)
+                    if not lines:
+                        break
+                    for line in lines:
+                        record = loads(line)
+                        custom_id = record["custom_id"]
+                        if custom_id in batch.done:
+                            continue
+                        if batch.cancel_initiated_at is not None:
+                            batch.append_result(custom_id, {"type": RESULT_CANCELED})
+                        elif time.time() >= batch.expires_at:
+                            batch.append_result(custom_id, {"type": RESULT_EXPIRED})
+                        else:
+                            batch.start_request()
+                            await queue.put((batch, custom_id, record["params"]))
+                    if batch.pending_bytes >= _READ_CHUNK:
+                        await self._flush(loop, batch)
+            await batch.wait_idle()
+            # 先写完剩余结果再标记结束：结束后results接口直接读取结果文件
+            await self._flush(loop, batch)
+            batch.ended_at = time.time()
+            batch.close()
+            await loop.run_in_executor(None, self.store.save, batch)
+            batch.done = set()
+            self._ended.add(batch.id)
+        finally:
+            self._feeders.pop(batch.id, None)
+            self.active.pop(batch.id, None)
+
+    async def _worker(self) -> None:
+        queue = self._work_queue
+        while True:
+            batch, custom_id, params = await queue.get()
+            try:
+                batch.append_result(custom_id, await self._run(batch, params))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                batch.append_result(custom_id, _error_result("api_error", str(e)))
+            finally:
+                batch.finish_request()
+
+    async def _run(self, batch: Batch, params: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            prepared, model = self.prepare(params)
+        except BatchRequestError as e:
+            return _error_result(e.error_type, str(e))
+        attempt = 0
+        while True:
+            if batch.cancel_initiated_at is not None:
+                return {"type": RESULT_CANCELED}
+            if time.time() >= batch.expires_at:
+                return {"type": RESULT_EXPIRED}
+            upstream = await self.slots.acquire(lambda: self.plan(model))
+            try:
+                self.executed += 1
+                message = await self.execute(prepared, upstream)
+            except BatchRequestError as e:
+                if not e.retryable or attempt >= self.max_retries:
+                    return _error_result(e.error_type, str(e))
+            else:
+                return {"type": RESULT_SUCCEEDED, "message": message}
+            finally:
+                await self.slots.release(upstream)
+            self.retried += 1
+            await asyncio.sleep(min(60.0, self.retry_backoff * 2 ** attempt))
+            attempt += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """批处理统计，用于/health展示"""
+        return {
+            "directory": self.store.directory,
+            "owner": self.owner,
+            "workers": self.workers,
+            "active_batches": len(self.active),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "executed": self.executed,
+            "retried": self.retried,
+            "upstream_slots": self.slots.stats(),
+        }
+
+
+def _error_result(error_type: str, message: str) -> Dict[str, Any]:
+    return {"type": RESULT_ERRORED, "error": {"type": "error", "error": {"type": error_type, "message": message}}}
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Prometheus指标
+计数器/仪表/直方图都是普通dict上的原地更新：只在事件循环线程上调用，不需要加锁。
+多worker部署时每个worker定期把快照写到METRICS_DIR（在线程池中执行），
+/metrics读取目录下所有worker的快照合并后输出，计数器和直方图跨worker求和。
+已退出（崩溃、被kill）的worker的快照在读取时删除，它的计数不再计入（与进程重启后计数器归零相同）。
+"""
+
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+# 秒级延迟直方图的默认分桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# 流式token间隔的分桶（更细）
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# 输出速率（tokens/s）的分桶
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def snapshot(self) -> List[Any]:
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, merged: Dict[Labels, Any], data: List[Any]) -> None:
+        for labels, value in data:
+            key = tuple(labels)
+            merged[key] = merged.get(key, 0.0) + value
+
+    def render(self, merged: Dict[Labels, Any]) -> Iterable[str]:
+        for labels, value in merged.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """可增可减的仪表（如进行中的流），跨worker求和"""
+
+    kind = "gauge"
+
+    def dec(self, labels: Labels, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) - amount
+
+    def set(self, labels: Labels, value: float) -> None:
+        self.values[labels] = value
+
+
+class MaxGauge(Gauge):
+    """跨worker取最大值的仪表（如Key饱和度：各worker对同一个Key的观察值取最坏的一个）"""
+
+    def merge(self, merged: Dict[Labels, Any], data: List[Any]) -> None:
+        for labels, value in data:
+            key = tuple(labels)
+            merged[key] = max(merged.get(key, value), value)
+
+
+class Histogram:
+    """固定分桶的直方图；observe只做一次二分查找和两次加法"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # 每个标签组合：[各分桶计数（非累积，最后一个为+Inf）, 总和]
+        self.values: Dict[Labels, List[Any]] = {}
+
+    def observe(self, labels: Labels, value: float) -> None:
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def snapshot(self) -> List[Any]:
+        return [[list(labels), list(counts), total] for labels, (counts, total) in self.values.items()]
+
+    def merge(self, merged: Dict[Labels, Any], data: List[Any]) -> None:
+        for labels, counts, total in data:
+            key = tuple(labels)
+            series = merged.get(key)
+            if series is None:
+                merged[key] = [list(counts), total]
+            else:
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+
+    def render(self, merged: Dict[Labels, Any]) -> Iterable[str]:
+        for labels, (counts, total) in merged.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(total)}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+class MetricsRegistry:
+    """指标注册表：文本格式输出 + 可选的多worker快照合并"""
+
+    def __init__(self, multiproc_dir: Optional[str] = None, export_interval: float = 5.0):
+        self.multiproc_dir = multiproc_dir
+        self.export_interval = export_interval
+        self._metrics: List[Any] = []
+        self._export_task: Optional["asyncio.Task[None]"] = None
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+
+    def set_directory(self, multiproc_dir: str) -> None:
+        """启用多worker快照合并（在worker启动前调用）"""
+        self.multiproc_dir = multiproc_dir
+        os.makedirs(multiproc_dir, exist_ok=True)
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str]) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str]) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def max_gauge(self, name: str, help_text: str, labelnames: Sequence[str]) -> MaxGauge:
+        return self._register(MaxGauge(name, help_text, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str],
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def _register(self, metric: Any) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    # ---- 快照 ----
+
+    def snapshot(self, include_gauges: bool = True) -> Dict[str, Any]:
+        """当前进程的指标快照（JSON可序列化）"""
+        return {
+            metric.name: metric.snapshot()
+            for metric in self._metrics
+            if include_gauges or metric.kind != "gauge"
+        }
+
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.multiproc_dir, f"metrics_{os.getpid()}.json")
+
+    def _write_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        path = self._snapshot_path()
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        if os.name != "posix":
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # 没有权限发信号说明进程存在
+            return True
+        return True
+
+    def _read_snapshots(self) -> List[Dict[str, Any]]:
+        """
+        读取其他worker的快照（本进程使用内存中的实时数据）。
+        进程已不存在的快照（崩溃/被kill的worker，或上次运行留下的）直接删除；
+        超过3个导出间隔没有更新的快照（worker卡住或pid被复用）本次不合并
+        """
+        own = os.path.basename(self._snapshot_path())
+        snapshots = []
+        try:
+            names = os.listdir(self.multiproc_dir)
+        except OSError:
+            return snapshots
+        stale_before = time.time() - 3 * self.export_interval
+        for name in names:
+            if name == own or not name.startswith("metrics_") or not name.endswith(".json"):
+                continue
+            path = os.path.join(self.multiproc_dir, name)
+            try:
+                pid = int(name[len("metrics_"):-len(".json")])
+            except ValueError:
+                continue
+            try:
+                if not self._pid_alive(pid):
+                    os.unlink(path)
+                    continue
+                if os.path.getmtime(path) < stale_before:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def start(self) -> None:
+        """多worker模式下启动后台快照导出任务"""
+        if self.multiproc_dir and self._export_task is None:
+            self._export_task = asyncio.ensure_future(self._export_loop())
+
+    async def stop(self) -> None:
+        """停止导出；最后一次快照不含仪表，退出的worker不再计入进行中的流"""
+        if self._export_task is None:
+            return
+        self._export_task.cancel()
+        try:
+            await self._export_task
+        except asyncio.CancelledError:
+            pass
+        self._export_task = None
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write_snapshot, self.snapshot(include_gauges=False))
+
+    async def _export_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await loop.run_in_executor(None, self._write_snapshot, self.snapshot())
+            await asyncio.sleep(self.export_interval)
+
+    # ---- 输出 ----
+
+    async def render(self) -> str:
+        """Prometheus文本格式（合并所有worker）"""
+        snapshots = [self.snapshot()]
+        if self.multiproc_dir:
+            loop = asyncio.get_event_loop()
+            snapshots.extend(await loop.run_in_executor(None, self._read_snapshots))
+
+        lines: List[str] = []
+        for metric in self._metrics:
+            merged: Dict[Labels, Any] = {}
+            for snapshot in snapshots:
+                data = snapshot.get(metric.name)
+                if data:
+                    metric.merge(merged, data)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(merged))
+        return "\n".join(lines) + "\n"
+
+
+# 错误分类
+ERROR_TIMEOUT = "timeout"
+ERROR_UPSTREAM_STATUS = "upstream_status"
+ERROR_DECODE = "decode"
+ERROR_INTERNAL = "internal"
+
+
+class ProxyMetrics:
+    """代理的指标集合；模型标签为(请求的模型, 映射后的模型)，上游标签额外加上上游名"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        model_labels = ("requested_model", "mapped_model")
+        upstream_labels = model_labels + ("upstream",)
+        self.requests = registry.counter(
+            "proxy_requests_total", "Requests received on /v1/messages", model_labels + ("stream",)
+        )
+        self.upstream_requests = registry.counter(
+            "proxy_upstream_requests_total", "Requests sent upstream by response status",
+            upstream_labels + ("status",)
+        )
+        self.inflight_streams = registry.gauge(
+            "proxy_inflight_streams", "Streams currently being relayed", upstream_labels
+        )
+        self.connect = registry.histogram(
+            "proxy_upstream_connect_seconds", "Time until upstream response headers (streaming)",
+            upstream_labels
+        )
+        self.ttft = registry.histogram(
+            "proxy_time_to_first_token_seconds", "Time until the first upstream chunk", upstream_labels
+        )
+        self.inter_token = registry.histogram(
+            "proxy_inter_token_seconds", "Gap between consecutive upstream chunks", upstream_labels,
+            INTER_TOKEN_BUCKETS
+        )
+        self.output_rate = registry.histogram(
+            "proxy_output_tokens_per_second", "Output tokens (chunks when streaming) per second",
+            upstream_labels, THROUGHPUT_BUCKETS
+        )
+        self.duration = registry.histogram(
+            "proxy_request_duration_seconds", "Total upstream request duration", upstream_labels
+        )
+        self.cancelled = registry.counter(
+            "proxy_cancelled_streams_total",
+            "Upstream requests aborted before completion (client_disconnect, shutdown or a timeout class)",
+            upstream_labels + ("reason",)
+        )
+        self.cancelled_tokens = registry.counter(
+            "proxy_cancelled_max_tokens_remaining_total",
+            "Upper bound of output tokens not generated because a request was aborted "
+            "(max_tokens minus chunks relayed)",
+            upstream_labels
+        )
+        self.errors = registry.counter(
+            "proxy_errors_total", "Errors by class (timeout, upstream_status, decode, internal)",
+            upstream_labels + ("class",)
+        )
+        self.context_window = registry.counter(
+            "proxy_context_window_total",
+            "Requests adjusted by the local context-window check (action: trimmed, clamped, rejected)",
+            model_labels + ("action",)
+        )
+        self.hedges = registry.counter(
+            "proxy_hedge_events_total",
+            "Hedging by requested model (event: launched, hedge_won, primary_won); "
+            "hedge win rate = hedge_won / launched",
+            ("requested_model", "event")
+        )
+        key_labels = ("upstream", "key")
+        self.key_requests = registry.counter(
+            "proxy_upstream_key_requests_total", "Requests sent per upstream API key by response status",
+            key_labels + ("status",)
+        )
+        self.key_saturation = registry.max_gauge(
+            "proxy_upstream_key_saturation",
+            "Used fraction of the tighter of an API key's request/token rate limits (1 while paused after a 429)",
+            key_labels
+        )
+        self.key_pool_wait = registry.histogram(
+            "proxy_key_pool_wait_seconds", "Time requests queued because every API key of an upstream was exhausted",
+            ("upstream",)
+        )
+        self.key_pool_exhausted = registry.counter(
+            "proxy_key_pool_exhausted_total", "Requests rejected because no API key freed up within KEY_POOL_MAX_WAIT",
+            ("upstream",)
+        )
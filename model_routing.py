@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+模型路由配置
+Anthropic模型名到OpenAI模型的路由规则，可以来自MODEL_MAPPING环境变量，也可以来自配置文件
+（YAML / TOML / JSON），配置文件在后台按修改时间监视，变化后重新加载并整体替换：
+- 规则按文件中的顺序匹配，第一条匹配的规则生效；match为精确名或glob模式（* 和 ?，如 claude-*-haiku*）
+- 一条规则可以有多个带权重的目标模型（金丝雀流量），按分流键（如metadata.user_id）哈希选择，
+  同一用户始终落在同一个目标上；没有分流键时随机选择
+- 规则和目标可以带params：覆盖转换后OpenAI请求的参数，值为null表示删除该参数
+- 规则编译为查找表：精确名一次字典查找，glob模式合并为一个正则，按模型名缓存匹配结果；
+  重新加载时构建新表后一次性替换引用，进行中的请求继续使用已经选定的目标
+
+配置文件示例（YAML）：
+    default: qwen-max-latest
+    routes:
+      - match: claude-sonnet-4-20250514
+        model: qwen3-coder-plus
+      - match: "claude-*-haiku*"
+        targets:
+          - {model: qwen-turbo, weight: 90}
+          - {model: qwen-turbo-canary, weight: 10, params: {temperature: 0.3}}
+        params: {max_tokens: 4096, top_p: null}
+"""
+
+import asyncio
+import bisect
+import json
+import os
+import random
+import re
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+# 每张路由表缓存的模型名匹配结果上限（模型名集合通常很小，超出时清空重建）
+_LOOKUP_CACHE_SIZE = 4096
+
+
+class RoutingConfigError(ValueError):
+    """路由配置文件无法解析或结构不合法"""
+
+
+class RouteTarget:
+    """一个目标模型：权重、参数覆盖和选中次数"""
+
+    __slots__ = ("model", "weight", "params", "requests")
+
+    def __init__(self, model: str, weight: float = 1.0, params: Optional[Dict[str, Any]] = None):
+        self.model = model
+        self.weight = weight
+        self.params = params or {}
+        self.requests = 0
+
+    def apply(self, openai_request: Dict[str, Any]) -> None:
+        """把参数覆盖应用到转换后的OpenAI请求"""
+        for name, value in self.params.items():
+            if value is None:
+                openai_request.pop(name, None)
+            else:
+                openai_request[name] = value
+
+
+class Route:
+    """一条路由规则：匹配模式和按权重分流的目标"""
+
+    __slots__ = ("match", "targets", "_cumulative", "_total")
+
+    def __init__(self, match: str, targets: List[RouteTarget]):
+        self.match = match
+        self.targets = targets
+        self._cumulative: List[float] = []
+        total = 0.0
+        for target in targets:
+            total += target.weight
+            self._cumulative.append(total)
+        self._total = total
+
+    def choose(self, key: Optional[str] = None) -> RouteTarget:
+        """按权重选择目标：有分流键时按其哈希稳定选择，否则随机"""
+        targets = self.targets
+        if len(targets) == 1:
+            target = targets[0]
+        else:
+            if key:
+                point = zlib.crc32(key.encode("utf-8")) / 4294967296.0 * self._total
+            else:
+                point = random.random() * self._total
+            index = bisect.bisect_right(self._cumulative, point)
+            target = targets[min(index, len(targets) - 1)]
+        target.requests += 1
+        return target
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "match": self.match,
+            "targets": [
+                {"model": target.model, "weight": target.weight, "params": target.params, "requests": target.requests}
+                for target in self.targets
+            ],
+        }
+
+
+def glob_to_regex(pattern: str) -> str:
+    """glob模式转为正则（只支持 * 和 ?，其余字符按字面匹配）"""
+    return "".join(
+        ".*" if char == "*" else "." if char == "?" else re.escape(char)
+        for char in pattern
+    )
+
+
+def _is_glob(pattern: str) -> bool:
+    return "*" in pattern or "?" in pattern
+
+
+class RoutingTable:
+    """编译后的路由表（只读，重新加载时整体替换）"""
+
+    def __init__(self, routes: List[Route], default: Route, source: str = "env"):
+        self.routes = routes
+        self.default = default
+        self.source = source
+        self.loaded_at = time.time()
+        self.shadowed: List[str] = []
+        self._exact: Dict[str, Route] = {}
+        patterns: List[Tuple[str, Route]] = []
+        for route in routes:
+            if _is_glob(route.match):
+                patterns.append((glob_to_regex(route.match), route))
+                continue
+            if route.match in self._exact or any(re.fullmatch(regex, route.match) for regex, _ in patterns):
+                # 前面的规则已经匹配这个名字，这条规则永远不会生效
+                self.shadowed.append(route.match)
+                continue
+            self._exact[route.match] = route
+        # 精确名之前的glob规则已在编译时排除，查找时精确名优先、其余按顺序匹配合并的正则
+        self._patterns = [route for _, route in patterns]
+        self._regex = re.compile(
+            "|".join(f"(?P<r{index}>{regex})" for index, (regex, _) in enumerate(patterns))
+        ) if patterns else None
+        self._cache: Dict[str, Route] = {}
+
+    def lookup(self, model: str) -> Route:
+        """模型名对应的规则（未匹配任何规则时为默认规则）"""
+        route = self._exact.get(model)
+        if route is not None:
+            return route
+        route = self._cache.get(model)
+        if route is not None:
+            return route
+        route = self.default
+        if self._regex is not None:
+            match = self._regex.fullmatch(model)
+            if match is not None:
+                route = self._patterns[int(match.lastgroup[1:])]  # type: ignore[index]
+        if len(self._cache) >= _LOOKUP_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[model] = route
+        return route
+
+    def resolve(self, model: str, key: Optional[str] = None) -> RouteTarget:
+        return self.lookup(model).choose(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "rules": len(self.routes),
+            "shadowed": self.shadowed,
+            "default": self.default.stats()["targets"],
+            "routes": [route.stats() for route in self.routes],
+        }
+
+
+def _parse_params(value: Any, where: str) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise RoutingConfigError(f"{where}.params: expected a mapping")
+    if "model" in value or "messages" in value:
+        raise RoutingConfigError(f"{where}.params: model and messages cannot be overridden")
+    return dict(value)
+
+
+def _parse_targets(rule: Dict[str, Any], where: str) -> List[RouteTarget]:
+    params = _parse_params(rule.get("params"), where)
+    if "targets" not in rule:
+        if not isinstance(rule.get("model"), str):
+            raise RoutingConfigError(f"{where}: model or targets required")
+        return [RouteTarget(rule["model"], 1.0, params)]
+    targets = rule["targets"]
+    if not isinstance(targets, list) or not targets:
+        raise RoutingConfigError(f"{where}.targets: expected a non-empty list")
+    parsed = []
+    for index, target in enumerate(targets):
+        path = f"{where}.targets[{index}]"
+        if not isinstance(target, dict) or not isinstance(target.get("model"), str):
+            raise RoutingConfigError(f"{path}.model: required")
+        weight = target.get("weight", 1)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+            raise RoutingConfigError(f"{path}.weight: expected a positive number")
+        # 目标的params在规则的params基础上覆盖
+        overrides = dict(params, **_parse_params(target.get("params"), path))
+        parsed.append(RouteTarget(target["model"], float(weight), overrides))
+    return parsed
+
+
+def compile_config(config: Any, default_model: str, source: str) -> RoutingTable:
+    """把解析后的配置（default + routes）编译为路由表"""
+    if not isinstance(config, dict):
+        raise RoutingConfigError("routing config: expected a mapping at the top level")
+    default = config.get("default", default_model)
+    if isinstance(default, str):
+        default_route = Route("*", [RouteTarget(default)])
+    elif isinstance(default, dict):
+        default_route = Route("*", _parse_targets(default, "default"))
+    else:
+        raise RoutingConfigError("default: expected a model name or a rule")
+    rules = config.get("routes") or []
+    if not isinstance(rules, list):
+        raise RoutingConfigError("routes: expected a list")
+    routes = []
+    for index, rule in enumerate(rules):
+        where = f"routes[{index}]"
+        if not isinstance(rule, dict) or not isinstance(rule.get("match"), str) or not rule["match"]:
+            raise RoutingConfigError(f"{where}.match: required")
+        routes.append(Route(rule["match"], _parse_targets(rule, where)))
+    return RoutingTable(routes, default_route, source)
+
+
+def mapping_table(mapping: Dict[str, str], default_model: str) -> RoutingTable:
+    """MODEL_MAPPING（精确名映射）对应的路由表；映射的键也可以是glob模式"""
+    return compile_config(
+        {"default": default_model, "routes": [{"match": name, "model": model} for name, model in mapping.items()]},
+        default_model,
+        "env",
+    )
+
+
+def read_config(path: str) -> Any:
+    """按扩展名解析配置文件：.yaml/.yml需要PyYAML，.toml需要Python 3.11+或tomli，.json使用标准库"""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        if extension in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise RoutingConfigError("YAML routing files require PyYAML: pip install pyyaml")
+            return yaml.safe_load(data)
+        if extension == ".toml":
+            try:
+                import tomllib  # type: ignore[import-not-found]
+            except ImportError:
+                try:
+                    import tomli as tomllib  # type: ignore[no-redef]
+                except ImportError:
+                    raise RoutingConfigError("TOML routing files require Python 3.11+ or tomli: pip install tomli")
+            return tomllib.loads(data.decode("utf-8"))
+        if extension == ".json":
+            return json.loads(data)
+    except RoutingConfigError:
+        raise
+    except Exception as e:
+        raise RoutingConfigError(f"{path}: {e}")
+    raise RoutingConfigError(f"{path}: unsupported routing file type (use .yaml, .yml, .toml or .json)")
+
+
+class ModelRouter:
+    """
+    当前生效的路由表；配置了path时启动后按interval检查文件，变化后在线程池中解析编译，
+    成功后替换路由表，失败时保留旧表并记录错误
+    """
+
+    def __init__(
+        self,
+        fallback: RoutingTable,
+        path: str = "",
+        default_model: str = "",
+        interval: float = 2.0,
+        logger: Any = None,
+    ):
+        self.path = path
+        self.default_model = default_model
+        self.interval = interval
+        self.logger = logger
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_error: Optional[str] = None
+        self._signature: Optional[Tuple[int, int, int]] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        # 启动时配置文件不合法直接报错，不带着错误的路由启动
+        self.table = self._load() if path else fallback
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        # 原子替换（写临时文件再rename）时inode变化，修改时间精度不够时也能发现
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self) -> RoutingTable:
+        signature = self._stat()
+        table = compile_config(read_config(self.path), self.default_model, self.path)
+        self._signature = signature
+        return table
+
+    def resolve(self, model: str, key: Optional[str] = None) -> RouteTarget:
+        """模型名对应的目标（热路径：只读取一次当前路由表的引用）"""
+        return self.table.resolve(model, key)
+
+    async def reload(self) -> bool:
+        """重新加载配置文件，返回是否成功"""
+        loop = asyncio.get_event_loop()
+        try:
+            table = await loop.run_in_executor(None, self._load)
+        except (OSError, RoutingConfigError) as e:
+            self.reload_errors += 1
+            self.last_error = str(e)
+            # 同一个错误版本不重复尝试，等文件再次变化
+            self._signature = self._stat()
+            if self.logger is not None:
+                self.logger.warning("[路由] 重新加载 %s 失败，继续使用旧配置: %s", self.path, e)
+            return False
+        self.table = table
+        self.reloads += 1
+        self.last_error = None
+        if self.logger is not None:
+            self.logger.info("[路由] 已重新加载 %s，规则数: %d", self.path, len(table.routes))
+        return True
+
+    async def _watch_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            signature = self._stat()
+            if signature is not None and signature != self._signature:
+                await self.reload()
+
+    def start(self) -> None:
+        if self.path and self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._watch_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """路由配置状态，用于/health展示"""
+        return dict(
+            self.table.stats(),
+            reloads=self.reloads,
+            reload_errors=self.reload_errors,
+            last_error=self.last_error,
+        )
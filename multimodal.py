@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+多模态内容（image/document块）转换
+- image和document块转换为OpenAI的image_url部分：base64来源转为data URL，url来源原样透传，
+  纯文本document转为text部分
+- 较大的base64数据不拼接成data URL字符串、也不随请求一起重新序列化：转换结果中只放一个
+  带内容哈希的占位URL，编码上游请求体时把数据作为独立的字节片段拼接进去（SplicedBody）。
+  数据直接取自原始请求体的切片（base64不含转义字符时与解析出的字符串逐字节相同）
+- 按内容哈希（sha256）的LRU缓存：同一对话后续轮次、并发请求和批处理中重复的图片共享同一份数据
+- 每个请求的内存上限：原始请求体、解析后的字符串和为上游额外复制的数据合计超过上限时拒绝
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple, Union
+
+# 占位URL：proxy-media:<sha256>，参与响应缓存/单飞的键和日志，不会发给上游
+MEDIA_PREFIX = "proxy-media:"
+
+Payload = Union[bytes, memoryview]
+
+# 原始请求体切片的抽样校验：窗口数和窗口长度
+_SAMPLES = 8
+_SAMPLE_CHARS = 32
+
+
+class RequestTooLarge(ValueError):
+    """请求的内存占用超过上限"""
+
+
+class MediaRequest(dict):
+    """包含拼接数据的OpenAI请求：字典内容与普通请求相同，media为占位URL到(data URL前缀, 数据)的映射"""
+
+    __slots__ = ("media",)
+
+    def __init__(self, request: Dict[str, Any], media: Dict[str, Tuple[bytes, Payload]]):
+        super().__init__(request)
+        self.media = media
+
+
+class SplicedBody:
+    """由多个字节片段组成的请求体；可重复迭代（故障切换/对冲时重新发送），长度用于Content-Length"""
+
+    __slots__ = ("chunks", "length")
+
+    def __init__(self, chunks: List[Payload]):
+        self.chunks = chunks
+        self.length = sum(len(chunk) for chunk in chunks)
+
+    def __len__(self) -> int:
+        return self.length
+
+    async def __aiter__(self) -> AsyncGenerator[Payload, None]:
+        for chunk in self.chunks:
+            yield chunk
+
+
+def splice(body: bytes, media: Dict[str, Tuple[bytes, Payload]]) -> SplicedBody:
+    """把编码后请求体中的占位URL替换为data URL前缀和数据片段"""
+    positions = []
+    for placeholder, (prefix, payload) in media.items():
+        token = placeholder.encode("ascii")
+        start = body.find(token)
+        while start != -1:
+            positions.append((start, len(token), prefix, payload))
+            start = body.find(token, start + len(token))
+    positions.sort(key=lambda item: item[0])
+    chunks: List[Payload] = []
+    cursor = 0
+    for start, length, prefix, payload in positions:
+        chunks.append(body[cursor:start] + prefix)
+        chunks.append(payload)
+        cursor = start + length
+    chunks.append(body[cursor:])
+    return SplicedBody(chunks)
+
+
+class MediaCache:
+    """按内容哈希的LRU缓存（字节数限制）；max_bytes<=0表示关闭"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, digest: str) -> Optional[bytes]:
+        payload = self._entries.get(digest)
+        if payload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(digest)
+        return payload
+
+    def put(self, digest: str, payload: bytes) -> None:
+        if len(payload) > self.max_bytes or digest in self._entries:
+            return
+        self._entries[digest] = payload
+        self._bytes += len(payload)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """多模态数据缓存统计，用于/health展示"""
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class MediaResolver:
+    """
+    一个请求的多模态数据：在原始请求体中定位base64数据的切片、查内容缓存、累计内存占用。
+    raw为原始请求体（没有时数据从解析出的字符串编码，计入内存占用）；max_memory<=0表示不限制
+    """
+
+    def __init__(
+        self,
+        raw: Optional[bytes],
+        cache: MediaCache,
+        splice_min_bytes: int = 64 * 1024,
+        max_memory: int = 0,
+    ):
+        self.raw = raw
+        self.cache = cache
+        self.splice_min_bytes = splice_min_bytes
+        self.max_memory = max_memory
+        self.media: Dict[str, Tuple[bytes, Payload]] = {}
+        # 原始请求体和解析出的对象各占一份
+        self.footprint = 2 * len(raw) if raw is not None else 0
+        self._cursor = 0
+        self._view = memoryview(raw) if raw is not None else None
+        self.check()
+
+    def check(self) -> None:
+        if self.max_memory > 0 and self.footprint > self.max_memory:
+            raise RequestTooLarge(
+                f"request needs about {self.footprint // (1024 * 1024)} MB of memory, "
+                f"exceeding the {self.max_memory // (1024 * 1024)} MB per-request limit"
+            )
+
+    def _charge(self, size: int) -> None:
+        self.footprint += size
+        self.check()
+
+    def _locate(self, data: str) -> Optional[memoryview]:
+        """
+        在原始请求体中找到data对应的JSON字符串内容：按文档顺序从上次的位置向后查找，
+        要求前后是引号、中间没有转义和引号、长度一致，并抽样比对若干窗口
+        """
+        raw = self.raw
+        if raw is None:
+            return None
+        size = len(data)
+        head = data[:_SAMPLE_CHARS].encode("ascii")
+        step = max(1, (size - _SAMPLE_CHARS) // _SAMPLES)
+        start = raw.find(head, self._cursor)
+        while start != -1:
+            end = start + size
+            if (
+                start > 0 and raw[start - 1] == 0x22 and end < len(raw) and raw[end] == 0x22
+                and raw.find(b"\\", start, end) == -1 and raw.find(b'"', start, end) == -1
+                and all(
+                    raw[start + offset:start + offset + _SAMPLE_CHARS]
+                    == data[offset:offset + _SAMPLE_CHARS].encode("ascii")
+                    for offset in range(0, size, step)
+                )
+            ):
+                self._cursor = end
+                return self._view[start:end]  # type: ignore[index]
+            start = raw.find(head, start + 1)
+        return None
+
+    def data_url(self, media_type: str, data: str) -> str:
+        """base64数据对应的URL：小数据直接拼成data URL，大数据返回占位URL并登记要拼接的数据"""
+        if len(data) < self.splice_min_bytes or not data.isascii():
+            self._charge(len(data))
+            return f"data:{media_type};base64,{data}"
+        source: Payload
+        view = self._locate(data)
+        if view is not None:
+            source = view
+        else:
+            source = data.encode("ascii")
+            self._charge(len(source))
+        digest = hashlib.sha256(source).hexdigest()
+        payload: Optional[Payload] = self.cache.get(digest) if self.cache.enabled else None
+        if payload is None:
+            payload = source
+            if self.cache.enabled and len(source) <= self.cache.max_bytes:
+                if isinstance(source, memoryview):
+                    payload = source.tobytes()
+                    self._charge(len(payload))
+                self.cache.put(digest, payload)  # type: ignore[arg-type]
+        placeholder = MEDIA_PREFIX + digest
+        self.media[placeholder] = (f"data:{media_type};base64,".encode("ascii"), payload)
+        return placeholder
+
+    def convert_block(self, block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """image/document块转换为OpenAI的content部分，不支持的来源返回None"""
+        source = block.get("source")
+        if not isinstance(source, dict):
+            return None
+        source_type = source.get("type")
+        if source_type == "base64" and isinstance(source.get("data"), str):
+            media_type = source.get("media_type") or (
+                "application/pdf" if block.get("type") == "document" else "image/png"
+            )
+            return {"type": "image_url", "image_url": {"url": self.data_url(media_type, source["data"])}}
+        if source_type == "url" and isinstance(source.get("url"), str):
+            return {"type": "image_url", "image_url": {"url": source["url"]}}
+        if source_type == "text" and isinstance(source.get("data"), str):
+            return {"type": "text", "text": source["data"]}
+        if source_type == "content" and isinstance(source.get("content"), list):
+            text = "\n".join(
+                item.get("text", "") for item in source["content"]
+                if isinstance(item, dict) and item.get("type") == "text"
+            )
+            return {"type": "text", "text": text}
+        return None
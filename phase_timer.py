@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+请求阶段计时
+每个请求一个PhaseTimer，按阶段（读取请求体、解析、转换、排队、上游连接、上游首字节、SSE输出等）累计耗时；
+非流式响应通过Server-Timing响应头返回，流式响应在末尾追加一个SSE注释帧。
+超过阈值的请求记录到固定容量的环形缓冲区，供/debug/slow_requests查看。
+"""
+
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterable, Deque, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class PhaseTimer:
+    """按阶段累计耗时（秒）；mark记录距上一个mark的耗时，add直接累加（用于在别处测得的时间）"""
+
+    __slots__ = ("started", "phases", "_last")
+
+    def __init__(self) -> None:
+        self.started = self._last = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.add(name, now - self._last)
+        self._last = now
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Server-Timing格式：read;dur=0.12, parse;dur=0.34, ..., total;dur=56.78（毫秒）"""
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        parts.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(parts)
+
+    def sse_comment(self) -> bytes:
+        """流式响应末尾的诊断注释帧（SSE客户端会忽略注释）"""
+        return f": server-timing {self.server_timing()}\n\n".encode("ascii")
+
+
+async def timed_iter(source: AsyncIterable[T], timer: PhaseTimer, phase: str) -> AsyncGenerator[T, None]:
+    """迭代异步数据源，把等待每个元素的时间累计到timer的phase阶段"""
+    iterator = source.__aiter__()
+    while True:
+        started = time.perf_counter()
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            timer.add(phase, time.perf_counter() - started)
+        yield item
+
+
+class SlowRequestLog:
+    """最近的慢请求（总耗时不低于阈值），固定容量的环形缓冲区"""
+
+    def __init__(self, threshold: float = 2.0, capacity: int = 100):
+        self.threshold = threshold
+        self._entries: Deque[Dict[str, Any]] = deque(maxlen=capacity)
+        self.recorded = 0
+
+    def record(self, timer: PhaseTimer, **info: Any) -> None:
+        total = timer.total()
+        if total < self.threshold:
+            return
+        self.recorded += 1
+        entry = dict(info)
+        entry["time"] = time.time()
+        entry["total_ms"] = round(total * 1000, 2)
+        entry["phases_ms"] = {name: round(seconds * 1000, 2) for name, seconds in timer.phases.items()}
+        self._entries.append(entry)
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """最近的慢请求，新的在前"""
+        return list(reversed(self._entries))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "threshold_ms": round(self.threshold * 1000, 1),
+            "recorded": self.recorded,
+            "buffered": len(self._entries),
+        }
+
+
+async def with_timing_trailer(
+    frames: AsyncIterable[bytes],
+    timer: PhaseTimer,
+    slow_log: Optional[SlowRequestLog] = None,
+    **info: Any
+) -> AsyncGenerator[bytes, None]:
+    """流式响应结束时追加Server-Timing注释帧，并把慢请求记入环形缓冲区"""
+    completed = False
+    try:
+        async for frame in frames:
+            yield frame
+        completed = True
+        yield timer.sse_comment()
+    finally:
+        if slow_log is not None:
+            slow_log.record(timer, completed=completed, **info)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+上游前缀缓存友好的请求规范化
+vLLM等上游的自动前缀缓存只在渲染后的提示词前缀逐字节相同时命中：
+- system提示词（顶层system字段和消息中的system角色）合并为第一条system消息，
+  多个text块按固定分隔符拼接，每一轮对话都得到相同的前缀
+- Anthropic的cache_control断点作为提示：带断点的请求按会话起点（system和第一条消息）的哈希
+  粘性路由到同一个上游（见UpstreamRouter.plan的affinity参数），上游负载过高时退回普通负载均衡
+- 上游返回的缓存命中token数（prompt_tokens_details.cached_tokens或prompt_cache_hit_tokens）
+  映射为Anthropic usage中的cache_read_input_tokens，input_tokens不再包含这部分
+"""
+
+import hashlib
+from typing import Any, Dict, List, Optional
+
+from request_codec import dumps
+
+SYSTEM_SEPARATOR = "\n"
+
+
+def system_text(system: Any) -> str:
+    """system字段（字符串或text块数组）转为纯文本"""
+    if isinstance(system, str):
+        return system
+    if isinstance(system, list):
+        return SYSTEM_SEPARATOR.join(
+            block.get("text", "") for block in system
+            if isinstance(block, dict) and block.get("type") == "text"
+        )
+    return "" if system is None else str(system)
+
+
+def canonical_messages(system: Any, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """把顶层system和消息中的system角色合并为第一条消息；没有system时原样返回"""
+    texts = [system_text(system)] if system else []
+    rest = messages
+    if any(message["role"] == "system" for message in messages):
+        rest = []
+        for message in messages:
+            if message["role"] == "system":
+                texts.append(system_text(message["content"]))
+            else:
+                rest.append(message)
+    if not texts:
+        return messages
+    return [{"role": "system", "content": SYSTEM_SEPARATOR.join(texts)}] + rest
+
+
+def _has_breakpoint(blocks: Any) -> bool:
+    return isinstance(blocks, list) and any(
+        isinstance(block, dict) and "cache_control" in block for block in blocks
+    )
+
+
+def has_cache_control(anthropic_request: Dict[str, Any]) -> bool:
+    """请求中是否有cache_control断点（system、tools或消息的content块）"""
+    if _has_breakpoint(anthropic_request.get("system")) or _has_breakpoint(anthropic_request.get("tools")):
+        return True
+    return any(_has_breakpoint(message.get("content")) for message in anthropic_request.get("messages", []))
+
+
+def affinity_key(anthropic_request: Dict[str, Any], openai_request: Dict[str, Any]) -> Optional[str]:
+    """
+    粘性路由的键：带cache_control断点的请求取 模型 + system + 第一条非system消息 的哈希，
+    同一会话的后续轮次得到相同的键；没有断点时返回None（按普通负载均衡）
+    """
+    if not has_cache_control(anthropic_request):
+        return None
+    messages = openai_request["messages"]
+    end = 0
+    while end < len(messages) and messages[end]["role"] == "system":
+        end += 1
+    prefix = dumps([openai_request["model"], messages[:end + 1]])
+    return hashlib.sha256(prefix).hexdigest()
+
+
+def anthropic_usage(openai_usage: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """OpenAI的usage转为Anthropic格式：命中上游前缀缓存的token计入cache_read_input_tokens"""
+    openai_usage = openai_usage or {}
+    prompt_tokens = openai_usage.get("prompt_tokens") or 0
+    details = openai_usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens") or openai_usage.get("prompt_cache_hit_tokens") or 0
+    cached = min(cached, prompt_tokens)
+    return {
+        "input_tokens": prompt_tokens - cached,
+        "output_tokens": openai_usage.get("completion_tokens") or 0,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": cached,
+    }
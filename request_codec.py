@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+请求编解码
+直接从原始请求体字节解码（与SSE编码器相同的后端选择：orjson > msgspec > 标准库json），
+解码后按Anthropic Messages API的结构做一次廉价校验，不合法时抛出InvalidRequest，
+由端点返回Anthropic格式的invalid_request_error。
+转换后的OpenAI请求一次性编码为bytes，作为预编码的请求体发给上游（对冲/故障切换时复用），
+不再由httpx用标准库json重新序列化；包含大块图片数据的请求编码为分片的请求体（见multimodal）。
+"""
+
+import json
+from typing import Any, Callable, Dict, Tuple, Type, Union
+
+from multimodal import MediaRequest, SplicedBody, splice
+from sse_encoder import DECODE_ERRORS, loads
+
+# 上游请求体编码：orjson / msgspec直接产生UTF-8 bytes，回退到标准库json时使用紧凑分隔符
+try:
+    import orjson
+
+    dumps: Callable[[Any], bytes] = orjson.dumps
+except ImportError:
+    try:
+        import msgspec
+
+        dumps = msgspec.json.encode
+    except ImportError:
+        def dumps(obj: Any) -> bytes:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+_NUMBER = (int, float)
+
+# 可选的顶层字段：允许的类型和错误信息中的类型名；未列出的字段（thinking等）不校验，原样保留
+OPTIONAL_FIELDS: Dict[str, Tuple[Tuple[Type[Any], ...], str]] = {
+    "max_tokens": ((int,), "integer"),
+    "stream": ((bool,), "boolean"),
+    "temperature": (_NUMBER, "number"),
+    "top_p": (_NUMBER, "number"),
+    "top_k": ((int,), "integer"),
+    "stop": ((str, list), "string or array"),
+    "stop_sequences": ((list,), "array"),
+    "system": ((str, list), "string or array"),
+    "metadata": ((dict,), "object"),
+    "tools": ((list,), "array"),
+}
+
+
+class InvalidRequest(ValueError):
+    """请求体不是合法的JSON，或不符合Messages API的结构"""
+
+
+def _type_name(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, _NUMBER):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    return "object"
+
+
+def _check_field(name: str, value: Any, types: Tuple[Type[Any], ...], expected: str) -> None:
+    # bool是int的子类，数值字段需要单独排除
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        raise InvalidRequest(f"{name}: expected {expected}, got {_type_name(value)}")
+
+
+def _check_blocks(path: str, blocks: Any) -> None:
+    for index, block in enumerate(blocks):
+        if not isinstance(block, dict):
+            raise InvalidRequest(f"{path}.{index}: expected object, got {_type_name(block)}")
+        if not isinstance(block.get("type"), str):
+            raise InvalidRequest(f"{path}.{index}.type: Field required")
+
+
+def validate_request(body: Any) -> Dict[str, Any]:
+    """校验Messages API请求的结构（只检查转换和路由会读取的字段）"""
+    if not isinstance(body, dict):
+        raise InvalidRequest(f"request body: expected object, got {_type_name(body)}")
+    if not isinstance(body.get("model"), str):
+        raise InvalidRequest("model: Field required" if "model" not in body else
+                             f"model: expected string, got {_type_name(body['model'])}")
+    messages = body.get("messages")
+    if not isinstance(messages, list):
+        raise InvalidRequest("messages: Field required" if messages is None else
+                             f"messages: expected array, got {_type_name(messages)}")
+    for index, message in enumerate(messages):
+        if not isinstance(message, dict):
+            raise InvalidRequest(f"messages.{index}: expected object, got {_type_name(message)}")
+        if not isinstance(message.get("role"), str):
+            raise InvalidRequest(f"messages.{index}.role: Field required")
+        content = message.get("content", "")
+        if isinstance(content, list):
+            _check_blocks(f"messages.{index}.content", content)
+        elif not isinstance(content, str):
+            raise InvalidRequest(
+                f"messages.{index}.content: expected string or array, got {_type_name(content)}"
+            )
+    for name, (types, expected) in OPTIONAL_FIELDS.items():
+        value = body.get(name)
+        if value is not None:
+            _check_field(name, value, types, expected)
+    system = body.get("system")
+    if isinstance(system, list):
+        _check_blocks("system", system)
+    return body
+
+
+def decode_request(raw: bytes) -> Dict[str, Any]:
+    """从原始请求体字节解码并校验"""
+    if not raw:
+        raise InvalidRequest("request body is empty")
+    try:
+        body = loads(raw)
+    except DECODE_ERRORS + (UnicodeDecodeError,) as e:
+        raise InvalidRequest(f"Invalid JSON in request body: {e}")
+    return validate_request(body)
+
+
+def encode_request(openai_request: Dict[str, Any]) -> Union[bytes, SplicedBody]:
+    """把OpenAI请求编码为上游请求体；包含拼接数据的请求（MediaRequest）返回分片的请求体"""
+    body = dumps(openai_request)
+    if isinstance(openai_request, MediaRequest):
+        return splice(body, openai_request.media)
+    return body
+
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+非阻塞请求日志
+日志记录只在事件循环上入队，格式化和写出由后台线程完成；
+队列满时直接丢弃，绝不阻塞正在处理的请求
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Any, Dict, IO, Optional
+
+LOGGER_NAME = "mini_open2anth"
+
+
+def truncate_body(obj: Any, max_chars: int) -> Any:
+    """截断请求体中过长的字符串字段，max_chars<=0表示不截断"""
+    if max_chars <= 0:
+        return obj
+    if isinstance(obj, str):
+        if len(obj) > max_chars:
+            return f"{obj[:max_chars]}...(已截断 {len(obj) - max_chars} 字符)"
+        return obj
+    if isinstance(obj, dict):
+        return {key: truncate_body(value, max_chars) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [truncate_body(item, max_chars) for item in obj]
+    return obj
+
+
+class LazyJSON:
+    """延迟序列化的JSON，只有在后台线程写出日志时才会执行json.dumps"""
+
+    __slots__ = ("obj", "max_chars")
+
+    def __init__(self, obj: Any, max_chars: int):
+        self.obj = obj
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        return json.dumps(truncate_body(self.obj, self.max_chars), ensure_ascii=False, indent=2)
+
+
+class DroppingQueueHandler(logging.Handler):
+    """有界队列日志处理器：只入队不格式化，队列满时丢弃并计数"""
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__()
+        self.queue = log_queue
+        self.dropped = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RequestLogger:
+    """结构化请求日志，支持日志级别、按请求采样、请求体截断和可选的完整请求体调试输出"""
+
+    def __init__(
+        self,
+        level: str = "INFO",
+        sample_rate: float = 1.0,
+        max_body_chars: int = 2000,
+        debug_bodies: bool = False,
+        queue_size: int = 10000,
+        stream: Optional[IO[str]] = None,
+    ):
+        self.sample_rate = sample_rate
+        self.max_body_chars = max_body_chars
+        self.debug_bodies = debug_bodies
+
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.setLevel(getattr(logging, level.upper(), logging.INFO))
+        self.logger.propagate = False
+
+        self._queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=queue_size)
+        self._handler = DroppingQueueHandler(self._queue)
+        self.logger.addHandler(self._handler)
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        self._listener = logging.handlers.QueueListener(self._queue, output)
+        self._started = False
+
+    def start(self) -> None:
+        """启动后台写日志线程"""
+        if not self._started:
+            self._listener.start()
+            self._started = True
+
+    def stop(self) -> None:
+        """停止后台线程，退出前写完队列中剩余的日志"""
+        if self._started:
+            self._listener.stop()
+            self._started = False
+
+    @property
+    def dropped(self) -> int:
+        return self._handler.dropped
+
+    def sampled(self) -> bool:
+        """按采样率决定当前请求是否记录日志"""
+        if self.sample_rate >= 1.0:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def log_request(
+        self,
+        title: str,
+        url: str,
+        method: str,
+        body: Dict[str, Any],
+        sampled: bool = True,
+    ) -> None:
+        """记录一次请求：默认只输出摘要，开启调试模式时输出（截断后的）完整请求体"""
+        if not sampled or not self.logger.isEnabledFor(logging.INFO):
+            return
+        messages = body.get("messages")
+        self.logger.info(
+            "[%s] %s %s model=%s stream=%s messages=%d",
+            title,
+            method,
+            url,
+            body.get("model"),
+            bool(body.get("stream", False)),
+            len(messages) if isinstance(messages, list) else 0,
+        )
+        if self.debug_bodies:
+            self.logger.info("[%s] 请求内容:\n%s", title, LazyJSON(body, self.max_body_chars))
+
+    def debug(self, msg: str, *args: Any) -> None:
+        self.logger.debug(msg, *args)
+
+    def info(self, msg: str, *args: Any) -> None:
+        self.logger.info(msg, *args)
+
+    def warning(self, msg: str, *args: Any) -> None:
+        self.logger.warning(msg, *args)
+
+    def error(self, msg: str, *args: Any) -> None:
+        self.logger.error(msg, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        """日志子系统状态，用于/health展示"""
+        return {
+            "level": logging.getLevelName(self.logger.level),
+            "sample_rate": self.sample_rate,
+            "debug_bodies": self.debug_bodies,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+        }
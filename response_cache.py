@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+确定性请求的响应缓存
+以转换后OpenAI请求的规范化哈希为键：内存LRU（条目数/字节数/TTL限制）+ 可选磁盘层。
+非流式请求缓存转换后的Anthropic响应，流式请求缓存完整的SSE帧序列用于回放。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+KIND_RESPONSE = "response"
+KIND_STREAM = "stream"
+
+
+def cache_key(openai_request: Dict[str, Any], original_model: str) -> str:
+    """请求的规范化哈希（字段顺序无关）；响应中带有原始模型名，因此一并计入"""
+    canonical = json.dumps(
+        [original_model, openai_request],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(openai_request: Dict[str, Any]) -> bool:
+    """temperature显式为0的请求视为确定性请求"""
+    return openai_request.get("temperature") == 0
+
+
+def cache_directives(headers: Any) -> Tuple[bool, bool]:
+    """
+    解析请求头中的缓存控制，返回(允许读缓存, 允许写缓存)
+    Cache-Control: no-cache 跳过读取；no-store 既不读也不写；X-Proxy-Cache: bypass 同no-store
+    """
+    cache_control = headers.get("cache-control", "").lower()
+    if headers.get("x-proxy-cache", "").lower() == "bypass" or "no-store" in cache_control:
+        return False, False
+    if "no-cache" in cache_control:
+        return False, True
+    return True, True
+
+
+class _Entry:
+    __slots__ = ("kind", "data", "size", "expires_at")
+
+    def __init__(self, kind: str, data: Any, size: int, expires_at: float):
+        self.kind = kind
+        self.data = data
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """内存LRU + 可选磁盘层的响应缓存"""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600.0,
+        disk_dir: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    # ---- 内存层 ----
+
+    def _get_memory(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put_memory(self, key: str, entry: _Entry) -> None:
+        if entry.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    # ---- 磁盘层（文件读写在线程池中执行） ----
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[_Entry]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("expires_at", 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        data = record["data"]
+        if record["kind"] == KIND_STREAM:
+            data = [frame.encode("utf-8") for frame in data]
+        return _Entry(record["kind"], data, record.get("size", 0), record["expires_at"])
+
+    def _write_disk(self, key: str, entry: _Entry) -> None:
+        data = entry.data
+        if entry.kind == KIND_STREAM:
+            data = [frame.decode("utf-8") for frame in data]
+        record = {"kind": entry.kind, "data": data, "size": entry.size, "expires_at": entry.expires_at}
+        path = self._disk_path(key)
+        # 多worker共享磁盘层：临时文件按进程区分，同时写同一个键时互不覆盖
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    # ---- 对外接口 ----
+
+    async def get(self, key: str) -> Optional[Tuple[str, Any]]:
+        """查询缓存，命中时返回(kind, data)"""
+        entry = self._get_memory(key)
+        if entry is None and self.disk_dir:
+            loop = asyncio.get_event_loop()
+            entry = await loop.run_in_executor(None, self._read_disk, key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._put_memory(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.kind, entry.data
+
+    def set_response(self, key: str, anthropic_response: Dict[str, Any]) -> None:
+        """缓存非流式请求的Anthropic响应"""
+        size = len(json.dumps(anthropic_response, ensure_ascii=False))
+        self._store(key, _Entry(KIND_RESPONSE, anthropic_response, size, time.time() + self.ttl))
+
+    def set_stream(self, key: str, frames: List[bytes]) -> None:
+        """缓存流式请求的完整SSE帧序列"""
+        size = sum(len(frame) for frame in frames)
+        self._store(key, _Entry(KIND_STREAM, frames, size, time.time() + self.ttl))
+
+    def _store(self, key: str, entry: _Entry) -> None:
+        self.stores += 1
+        self._put_memory(key, entry)
+        if self.disk_dir:
+            asyncio.get_event_loop().run_in_executor(None, self._write_disk, key, entry)
+
+    async def record_stream(
+        self,
+        key: str,
+        frames: AsyncGenerator[bytes, None],
+        terminal_frame: bytes,
+    ) -> AsyncGenerator[bytes, None]:
+        """透传流式输出并记录帧序列，只有以terminal_frame正常结束的流才会写入缓存"""
+        recorded: List[bytes] = []
+        async for frame in frames:
+            recorded.append(frame)
+            yield frame
+        if recorded and recorded[-1].endswith(terminal_frame):
+            self.set_stream(key, recorded)
+
+    @staticmethod
+    async def replay_stream(frames: List[bytes]) -> AsyncGenerator[bytes, None]:
+        """回放缓存的SSE帧序列"""
+        for frame in frames:
+            yield frame
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计，用于/health展示"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "disk_dir": self.disk_dir,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
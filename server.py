@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+生产服务模式
+- 多worker：每个worker进程各自用SO_REUSEPORT绑定同一端口，由内核把新连接分配给各worker；
+  主进程只负责fork worker、重启异常退出的worker和转发退出信号。
+  不支持SO_REUSEPORT或fork的平台（如Windows）退回单进程
+- 事件循环和HTTP解析器为auto时，安装了uvloop/httptools就自动使用
+- 优雅退出：收到SIGTERM/SIGINT后停止接受新连接，空闲的keep-alive连接立即关闭，
+  进行中的请求最多继续drain_timeout秒；on_drain在停止接受连接时被调用（用于到期后结束仍在进行的流），
+  uvicorn在排空期限之后再留grace秒让最后的错误事件写出，然后才强制取消
+"""
+
+import importlib.util
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import uvicorn
+
+# worker在启动后这么短的时间内退出视为启动失败，重启前等待，避免崩溃循环
+_MIN_UPTIME = 1.0
+_RESTART_DELAY = 1.0
+
+
+def supports_reuse_port() -> bool:
+    return hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork")
+
+
+def resolved_loop(loop: str) -> str:
+    """auto时实际使用的事件循环"""
+    if loop == "auto":
+        return "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+    return loop
+
+
+def resolved_http(http: str) -> str:
+    """auto时实际使用的HTTP/1.1实现"""
+    if http == "auto":
+        return "httptools" if importlib.util.find_spec("httptools") is not None else "h11"
+    return http
+
+
+class DrainingServer(uvicorn.Server):
+    """停止接受新连接的同时通知应用开始排空"""
+
+    def __init__(self, config: uvicorn.Config, on_drain: Optional[Callable[[float], None]], drain_timeout: float):
+        super().__init__(config)
+        self.on_drain = on_drain
+        self.drain_timeout = drain_timeout
+
+    async def shutdown(self, sockets: Optional[List[socket.socket]] = None) -> None:
+        if self.on_drain is not None:
+            self.on_drain(self.drain_timeout)
+        await super().shutdown(sockets)
+
+
+def reuse_port_socket(host: str, port: int, backlog: int) -> socket.socket:
+    """绑定到同一端口的监听socket（SO_REUSEPORT），每个worker一个"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    """主进程：保持workers个worker进程运行，收到退出信号后转发给worker并等待排空"""
+
+    def __init__(self, target: Callable[[], None], workers: int, stop_timeout: float):
+        self.target = target
+        self.workers = workers
+        self.stop_timeout = stop_timeout
+        self.processes: Dict[int, Any] = {}
+        self.started: Dict[int, float] = {}
+        self.stopping = False
+        self._context = multiprocessing.get_context("fork")
+
+    def _spawn(self, slot: int) -> None:
+        process = self._context.Process(target=self.target, name=f"worker-{slot}", daemon=False)
+        process.start()
+        self.processes[slot] = process
+        self.started[slot] = time.monotonic()
+        print(f"[server] worker {slot} started (pid {process.pid})", flush=True)
+
+    def _handle_signal(self, signum: int, frame: Any) -> None:
+        if self.stopping and signum == signal.SIGINT:
+            # 第二次Ctrl+C：立即结束
+            for process in self.processes.values():
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGKILL)
+            return
+        self.stopping = True
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for slot in range(self.workers):
+            self._spawn(slot)
+        while not self.stopping:
+            time.sleep(0.5)
+            for slot, process in list(self.processes.items()):
+                if process.is_alive() or self.stopping:
+                    continue
+                print(f"[server] worker {slot} (pid {process.pid}) exited with {process.exitcode}, restarting",
+                      flush=True)
+                if time.monotonic() - self.started[slot] < _MIN_UPTIME:
+                    time.sleep(_RESTART_DELAY)
+                self._spawn(slot)
+        deadline = time.monotonic() + self.stop_timeout
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+        for process in self.processes.values():
+            if process.is_alive():
+                print(f"[server] worker pid {process.pid} did not exit in time, killing", flush=True)
+                process.kill()
+                process.join()
+
+
+def serve(
+    app: Any,
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    workers: int = 1,
+    backlog: int = 2048,
+    keepalive_timeout: float = 5.0,
+    drain_timeout: float = 30.0,
+    drain_grace: float = 5.0,
+    loop: str = "auto",
+    http: str = "auto",
+    on_drain: Optional[Callable[[float], None]] = None,
+) -> None:
+    """
+    启动服务：workers>1且平台支持时为多进程（SO_REUSEPORT），否则在当前进程中运行。
+    多进程模式在fork前应完成应用的导入和配置（worker继承主进程的模块状态，事件循环在worker中创建）
+    """
+    config_args = dict(
+        host=host,
+        port=port,
+        loop=loop,
+        http=http,
+        backlog=backlog,
+        timeout_keep_alive=math.ceil(keepalive_timeout),
+        timeout_graceful_shutdown=math.ceil(drain_timeout + drain_grace),
+    )
+
+    if workers <= 1 or not supports_reuse_port():
+        if workers > 1:
+            print("[server] SO_REUSEPORT/fork not available on this platform, running a single process", flush=True)
+        DrainingServer(uvicorn.Config(app, **config_args), on_drain, drain_timeout).run()
+        return
+
+    def run_worker() -> None:
+        # fork继承了主进程的信号处理函数，由uvicorn重新安装之前先恢复默认
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        sock = reuse_port_socket(host, port, backlog)
+        server = DrainingServer(uvicorn.Config(app, **config_args), on_drain, drain_timeout)
+        server.run(sockets=[sock])
+        sys.exit(0 if server.started else 1)
+
+    Supervisor(run_worker, workers, drain_timeout + drain_grace + 5.0).run()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+相同请求的单飞合并
+同一时刻的相同请求只向上游发送一次：非流式请求共享同一个结果，
+流式请求通过广播器订阅同一串SSE帧，迟到的订阅者先回放已发送的帧；
+所有订阅者都断开（包括还没开始读取响应体就断开）后取消上游请求
+"""
+
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class _StreamFlight:
+    """一次进行中的流式请求：已产生的帧 + 新帧通知；上游生成器在第一个订阅者开始迭代时才启动"""
+
+    __slots__ = ("frames", "done", "event", "subscribers", "task", "factory")
+
+    def __init__(self, factory: Callable[[], AsyncGenerator[bytes, None]]):
+        self.frames: List[bytes] = []
+        self.done = False
+        self.event = asyncio.Event()
+        self.subscribers = 0
+        self.task: Optional["asyncio.Task[None]"] = None
+        self.factory: Optional[Callable[[], AsyncGenerator[bytes, None]]] = factory
+
+
+class _Subscription:
+    """
+    一个订阅者：创建时就计入订阅数，迭代结束、aclose或者没有迭代就被回收时退出。
+    响应体在开始迭代前就被丢弃（客户端在发送响应头时断开）时外层生成器的aclose不会传到这里，
+    由回收时的__del__退出，最后一个订阅者退出后取消（或不再启动）上游请求
+    """
+
+    __slots__ = ("_owner", "_key", "_flight", "_position", "_released")
+
+    def __init__(self, owner: "SingleFlight", key: str, flight: _StreamFlight):
+        self._owner = owner
+        self._key = key
+        self._flight = flight
+        self._position = 0
+        self._released = False
+        flight.subscribers += 1
+
+    def __aiter__(self) -> "_Subscription":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._released:
+            raise StopAsyncIteration
+        flight = self._flight
+        if flight.task is None and not flight.done:
+            self._owner._start(self._key, flight)
+        while True:
+            # 先回放（或追上）已产生的帧
+            if self._position < len(flight.frames):
+                self._position += 1
+                return flight.frames[self._position - 1]
+            if flight.done:
+                self.release()
+                raise StopAsyncIteration
+            await flight.event.wait()
+
+    async def aclose(self) -> None:
+        self.release()
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        flight = self._flight
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            self._owner._abandon(self._key, flight)
+
+    def __del__(self) -> None:
+        self.release()
+
+
+class SingleFlight:
+    """按请求键合并进行中的上游调用"""
+
+    def __init__(self):
+        self._calls: Dict[str, "asyncio.Task[Any]"] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def call(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """非流式调用：第一个请求执行factory，并发的相同请求等待同一结果"""
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish_call(key, t))
+        else:
+            self.followers += 1
+        # shield：某个客户端断开时不影响其他仍在等待的请求
+        return await asyncio.shield(task)
+
+    def _finish_call(self, key: str, task: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 所有等待者都已断开时避免"exception was never retrieved"警告
+        if not task.cancelled():
+            task.exception()
+
+    def stream(
+        self,
+        key: str,
+        factory: Callable[[], AsyncGenerator[bytes, None]],
+    ) -> AsyncIterator[bytes]:
+        """流式调用：第一个请求的factory驱动上游生成器，相同请求订阅同一帧序列"""
+        flight = self._streams.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = self._streams[key] = _StreamFlight(factory)
+        else:
+            self.followers += 1
+        return _Subscription(self, key, flight)
+
+    def _start(self, key: str, flight: _StreamFlight) -> None:
+        factory, flight.factory = flight.factory, None
+        assert factory is not None
+        flight.task = asyncio.ensure_future(self._pump(key, flight, factory()))
+
+    def _abandon(self, key: str, flight: _StreamFlight) -> None:
+        """所有订阅者都已退出：取消上游请求（还没有启动时不再启动），之后的相同请求重新发往上游"""
+        flight.factory = None
+        if flight.task is not None:
+            flight.task.cancel()
+        if self._streams.get(key) is flight:
+            del self._streams[key]
+
+    async def _pump(self, key: str, flight: _StreamFlight, source: AsyncGenerator[bytes, None]) -> None:
+        try:
+            async for frame in source:
+                flight.frames.append(frame)
+                event, flight.event = flight.event, asyncio.Event()
+                event.set()
+        finally:
+            flight.done = True
+            flight.event.set()
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+
+    def joinable(self, key: str) -> bool:
+        """是否有进行中的相同请求（新请求将作为跟随者，不会再发往上游）"""
+        return key in self._calls or key in self._streams
+
+    def stats(self) -> Dict[str, Any]:
+        """单飞统计，用于/health展示"""
+        return {
+            "inflight_calls": len(self._calls),
+            "inflight_streams": len(self._streams),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+SSE帧编码器
+流式热路径上的Anthropic事件使用预先序列化好的帧模板，
+每个token只需要转义文本片段并拼接字节，不再构造嵌套dict和调用json.dumps。
+输出与 f"data: {json.dumps(event)}\\n\\n" 逐字节一致。
+"""
+
+import json
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+# 上游chunk解析：优先使用orjson，其次msgspec，都不可用时回退到标准库json
+try:
+    import orjson
+
+    loads: Callable[[Any], Any] = orjson.loads
+    DECODE_ERRORS: Tuple[Type[Exception], ...] = (orjson.JSONDecodeError,)
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+
+        loads = msgspec.json.decode
+        DECODE_ERRORS = (msgspec.DecodeError,)
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        loads = json.loads
+        DECODE_ERRORS = (json.JSONDecodeError,)
+        JSON_BACKEND = "json"
+
+DONE = b"data: [DONE]\n\n"
+_FRAME_END = b"}}\n\n"
+
+
+def _escape(text: str) -> bytes:
+    """与json.dumps默认参数(ensure_ascii=True)相同的字符串转义，结果一定是ASCII"""
+    return encode_basestring_ascii(text).encode("ascii")
+
+
+def encode_event(event: Any) -> bytes:
+    """通用事件编码（非热路径使用）"""
+    return f"data: {json.dumps(event)}\n\n".encode("ascii")
+
+
+@lru_cache(maxsize=64)
+def _delta_prefix(index: int, delta_type: str, field: str) -> bytes:
+    return (
+        f'data: {{"type": "content_block_delta", "index": {index}, '
+        f'"delta": {{"type": "{delta_type}", "{field}": '
+    ).encode("ascii")
+
+
+@lru_cache(maxsize=64)
+def content_block_start(index: int, block_type: str) -> bytes:
+    """content_block_start事件，block_type为thinking或text"""
+    return encode_event({
+        "type": "content_block_start",
+        "index": index,
+        "content_block": {
+            "type": block_type,
+            block_type: ""
+        }
+    })
+
+
+@lru_cache(maxsize=64)
+def content_block_stop(index: int) -> bytes:
+    """content_block_stop事件"""
+    return encode_event({"type": "content_block_stop", "index": index})
+
+
+def text_delta(index: int, text: str) -> bytes:
+    """text_delta事件，只转义文本片段"""
+    return _delta_prefix(index, "text_delta", "text") + _escape(text) + _FRAME_END
+
+
+def thinking_delta(index: int, thinking: str) -> bytes:
+    """thinking_delta事件，只转义思考片段"""
+    return _delta_prefix(index, "thinking_delta", "thinking") + _escape(thinking) + _FRAME_END
+
+
+def message_start(message_id: str, model: str, input_tokens: int = 0, output_tokens: int = 0) -> bytes:
+    """message_start事件（每个流只发送一次）"""
+    return encode_event({
+        "type": "message_start",
+        "message": {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "content": [],
+            "model": model,
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens
+            }
+        }
+    })
+
+
+def message_delta(
+    stop_reason: str, include_stop_sequence: bool = False, usage: Optional[Dict[str, int]] = None
+) -> bytes:
+    """message_delta事件；[DONE]时发送的结束事件额外带有stop_sequence字段，上游返回了usage时一并带上"""
+    reason = _escape(stop_reason)
+    frame = (
+        b'data: {"type": "message_delta", "delta": {"stop_reason": ' + reason
+        + b'}, "message": {"stop_reason": ' + reason
+    )
+    if include_stop_sequence:
+        frame += b', "stop_sequence": null'
+    if usage is not None:
+        return frame + b'}, "usage": ' + json.dumps(usage).encode("ascii") + _FRAME_END[1:]
+    return frame + _FRAME_END
+
+
+def error_event(error_type: str, message: str) -> bytes:
+    """流式错误事件"""
+    return encode_event({
+        "type": "error",
+        "error": {
+            "type": error_type,
+            "message": message
+        }
+    })
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+流的取消与超时
+- 按映射模型配置的分级超时：连接、首字节（请求开始到第一个data行）、chunk间空闲、总时长
+- StreamWatchdog：每个流一个定时器，只在等待上游数据时计时，到期后取消正在等待的任务，
+  由流式生成器把取消转换为Anthropic格式的错误事件；每个chunk只更新一个时间戳
+- DisconnectAwareStreamingResponse：不论ASGI spec版本都监听客户端断开，
+  断开时立即停止发送并关闭响应体生成器，生成器的finally随即关闭上游连接
+- StreamDrain：服务关闭时让进行中的流继续到排空期限，到期仍未结束的流被取消，
+  由流式生成器转换为overloaded_error事件（客户端可以重试），而不是被直接断开
+"""
+
+import asyncio
+import time
+from functools import partial
+from typing import Any, AsyncGenerator, AsyncIterable, Dict, Optional, Set, Tuple, TypeVar
+
+import anyio
+from starlette.requests import ClientDisconnect
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+T = TypeVar("T")
+
+# 取消原因
+CANCEL_CLIENT_DISCONNECT = "client_disconnect"
+CANCEL_SHUTDOWN = "shutdown"
+TIMEOUT_CONNECT = "connect_timeout"
+TIMEOUT_FIRST_BYTE = "first_byte_timeout"
+TIMEOUT_IDLE = "idle_timeout"
+TIMEOUT_TOTAL = "total_timeout"
+
+_FIELDS = ("connect", "first_byte", "idle", "total")
+
+
+class StreamTimeouts:
+    """单个模型的超时配置（秒），0表示不限制"""
+
+    __slots__ = _FIELDS
+
+    def __init__(self, connect: float = 10.0, first_byte: float = 0.0, idle: float = 0.0, total: float = 0.0):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.idle = idle
+        self.total = total
+
+    def override(self, spec: str) -> "StreamTimeouts":
+        """在当前配置基础上覆盖：connect:5,first_byte:60,idle:30,total:600"""
+        values = {field: getattr(self, field) for field in _FIELDS}
+        for item in spec.split(","):
+            item = item.strip()
+            if ":" not in item:
+                continue
+            field, value = item.split(":", 1)
+            field = field.strip()
+            if field not in values:
+                raise ValueError(f"unknown timeout field: {field}")
+            values[field] = float(value)
+        return StreamTimeouts(**values)
+
+    @property
+    def watched(self) -> bool:
+        return self.first_byte > 0 or self.idle > 0 or self.total > 0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {field: getattr(self, field) for field in _FIELDS}
+
+
+class UpstreamTimeout(Exception):
+    """非流式请求超时"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def timeout_message(reason: str, timeouts: StreamTimeouts) -> str:
+    """超时错误事件的说明文字"""
+    if reason == TIMEOUT_CONNECT:
+        return f"Upstream connect timeout ({timeouts.connect:g}s)"
+    if reason == TIMEOUT_FIRST_BYTE:
+        return f"Upstream did not start responding within {timeouts.first_byte:g}s"
+    if reason == TIMEOUT_IDLE:
+        return f"Upstream stream stalled: no data for {timeouts.idle:g}s"
+    return f"Upstream response exceeded the total timeout ({timeouts.total:g}s)"
+
+
+def parse_timeouts(spec: str, default: StreamTimeouts) -> Dict[str, StreamTimeouts]:
+    """解析按模型的超时配置：model1=first_byte:120,idle:30;model2=total:600；未列出的字段使用默认值"""
+    timeouts: Dict[str, StreamTimeouts] = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if "=" not in item:
+            continue
+        model, fields = item.split("=", 1)
+        timeouts[model.strip()] = default.override(fields)
+    return timeouts
+
+
+class StreamWatchdog:
+    """
+    一个流的首字节/空闲/总时长截止时间。
+    只在wait_started和wait_finished之间（即等待上游时）到期才取消等待中的任务；
+    下游写出阻塞时不计入空闲超时。定时器按最近的截止时间惰性重新调度，触发次数约为 时长/空闲超时，
+    定时器触发时不在等待上游则停止，由下一次wait_started重新调度
+    """
+
+    __slots__ = ("timeouts", "started", "first_byte_received", "expired", "_waiting_since", "_task", "_handle")
+
+    def __init__(self, timeouts: StreamTimeouts):
+        self.timeouts = timeouts
+        self.started = time.monotonic()
+        self.first_byte_received = False
+        self.expired: Optional[str] = None
+        self._waiting_since: Optional[float] = None
+        self._task: Optional["asyncio.Task[Any]"] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def wait_started(self) -> None:
+        self._waiting_since = time.monotonic()
+        self._task = asyncio.current_task()
+        if self._handle is None:
+            self._schedule(self._waiting_since)
+
+    def wait_finished(self) -> None:
+        self._waiting_since = None
+
+    def first_byte(self) -> None:
+        """收到首个data行：之后按空闲超时计时（定时器在下一次等待时按新的截止时间调度）"""
+        self.first_byte_received = True
+        self.close()
+
+    def _deadline(self, now: float) -> Tuple[float, str]:
+        """当前状态下最近的截止时间和对应的超时原因"""
+        timeouts = self.timeouts
+        deadline, reason = float("inf"), ""
+        if timeouts.total > 0:
+            deadline, reason = self.started + timeouts.total, TIMEOUT_TOTAL
+        waiting_since = self._waiting_since if self._waiting_since is not None else now
+        if not self.first_byte_received:
+            if timeouts.first_byte > 0 and self.started + timeouts.first_byte < deadline:
+                deadline, reason = self.started + timeouts.first_byte, TIMEOUT_FIRST_BYTE
+        elif timeouts.idle > 0 and waiting_since + timeouts.idle < deadline:
+            deadline, reason = waiting_since + timeouts.idle, TIMEOUT_IDLE
+        return deadline, reason
+
+    def _schedule(self, now: float) -> None:
+        deadline, _ = self._deadline(now)
+        if deadline != float("inf"):
+            self._handle = asyncio.get_event_loop().call_later(max(0.0, deadline - now), self._check)
+
+    def _check(self) -> None:
+        self._handle = None
+        if self.expired is not None or self._waiting_since is None or self._task is None:
+            # 不在等待上游：下一次wait_started时重新调度
+            return
+        now = time.monotonic()
+        deadline, reason = self._deadline(now)
+        if deadline <= now:
+            self.expired = reason
+            self._task.cancel()
+            return
+        self._schedule(now)
+
+    async def watch(self, source: AsyncIterable[T]) -> AsyncGenerator[T, None]:
+        """迭代上游数据源，等待每个元素期间计入超时"""
+        iterator = source.__aiter__()
+        while True:
+            self.wait_started()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                self._waiting_since = None
+            yield item
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class StreamDrain:
+    """
+    进行中的流的登记表：每个流开始时登记迭代它的任务，结束时注销。
+    begin(timeout)开始排空（由服务器在停止接受新连接时调用），timeout秒后取消仍在进行的流
+    """
+
+    def __init__(self) -> None:
+        self.draining = False
+        self.expired = False
+        self._tasks: Set["asyncio.Task[Any]"] = set()
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self.cut = 0
+
+    def add(self) -> Optional["asyncio.Task[Any]"]:
+        """登记当前任务，返回值交给discard"""
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.add(task)
+        return task
+
+    def discard(self, task: Optional["asyncio.Task[Any]"]) -> None:
+        if task is not None:
+            self._tasks.discard(task)
+
+    def begin(self, timeout: float) -> None:
+        if self.draining:
+            return
+        self.draining = True
+        self._handle = asyncio.get_event_loop().call_later(max(0.0, timeout), self._expire)
+
+    def _expire(self) -> None:
+        self._handle = None
+        self.expired = True
+        self.cut += len(self._tasks)
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"draining": self.draining, "active_streams": len(self._tasks), "cut_streams": self.cut}
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """
+    流式响应：发送的同时监听http.disconnect（Starlette只在ASGI spec<2.4时监听），
+    结束后（包括客户端断开）显式关闭响应体生成器，而不是等待垃圾回收
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            async with anyio.create_task_group() as task_group:
+
+                async def wrap(func: Any) -> None:
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wrap, partial(self.stream_response, send))
+                await wrap(partial(self.listen_for_disconnect, receive))
+        except OSError:
+            raise ClientDisconnect()
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                with anyio.CancelScope(shield=True):
+                    await aclose()
+
+        if self.background is not None:
+            await self.background()
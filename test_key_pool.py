@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Key池令牌桶的回归测试（python test_key_pool.py，或用pytest运行）
+"""
+
+import asyncio
+import time
+
+from key_pool import KeyPool, TokenBucket
+
+
+def test_sync_restarts_refill_clock():
+    """上游报告的剩余额度是此刻的值：长请求结束后校准，不能再把请求期间的时间算作恢复"""
+    bucket = TokenBucket(60)
+    bucket.take(1)
+    # 30秒前取出令牌，期间没有refill
+    bucket.updated -= 30
+    bucket.sync(60, 10, None)
+    bucket.refill(time.monotonic())
+    assert 10 <= bucket.tokens < 10.5, bucket.tokens
+
+
+def test_sync_subtracts_other_in_flight_estimates():
+    """同一Key上其他进行中请求的预估token数还没有计入上游报告的剩余额度"""
+    pool = KeyPool(["sk-a"], tpm=10000)
+    # 两个并发请求各预估1000 token
+    key = asyncio.run(pool.acquire(1000))
+    assert asyncio.run(pool.acquire(1000)) is key
+    pool.update(key, {"x-ratelimit-limit-tokens": "10000", "x-ratelimit-remaining-tokens": "7000"}, 200, 1000)
+    assert key.in_flight == 1
+    assert key.pending_tokens == 1000
+    assert 6000 <= key.tokens.tokens < 6010, key.tokens.tokens
+
+
+def test_release_returns_estimate():
+    pool = KeyPool(["sk-a"], tpm=10000)
+    key = asyncio.run(pool.acquire(500))
+    pool.release(key, 500)
+    assert key.in_flight == 0
+    assert key.pending_tokens == 0
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE帧编码器的等价性测试（python test_sse_encoder.py，或用pytest运行）
+每个模板函数的输出与原来的 f"data: {json.dumps(event)}\\n\\n" 逐字节比较，
+文本覆盖引号、反斜杠、控制字符、U+2028/U+2029、非BMP字符和随机组合
+"""
+
+import importlib
+import json
+import random
+import sys
+
+import sse_encoder
+
+SAMPLES = [
+    "",
+    "plain ascii",
+    'quote " and \\ backslash \\" mixed',
+    "newline\n tab\t cr\r formfeed\f backspace\b",
+    "".join(chr(code) for code in range(0x20)) + "\x7f",
+    "line separator \u2028 paragraph separator \u2029 nbsp \u00a0 bom \ufeff",
+    "中文 函数调用 日本語 한국어",
+    "emoji \U0001F600 math \U0001D49C surrogate-range \U00010000 \U0010FFFF",
+    "</script><!-- & ' éñ",
+]
+
+_ALPHABET = ['"', "\\", "/", "\n", "\r", "\t", "\x00", "\x1f", "\u2028", "\u2029", "é", "中", "\U0001F600", "a", " "]
+
+
+def _random_samples(count: int = 300, seed: int = 3):
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice(_ALPHABET) for _ in range(rng.randint(1, 40)))
+        for _ in range(count)
+    ]
+
+
+def _old(event, **kwargs) -> bytes:
+    """改动前main.py的写法"""
+    return f"data: {json.dumps(event, **kwargs)}\n\n".encode("utf-8")
+
+
+def _cases(text: str):
+    """(模板函数的输出, 原来的事件dict)"""
+    yield sse_encoder.text_delta(3, text), {
+        "type": "content_block_delta", "index": 3, "delta": {"type": "text_delta", "text": text}
+    }
+    yield sse_encoder.thinking_delta(0, text), {
+        "type": "content_block_delta", "index": 0, "delta": {"type": "thinking_delta", "thinking": text}
+    }
+    yield sse_encoder.message_start(text, text, 12, 0), {
+        "type": "message_start",
+        "message": {
+            "id": text, "type": "message", "role": "assistant", "content": [], "model": text,
+            "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 12, "output_tokens": 0},
+        },
+    }
+    yield sse_encoder.message_delta(text), {
+        "type": "message_delta", "delta": {"stop_reason": text}, "message": {"stop_reason": text}
+    }
+    yield sse_encoder.message_delta(text, include_stop_sequence=True), {
+        "type": "message_delta", "delta": {"stop_reason": text},
+        "message": {"stop_reason": text, "stop_sequence": None},
+    }
+    usage = {"input_tokens": 5, "output_tokens": 7}
+    yield sse_encoder.message_delta(text, include_stop_sequence=True, usage=usage), {
+        "type": "message_delta", "delta": {"stop_reason": text},
+        "message": {"stop_reason": text, "stop_sequence": None}, "usage": usage,
+    }
+    yield sse_encoder.error_event(text, text), {"type": "error", "error": {"type": text, "message": text}}
+
+
+def test_fixed_frames_match_old_output():
+    for index in (0, 1, 12):
+        for block_type in ("text", "thinking"):
+            assert sse_encoder.content_block_start(index, block_type) == _old({
+                "type": "content_block_start", "index": index, "content_block": {"type": block_type, block_type: ""}
+            })
+        assert sse_encoder.content_block_stop(index) == _old({"type": "content_block_stop", "index": index})
+    assert sse_encoder.DONE == b"data: [DONE]\n\n"
+
+
+def test_templates_match_old_output_byte_for_byte():
+    """原来的输出使用json.dumps的默认参数（ensure_ascii=True）"""
+    for text in SAMPLES + _random_samples():
+        for frame, event in _cases(text):
+            assert frame == _old(event), (text, frame)
+            assert frame == _old(event, ensure_ascii=True)
+
+
+def test_templates_decode_like_non_ascii_output():
+    """ensure_ascii=False的输出字节不同（不转义非ASCII），但解码后的事件相同"""
+    for text in SAMPLES + _random_samples():
+        for frame, event in _cases(text):
+            assert frame.isascii()
+            reference = _old(event, ensure_ascii=False)
+            assert json.loads(frame[6:]) == json.loads(reference[6:].decode("utf-8")) == event
+
+
+def _backends():
+    backends = [("json", json.loads)]
+    try:
+        import orjson
+        backends.append(("orjson", orjson.loads))
+    except ImportError:
+        pass
+    try:
+        import msgspec
+        backends.append(("msgspec", msgspec.json.decode))
+    except ImportError:
+        pass
+    return backends
+
+
+def test_every_backend_loads_frames_identically():
+    for text in SAMPLES + _random_samples():
+        for frame, event in _cases(text):
+            payload = frame[6:].rstrip(b"\n")
+            for name, loads in _backends():
+                assert loads(payload) == event, (name, text)
+
+
+def test_loads_falls_back_between_backends():
+    """orjson不可用时使用msgspec，都不可用时使用标准库json；各后端的解码错误都在DECODE_ERRORS中"""
+    saved = {name: sys.modules.get(name) for name in ("orjson", "msgspec")}
+    try:
+        for blocked, expected in (((), None), (("orjson",), "msgspec"), (("orjson", "msgspec"), "json")):
+            for name in blocked:
+                sys.modules[name] = None
+            module = importlib.reload(sse_encoder)
+            if expected is not None:
+                assert module.JSON_BACKEND == expected
+            for text in SAMPLES:
+                for frame, event in _cases(text):
+                    assert module.loads(frame[6:].rstrip(b"\n")) == event
+            try:
+                module.loads(b'{"broken": ')
+            except module.DECODE_ERRORS:
+                pass
+            else:
+                raise AssertionError(f"{module.JSON_BACKEND} accepted invalid JSON")
+            for name in blocked:
+                sys.modules.pop(name)
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        importlib.reload(sse_encoder)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: ok")
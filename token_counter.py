@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+本地token计数
+按映射后的OpenAI模型选择分词器（可选依赖tiktoken / tokenizers，只从本地文件加载），
+不可用时回退到按字节的估算。每条消息的计数按内容哈希缓存，
+对不断增长的对话重复计数时只需要对新消息分词。
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+# OpenAI聊天格式的每条消息开销和回复引导开销（近似值）
+MESSAGE_OVERHEAD = 4
+REPLY_PRIMING = 3
+# 每张图片/文档的估算值：上游缩放后最大约1.15百万像素，按 宽*高/750 计约1600
+IMAGE_TOKENS = 1600
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    按字节估算token数：ASCII文本约4字节一个token，
+    非ASCII字符（中日韩文字等）按每个字符一个token计
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", errors="ignore"))
+    other_chars = len(text) - ascii_chars
+    return (ascii_chars + 3) // 4 + other_chars
+
+
+def parse_tokenizers(spec: str) -> Dict[str, str]:
+    """解析TOKENIZERS配置：model=tiktoken:cl100k_base;model2=hf:/path/to/tokenizer.json"""
+    tokenizers: Dict[str, str] = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if "=" not in item:
+            continue
+        model, tokenizer = item.split("=", 1)
+        tokenizers[model.strip()] = tokenizer.strip()
+    return tokenizers
+
+
+def load_tokenizer(spec: str) -> Optional[Callable[[str], int]]:
+    """
+    加载分词器，返回计数函数；依赖未安装或本地文件不可用时返回None。
+    tiktoken:<encoding> 需要本地已缓存编码文件（TIKTOKEN_CACHE_DIR），hf:<path> 读取本地tokenizer.json
+    """
+    kind, _, name = spec.partition(":")
+    try:
+        if kind == "tiktoken":
+            import tiktoken
+
+            encoding = tiktoken.get_encoding(name)
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        if kind == "hf":
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(name)
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+    except Exception:
+        return None
+    return None
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and all(isinstance(part, dict) for part in content):
+        # content parts：只对文本分词，图片按IMAGE_TOKENS另计（base64数据不是文本）
+        return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return json.dumps(content, ensure_ascii=False, sort_keys=True)
+
+
+def _image_count(message: Dict[str, Any]) -> int:
+    content = message.get("content")
+    if not isinstance(content, list):
+        return 0
+    return sum(1 for part in content if isinstance(part, dict) and part.get("type") == "image_url")
+
+
+class TokenCounter:
+    """按模型的token计数器，带按消息内容哈希的LRU缓存"""
+
+    def __init__(self, tokenizers: Optional[Dict[str, str]] = None, max_entries: int = 50000):
+        self.tokenizer_specs = dict(tokenizers or {})
+        self.max_entries = max_entries
+        self._tokenizers: Dict[str, Optional[Callable[[str], int]]] = {}
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def _tokenizer(self, model: str) -> Optional[Callable[[str], int]]:
+        """模型的分词器，首次使用时加载；*为未列出模型的默认分词器"""
+        if model not in self._tokenizers:
+            spec = self.tokenizer_specs.get(model) or self.tokenizer_specs.get("*")
+            tokenizer = load_tokenizer(spec) if spec else None
+            if spec and tokenizer is None:
+                self.fallbacks += 1
+            self._tokenizers[model] = tokenizer
+        return self._tokenizers[model]
+
+    def count_text(self, model: str, text: str) -> int:
+        tokenizer = self._tokenizer(model)
+        return tokenizer(text) if tokenizer is not None else estimate_tokens(text)
+
+    def count_message(self, model: str, message: Dict[str, Any]) -> int:
+        """单条OpenAI格式消息的token数（含消息开销），文本部分按(模型, 角色, 内容)哈希缓存"""
+        images = _image_count(message) * IMAGE_TOKENS
+        text = _message_text(message)
+        role = message.get("role", "")
+        key = hashlib.blake2b(f"{model}\0{role}\0{text}".encode("utf-8"), digest_size=16).digest()
+        count = self._cache.get(key)
+        if count is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return count + images
+        self.misses += 1
+        count = self.count_text(model, text) + self.count_text(model, role) + MESSAGE_OVERHEAD
+        self._cache[key] = count
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return count + images
+
+    def count_messages(self, model: str, messages: List[Dict[str, Any]]) -> int:
+        """整段对话的token数"""
+        return sum(self.count_message(model, message) for message in messages) + REPLY_PRIMING
+
+    def stats(self) -> Dict[str, Any]:
+        """计数器统计，用于/health展示"""
+        return {
+            "tokenizers": {
+                model: ("loaded" if tokenizer is not None else "estimate")
+                for model, tokenizer in self._tokenizers.items()
+            },
+            "cache_entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+        }
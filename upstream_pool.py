@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+上游连接池
+在应用生命周期内共享一个httpx.AsyncClient，复用到OPENAI_API_URL的TCP/TLS连接
+"""
+
+import asyncio
+from typing import Any, Dict, Optional
+
+import httpx
+
+
+def http2_available() -> bool:
+    """检查是否安装了HTTP/2所需的h2依赖"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class UpstreamClientPool:
+    """共享的上游连接池，由FastAPI lifespan负责创建和关闭"""
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        timeout: float = 300.0,
+        connect_timeout: float = 10.0,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        # 每个上游预热成功的连接数
+        self.prewarmed_connections: Dict[str, int] = {}
+
+    def start(self, logger: Any = None) -> httpx.AsyncClient:
+        """创建共享客户端（HTTP/2需要h2依赖，缺失时回退到HTTP/1.1，回退通过logger记录警告）"""
+        if self._client is not None:
+            return self._client
+
+        if self.http2 and not http2_available():
+            if logger is not None:
+                logger.warning("[连接池] 未安装h2依赖，HTTP/2已禁用，回退到HTTP/1.1")
+            self.http2 = False
+
+        self._client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+        return self._client
+
+    async def prewarm(self, name: str, url: str, count: int, headers: Optional[Dict[str, str]] = None) -> int:
+        """启动时预先建立到上游name的连接，避免首批请求承担DNS/TCP/TLS握手开销；多个上游可以并发预热"""
+        if count <= 0:
+            return 0
+        client = self.client
+
+        async def _touch() -> bool:
+            try:
+                # 只需要建立连接，响应内容和状态码不重要
+                response = await client.get(url, headers=headers)
+                await response.aclose()
+                return True
+            except httpx.HTTPError:
+                return False
+
+        # HTTP/2下所有请求复用同一连接，预热一次即可
+        results = await asyncio.gather(*[_touch() for _ in range(1 if self.http2 else count)])
+        warmed = self.prewarmed_connections[name] = sum(1 for ok in results if ok)
+        return warmed
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取共享客户端，未启动时自动创建"""
+        if self._client is None:
+            return self.start()
+        return self._client
+
+    async def aclose(self) -> None:
+        """关闭共享客户端，释放所有连接"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        """连接池状态，用于/health展示"""
+        stats: Dict[str, Any] = {
+            "started": self._client is not None,
+            "http2": self.http2,
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive_connections,
+            "keepalive_expiry": self.keepalive_expiry,
+            "prewarmed_connections": dict(self.prewarmed_connections),
+        }
+        if self._client is None:
+            return stats
+
+        # httpx没有公开连接池统计接口，这里读取底层httpcore连接池
+        pool = getattr(self._client._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        stats.update({
+            "connections": len(connections),
+            "idle_connections": sum(1 for conn in connections if conn.is_idle()),
+            "active_connections": sum(
+                1 for conn in connections if not conn.is_idle() and not conn.is_closed()
+            ),
+        })
+        return stats
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+多上游路由
+每个映射后的OpenAI模型对应一组上游（各自的URL和API Key），
+按最少进行中请求数或首token时间（TTFT）的EWMA选择上游；
+连续失败/超时达到阈值的上游由熔断器摘除，后台探测恢复后重新接入。
+带亲和键的请求（同一会话）按最高随机权重哈希固定到组内同一个上游，以复用上游的前缀缓存；
+该上游的负载超过组内平均负载的一定倍数时退回普通负载均衡（有界负载）。
+"""
+
+import asyncio
+import hashlib
+import math
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from key_pool import KeyPool
+
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+STRATEGY_EWMA_TTFT = "ewma_ttft"
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# 这些状态码视为上游故障：计入熔断器，并在还有候选上游时切换重试
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_upstreams(spec: str) -> Dict[str, Dict[str, str]]:
+    """
+    解析UPSTREAMS配置：name=url|api_key;name2=url2|api_key2
+    api_key可省略（如不需要认证的vLLM副本），多个Key用逗号分隔（组成该上游的Key池）
+    """
+    upstreams: Dict[str, Dict[str, str]] = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        url, _, api_key = value.partition("|")
+        upstreams[name.strip()] = {"url": url.strip().rstrip("/"), "api_key": api_key.strip()}
+    return upstreams
+
+
+def parse_routes(spec: str) -> Dict[str, List[str]]:
+    """解析UPSTREAM_ROUTES配置：model=name1,name2;*=name3（*为未列出模型的默认组）"""
+    routes: Dict[str, List[str]] = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if "=" not in item:
+            continue
+        model, names = item.split("=", 1)
+        routes[model.strip()] = [name.strip() for name in names.split(",") if name.strip()]
+    return routes
+
+
+class Upstream:
+    """单个上游：负载计数、TTFT EWMA、熔断器状态和API Key池"""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: str = "",
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        ewma_alpha: float = 0.3,
+        keys: Optional[KeyPool] = None,
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        # api_key可以是逗号分隔的多个Key；单个Key的场景（探测、预热）使用第一个
+        self.keys = keys if keys is not None else KeyPool(KeyPool.split(api_key))
+        self.api_key = self.keys.keys[0].key
+        self.chat_completions_url = f"{self.base_url}/chat/completions"
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+
+        self.outstanding = 0
+        self.ewma_ttft: Optional[float] = None
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def available(self, now: float) -> bool:
+        """是否可以接收请求；熔断冷却期过后进入半开状态，只放行一个试探请求"""
+        if self.state == STATE_OPEN and now - self.opened_at >= self.cooldown:
+            self.state = STATE_HALF_OPEN
+        if self.state == STATE_HALF_OPEN:
+            return self.outstanding == 0
+        return self.state == STATE_CLOSED
+
+    def score(self, strategy: str) -> float:
+        """负载评分，越小越优先；还没有TTFT样本的上游优先获得流量"""
+        if strategy == STRATEGY_EWMA_TTFT:
+            return (self.ewma_ttft or 0.0) * (self.outstanding + 1)
+        return float(self.outstanding)
+
+    def acquire(self) -> float:
+        """开始一次请求，返回开始时间"""
+        self.outstanding += 1
+        self.requests += 1
+        return time.monotonic()
+
+    def release(self, success: Optional[bool], ttft: Optional[float] = None) -> None:
+        """结束一次请求：更新TTFT EWMA和熔断器；success为None（如客户端断开）时不影响熔断器"""
+        self.outstanding -= 1
+        if ttft is not None:
+            if self.ewma_ttft is None:
+                self.ewma_ttft = ttft
+            else:
+                self.ewma_ttft += self.ewma_alpha * (ttft - self.ewma_ttft)
+        if success is None:
+            return
+        if success:
+            self.consecutive_failures = 0
+            self.state = STATE_CLOSED
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self) -> None:
+        """熔断：摘除该上游，等待冷却或探测成功"""
+        if self.state != STATE_OPEN:
+            self.ejections += 1
+        self.state = STATE_OPEN
+        self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.base_url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "ewma_ttft_ms": round(self.ewma_ttft * 1000, 1) if self.ewma_ttft is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "key_pool": self.keys.stats(),
+        }
+
+
+class UpstreamRouter:
+    """按映射后的模型名选择上游，并在后台探测被熔断的上游"""
+
+    def __init__(
+        self,
+        upstreams: Dict[str, Upstream],
+        routes: Dict[str, List[str]],
+        strategy: str = STRATEGY_LEAST_OUTSTANDING,
+        max_attempts: int = 2,
+        probe_interval: float = 10.0,
+        affinity_load_factor: float = 1.5,
+    ):
+        if strategy not in (STRATEGY_LEAST_OUTSTANDING, STRATEGY_EWMA_TTFT):
+            raise ValueError(f"Unknown upstream balance strategy: {strategy}")
+        self.upstreams = upstreams
+        self.strategy = strategy
+        self.max_attempts = max(1, max_attempts)
+        self.probe_interval = probe_interval
+        self.affinity_load_factor = affinity_load_factor
+        self.affinity_requests = 0
+        self.affinity_overflows = 0
+        self._default = list(upstreams.values())
+        self._routes: Dict[str, List[Upstream]] = {}
+        for model, names in routes.items():
+            unknown = [name for name in names if name not in upstreams]
+            if unknown:
+                raise ValueError(f"Unknown upstream(s) in route '{model}': {', '.join(unknown)}")
+            if model == "*":
+                self._default = [upstreams[name] for name in names]
+            else:
+                self._routes[model] = [upstreams[name] for name in names]
+        self._probe_task: Optional["asyncio.Task[None]"] = None
+
+    def group(self, model: str) -> List[Upstream]:
+        """模型对应的上游组"""
+        return self._routes.get(model, self._default)
+
+    def plan(
+        self, model: str, exclude: Optional[Upstream] = None, affinity: Optional[str] = None
+    ) -> List[Upstream]:
+        """
+        本次请求依次尝试的上游（最多max_attempts个）：可用上游按负载评分排序，
+        同分时随机打散；所有上游都被熔断时退化为尝试最早被摘除的上游。
+        exclude用于对冲请求避开主请求的上游（组内只有这一个上游时仍然使用它）；
+        affinity为粘性路由的键，对应的上游负载未超限时排在第一位
+        """
+        group = self.group(model)
+        if exclude is not None and len(group) > 1:
+            group = [upstream for upstream in group if upstream is not exclude]
+        now = time.monotonic()
+        candidates = [upstream for upstream in group if upstream.available(now)]
+        if not candidates:
+            return sorted(group, key=lambda upstream: upstream.opened_at)[:1]
+        if len(candidates) > 1:
+            random.shuffle(candidates)
+            candidates.sort(key=lambda upstream: upstream.score(self.strategy))
+            if affinity is not None and self.affinity_load_factor > 0:
+                preferred = self._preferred(candidates, affinity)
+                if preferred is not None and preferred is not candidates[0]:
+                    candidates.remove(preferred)
+                    candidates.insert(0, preferred)
+        return candidates[:self.max_attempts]
+
+    def _preferred(self, candidates: List[Upstream], affinity: str) -> Optional[Upstream]:
+        """
+        最高随机权重哈希：上游增减时只有落在该上游上的会话会迁移。
+        有界负载：加上本次请求后不超过 平均负载 × affinity_load_factor（向上取整）
+        """
+        self.affinity_requests += 1
+        preferred = max(
+            candidates,
+            key=lambda upstream: hashlib.sha1(f"{affinity}:{upstream.name}".encode("utf-8")).digest()
+        )
+        total = sum(upstream.outstanding for upstream in candidates) + 1
+        capacity = math.ceil(self.affinity_load_factor * total / len(candidates))
+        if preferred.outstanding + 1 > capacity:
+            self.affinity_overflows += 1
+            return None
+        return preferred
+
+    # ---- 后台健康探测 ----
+
+    def start_probes(self, client: httpx.AsyncClient) -> None:
+        """启动后台探测任务（probe_interval<=0时不探测，只依赖冷却时间恢复）"""
+        if self.probe_interval > 0 and self._probe_task is None:
+            self._probe_task = asyncio.ensure_future(self._probe_loop(client))
+
+    async def stop_probes(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    async def _probe_loop(self, client: httpx.AsyncClient) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            ejected = [upstream for upstream in self.upstreams.values() if upstream.state == STATE_OPEN]
+            if ejected:
+                await asyncio.gather(*[self.probe(client, upstream) for upstream in ejected])
+
+    @staticmethod
+    async def probe(client: httpx.AsyncClient, upstream: Upstream) -> bool:
+        """探测被摘除的上游（GET /models），成功后进入半开状态接收试探请求"""
+        headers = {"Authorization": f"Bearer {upstream.api_key}"} if upstream.api_key else None
+        try:
+            response = await client.get(f"{upstream.base_url}/models", headers=headers, timeout=5.0)
+            healthy = response.status_code < 500
+        except httpx.HTTPError:
+            healthy = False
+        if upstream.state != STATE_OPEN:
+            return healthy
+        if healthy:
+            upstream.state = STATE_HALF_OPEN
+        else:
+            upstream.opened_at = time.monotonic()
+        return healthy
+
+    def stats(self) -> Dict[str, Any]:
+        """路由状态，用于/health展示"""
+        return {
+            "strategy": self.strategy,
+            "max_attempts": self.max_attempts,
+            "affinity": {
+                "load_factor": self.affinity_load_factor,
+                "requests": self.affinity_requests,
+                "overflows": self.affinity_overflows,
+            },
+            "routes": {model: [u.name for u in group] for model, group in self._routes.items()},
+            "default_route": [upstream.name for upstream in self._default],
+            "upstreams": {name: upstream.stats() for name, upstream in self.upstreams.items()},
+        }
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+用量账本
+按 (时间桶, API Key, 请求模型, 映射模型) 在内存中累加请求数、错误数、token数和耗时，
+后台任务定期把累加结果批量写入本地SQLite（WAL模式，UPSERT累加），写入在专用线程中执行：
+请求路径上只有一次字典更新，不做任何I/O。
+API Key只保存哈希前缀，不落盘原文；多个worker可以共享同一个数据库文件。
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+ANONYMOUS = "anonymous"
+GROUP_FIELDS = ("api_key", "model", "mapped_model")
+
+# 累加字段：requests, errors, input_tokens, output_tokens, cache_read_tokens, latency_ms, ttft_ms, ttft_count
+_FIELDS = 8
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    bucket INTEGER NOT NULL,
+    api_key TEXT NOT NULL,
+    model TEXT NOT NULL,
+    mapped_model TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    cache_read_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL NOT NULL DEFAULT 0,
+    ttft_ms REAL NOT NULL DEFAULT 0,
+    ttft_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, api_key, model, mapped_model)
+)
+"""
+
+_UPSERT = """
+INSERT INTO usage (bucket, api_key, model, mapped_model, requests, errors, input_tokens, output_tokens,
+                   cache_read_tokens, latency_ms, ttft_ms, ttft_count)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (bucket, api_key, model, mapped_model) DO UPDATE SET
+    requests = requests + excluded.requests,
+    errors = errors + excluded.errors,
+    input_tokens = input_tokens + excluded.input_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    cache_read_tokens = cache_read_tokens + excluded.cache_read_tokens,
+    latency_ms = latency_ms + excluded.latency_ms,
+    ttft_ms = ttft_ms + excluded.ttft_ms,
+    ttft_count = ttft_count + excluded.ttft_count
+"""
+
+Key = Tuple[int, str, str, str]
+
+
+def account_id(headers: Any) -> str:
+    """客户端API Key（x-api-key或Authorization: Bearer）的哈希前缀，没有时为anonymous"""
+    key = headers.get("x-api-key") or ""
+    if not key:
+        authorization = headers.get("authorization") or ""
+        if authorization.lower().startswith("bearer "):
+            key = authorization[7:].strip()
+    if not key:
+        return ANONYMOUS
+    return "key-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+class UsageLedger:
+    """
+    内存累加 + 批量落盘的用量账本；path为空表示关闭。
+    所有SQLite操作在同一个单线程执行器中串行执行（连接只在该线程中使用）
+    """
+
+    def __init__(
+        self,
+        path: str,
+        bucket_seconds: int = 60,
+        flush_interval: float = 5.0,
+        max_pending: int = 10000,
+        retention_days: float = 90.0,
+    ):
+        self.path = path
+        self.bucket_seconds = max(1, bucket_seconds)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retention_days = retention_days
+        self._pending: Dict[Key, List[float]] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_prune = 0.0
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    # ---- 请求路径 ----
+
+    def record(
+        self,
+        api_key: str,
+        model: str,
+        mapped_model: str,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        cache_read_tokens: int = 0,
+        latency: float = 0.0,
+        ttft: Optional[float] = None,
+        error: bool = False,
+    ) -> None:
+        """记录一次请求（只更新内存中的累加值）"""
+        if not self.path:
+            return
+        key = (int(time.time()) // self.bucket_seconds * self.bucket_seconds, api_key, model, mapped_model)
+        row = self._pending.get(key)
+        if row is None:
+            row = self._pending[key] = [0.0] * _FIELDS
+            if len(self._pending) >= self.max_pending and self._wakeup is not None:
+                self._wakeup.set()
+        row[0] += 1
+        if error:
+            row[1] += 1
+        row[2] += input_tokens
+        row[3] += output_tokens
+        row[4] += cache_read_tokens
+        row[5] += latency * 1000
+        if ttft is not None:
+            row[6] += ttft * 1000
+            row[7] += 1
+        self.recorded += 1
+
+    # ---- 后台写入 ----
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(_SCHEMA)
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _write(self, rows: Dict[Key, List[float]]) -> None:
+        connection = self._connect()
+        with connection:
+            connection.executemany(_UPSERT, [
+                key + (int(row[0]), int(row[1]), int(row[2]), int(row[3]), int(row[4]), row[5], row[6], int(row[7]))
+                for key, row in rows.items()
+            ])
+        now = time.time()
+        if self.retention_days > 0 and now - self._last_prune > 3600:
+            self._last_prune = now
+            with connection:
+                connection.execute("DELETE FROM usage WHERE bucket < ?", (int(now - self.retention_days * 86400),))
+
+    async def _run(self, func: Any, *args: Any) -> Any:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage-ledger")
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    async def flush(self) -> None:
+        """把当前累加值交给写入线程；写入失败时合并回内存，下次重试"""
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, {}
+        try:
+            await self._run(self._write, rows)
+        except (sqlite3.Error, OSError) as e:
+            self.flush_errors += 1
+            self.last_error = str(e)
+            for key, row in rows.items():
+                current = self._pending.setdefault(key, [0.0] * _FIELDS)
+                for index, value in enumerate(row):
+                    current[index] += value
+            return
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    @property
+    def wakeup(self) -> asyncio.Event:
+        # Python 3.8的Event创建时绑定事件循环，在启动后再创建
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def start(self) -> None:
+        if self.path and self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def stop(self) -> None:
+        """停止后台任务并写出剩余的累加值"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.path:
+            await self.flush()
+        if self._executor is not None:
+            if self._connection is not None:
+                await self._run(self._connection.close)
+                self._connection = None
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    # ---- 查询 ----
+
+    def _query(
+        self, since: int, until: int, group_by: Tuple[str, ...], interval: int, api_key: Optional[str]
+    ) -> List[Tuple[Any, ...]]:
+        columns = list(group_by)
+        if interval > 0:
+            columns.insert(0, f"(bucket / {interval}) * {interval}")
+        where = "bucket >= ? AND bucket < ?"
+        params: List[Any] = [since, until]
+        if api_key is not None:
+            where += " AND api_key = ?"
+            params.append(api_key)
+        select = ", ".join(columns + [
+            "SUM(requests)", "SUM(errors)", "SUM(input_tokens)", "SUM(output_tokens)", "SUM(cache_read_tokens)",
+            "SUM(latency_ms)", "SUM(ttft_ms)", "SUM(ttft_count)",
+        ])
+        sql = f"SELECT {select} FROM usage WHERE {where}"
+        if columns:
+            sql += " GROUP BY " + ", ".join(columns)
+        return self._connect().execute(sql, params).fetchall()
+
+    async def query(
+        self,
+        since: float,
+        until: float,
+        group_by: Tuple[str, ...] = GROUP_FIELDS,
+        interval: int = 0,
+        api_key: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        按时间范围汇总用量；interval>0时按该秒数分段。结果包含尚未落盘的累加值：
+        查询提交时复制内存中的累加值，此前交给写入线程的数据由线程串行保证先于查询写入
+        """
+        unknown = [field for field in group_by if field not in GROUP_FIELDS]
+        if unknown:
+            raise ValueError(f"group_by: unknown field(s) {', '.join(unknown)}; expected {', '.join(GROUP_FIELDS)}")
+        start, end = int(since), int(until)
+        pending = [
+            (key, list(row)) for key, row in self._pending.items()
+            if start <= key[0] < end and (api_key is None or key[1] == api_key)
+        ]
+        rows = await self._run(self._query, start, end, group_by, interval, api_key)
+
+        totals: Dict[Tuple[Any, ...], List[float]] = {}
+        width = len(group_by) + (1 if interval > 0 else 0)
+        for row in rows:
+            if row[width] is None:
+                continue
+            totals[tuple(row[:width])] = [value or 0 for value in row[width:]]
+        for key, values in pending:
+            fields = dict(zip(("bucket",) + GROUP_FIELDS, key))
+            group = tuple(fields[field] for field in group_by)
+            if interval > 0:
+                group = (key[0] // interval * interval,) + group
+            current = totals.setdefault(group, [0.0] * _FIELDS)
+            for index, value in enumerate(values):
+                current[index] += value
+
+        result = []
+        for group, values in sorted(totals.items(), key=lambda item: tuple(str(part) for part in item[0])):
+            entry: Dict[str, Any] = {}
+            names = (("bucket_start",) if interval > 0 else ()) + tuple(group_by)
+            entry.update(zip(names, group))
+            requests, errors, input_tokens, output_tokens, cache_read, latency, ttft, ttft_count = values
+            entry.update({
+                "requests": int(requests),
+                "errors": int(errors),
+                "input_tokens": int(input_tokens),
+                "output_tokens": int(output_tokens),
+                "cache_read_input_tokens": int(cache_read),
+                "avg_latency_ms": round(latency / requests, 1) if requests else None,
+                "avg_ttft_ms": round(ttft / ttft_count, 1) if ttft_count else None,
+            })
+            result.append(entry)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """账本状态，用于/health展示"""
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "pending_rows": len(self._pending),
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+            "last_error": self.last_error,
+        }